@@ -14,7 +14,6 @@ from openxyz.marlin import Marlin
 from coordinate_paths import RectangularPath
 
 import decimal
-import pickle
 import logging
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s\t[%(levelname)s]\t%(message)s")
@@ -68,6 +67,9 @@ def main():
 	# Output file for results
 	OUTPUT_FILE = "measurement_results.pckl"
 
+	# Journal of completed points, running the script again after a crash resumes the scan
+	JOURNAL_FILE = OUTPUT_FILE + ".journal"
+
 	# ========== Initialize Hardware ==========
 
 	logging.info("Initializing stage...")
@@ -89,9 +91,7 @@ def main():
 	# ========== Set Initial Position ==========
 
 	logging.info("Moving to starting position...")
-	stage.x = path.coordinates[0][0]
-	stage.y = path.coordinates[0][1]
-	stage.z = PROBE_HEIGHT
+	stage.move_to(x=path.coordinates[0][0], y=path.coordinates[0][1], z=PROBE_HEIGHT)
 
 	input("Stage is at starting position. Press Enter to begin scan...")
 
@@ -99,21 +99,13 @@ def main():
 
 	logging.info("Starting scan...")
 
-	with open(OUTPUT_FILE, 'wb') as results_file:
-		for idx, coordinate in enumerate(path.coordinates, start=1):
-			# Move to next position
-			stage.x = coordinate[0]
-			stage.y = coordinate[1]
-
-			logging.info(f"[{idx}/{total_points}] Measuring at ({coordinate[0]}, {coordinate[1]})")
-
-			# Perform measurement
-			data = measurement_callback()
-
-			# Save position and data
-			pickle.dump((coordinate, data), results_file)
+	# Moves and measurements run in this thread. Results are written to OUTPUT_FILE
+	# (pickled (coordinate, data) tuples) in the background while the stage already
+	# moves to the next point. Points already listed in JOURNAL_FILE are skipped and
+	# new results are appended to OUTPUT_FILE.
+	measured_points = stage.scan(path, measurement_callback, OUTPUT_FILE, journal=JOURNAL_FILE)
 
-	logging.info(f"Scan complete! Results saved to {OUTPUT_FILE}")
+	logging.info(f"Scan complete! {measured_points} results saved to {OUTPUT_FILE}")
 
 	# Optional: Return to starting position
 	# stage.x = START_X
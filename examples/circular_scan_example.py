@@ -68,9 +68,7 @@ def main():
 	# ========== Set Initial Position ==========
 
 	logging.info("Moving to center position...")
-	stage.x = CENTER_X
-	stage.y = CENTER_Y
-	stage.z = PROBE_HEIGHT
+	stage.move_to(x=CENTER_X, y=CENTER_Y, z=PROBE_HEIGHT)
 
 	input("Stage is at center position. Press Enter to begin spiral scan...")
 
@@ -80,9 +78,8 @@ def main():
 
 	with open(OUTPUT_FILE, 'wb') as results_file:
 		for idx, coordinate in enumerate(path.coordinates, start=1):
-			# Move to next position
-			stage.x = coordinate[0]
-			stage.y = coordinate[1]
+			# Move to next position (single diagonal move)
+			stage.xy = (coordinate[0], coordinate[1])
 
 			logging.info(f"[{idx}/{total_points}] Measuring at ({coordinate[0]}, {coordinate[1]})")
 
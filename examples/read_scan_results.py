@@ -5,74 +5,57 @@ This example demonstrates how to load and process measurement data
 saved by the basic_scan_with_callback.py example.
 """
 
-import pickle
 import logging
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s\t[%(levelname)s]\t%(message)s")
-
-
-def load_scan_results(filename: str):
-	"""
-	Load all measurement data from a pickle file.
-
-	:param filename: Path to the pickle file containing scan results
-	:type filename: str
-	:return: List of (coordinate, data) tuples
-	:rtype: list
-	"""
-	results = []
-
-	with open(filename, 'rb') as f:
-		while True:
-			try:
-				coordinate, data = pickle.load(f)
-				results.append((coordinate, data))
-			except EOFError:
-				break
+from openxyz.results import ScanResults
 
-	return results
+logging.basicConfig(level=logging.INFO, format="%(asctime)s\t[%(levelname)s]\t%(message)s")
 
 
 def main():
 	INPUT_FILE = "measurement_results.pckl"
 
-	logging.info(f"Loading scan results from {INPUT_FILE}...")
-	results = load_scan_results(INPUT_FILE)
+	logging.info(f"Opening scan results {INPUT_FILE}...")
+	# the first open indexes the file (saved next to it), points are only loaded when accessed
+	results = ScanResults(INPUT_FILE)
+
+	logging.info(f"Found {len(results)} measurements")
+
+	# Example: Access a single point by index
+	coordinate, data = results[0]
+	print(f"First position ({coordinate[0]}, {coordinate[1]}): {data}")
 
-	logging.info(f"Loaded {len(results)} measurements")
+	# Example: Access the point closest to a location
+	coordinate, data = results.at((1.0, 1.0))
+	print(f"Closest to (1, 1): ({coordinate[0]}, {coordinate[1]}): {data}")
 
-	# Example: Print all measurements
+	# Example: Print all measurements, one point at a time
 	for coordinate, data in results:
 		print(f"Position ({coordinate[0]}, {coordinate[1]}): {data}")
 
 	# Example: Extract specific data
-	# x_coords = [coord[0] for coord, data in results]
-	# y_coords = [coord[1] for coord, data in results]
-	# values = [data['voltage'] for coord, data in results]
+	# x_coords = results.coordinates[:, 0]
+	# y_coords = results.coordinates[:, 1]
+	# values = results.column('voltage')
 
-	# Example: Plot heatmap (requires matplotlib and numpy)
-	# import numpy as np
+	# Example: Plot heatmap (requires matplotlib)
 	# import matplotlib.pyplot as plt
+	# from openxyz.results import ResultGrid
 	#
-	# # Create grid
-	# x_unique = sorted(set(x_coords))
-	# y_unique = sorted(set(y_coords))
-	# grid = np.zeros((len(y_unique), len(x_unique)))
-	#
-	# # Fill grid with values
-	# for (x, y), data in results:
-	#     i = y_unique.index(y)
-	#     j = x_unique.index(x)
-	#     grid[i, j] = data['voltage']
+	# # Map the points onto a grid, repeated points are averaged, cells without points are masked
+	# grid = ResultGrid(results.coordinates)
+	# heatmap = grid.reduce(results.column('voltage'), 'mean')
 	#
 	# # Plot
-	# plt.imshow(grid, origin='lower', extent=[min(x_coords), max(x_coords), min(y_coords), max(y_coords)])
+	# plt.imshow(heatmap, origin='lower', extent=grid.extent)
 	# plt.colorbar(label='Voltage')
 	# plt.xlabel('X (mm)')
 	# plt.ylabel('Y (mm)')
 	# plt.title('Scan Results Heatmap')
 	# plt.show()
 
+	results.close()
+
 
 if __name__ == "__main__":
 	main()
@@ -0,0 +1,30 @@
+import importlib
+
+# public classes by the module defining them, imported on first access (e.g.: openxyz.Stage) so importing the package
+# stays cheap for CLI tools and worker processes
+_EXPORTS = {
+	'Stage': 'openxyz.xyz_stage',
+	'Marlin': 'openxyz.marlin',
+	'AsyncStage': 'openxyz.async_stage',
+	'AsyncMarlin': 'openxyz.async_marlin',
+	'MotionModel': 'openxyz.motion',
+	'Calibration': 'openxyz.calibration',
+	'ScanStore': 'openxyz.store',
+	'ScanJournal': 'openxyz.journal',
+	'ScanResults': 'openxyz.results',
+	'ResultGrid': 'openxyz.results',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name: str):
+	if name not in _EXPORTS:
+		raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+	value = getattr(importlib.import_module(_EXPORTS[name]), name)
+	globals()[name] = value
+	return value
+
+
+def __dir__():
+	return sorted(set(globals()) | set(_EXPORTS))
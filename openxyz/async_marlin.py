@@ -0,0 +1,291 @@
+import asyncio
+import concurrent.futures
+import itertools
+import json
+import logging
+from typing import Callable
+from urllib.parse import urlparse
+
+from openxyz.marlin_serial import UNKNOWN_CMD_MSG
+from openxyz.metrics import gcode_verb
+
+# commands which move or wait for moves, the emergency stop is issued if they time out
+MOTION_VERBS = frozenset(('G0', 'G1', 'G2', 'G3', 'G4', 'G28', 'G29', 'M400'))
+
+
+class AsyncMarlin:
+	"""
+	asyncio counterpart of :class:`openxyz.marlin.Marlin`.
+
+	The connection is selected by the scheme of ``url``:
+
+	- 'tcp://host:port' talks natively to the stream server of the bridge (pipelined, no threads involved)
+	- 'http://host:port' or a plain host name uses the HTTP API of the bridge
+	- 'serial:///dev/ttyACM0' drives the Marlin board directly through :class:`openxyz.marlin_serial.MarlinSerial`
+
+	Blocking connections (HTTP, serial) run on a dedicated single thread, so commands keep their order and the event
+	loop is never blocked. Every command has a timeout; if it expires or the awaiting task is cancelled while a move is
+	commanded (MOTION_VERBS), the emergency stop (M410) is issued through a path which bypasses queued commands before
+	the exception is propagated.
+
+	Use :meth:`connect` to create an instance.
+
+	:param url: URL of the bridge or serial port
+	:type url: str
+	:param timeout: Default timeout of a command in seconds (has to cover the longest move)
+	:type timeout: float, optional
+	"""
+
+	def __init__(self, url: str, timeout: float = 120.0):
+		self._log = logging.getLogger(__name__)
+		self.url = url if '://' in url else f'http://{url}:5000'
+		self.timeout = timeout
+		self.__scheme = urlparse(self.url).scheme
+		self.__executor = None
+		self.__transport = None
+		self.__marlin_serial = None
+		self.__reader = None
+		self.__writer = None
+		self.__reader_task = None
+		self.__ids = itertools.count(1)
+		self.__pending = {}
+		self.__listeners = []
+
+	@classmethod
+	async def connect(cls, url: str, timeout: float = 120.0, connect_timeout: float = 3.05, **kwargs) -> 'AsyncMarlin':
+		"""
+		Opens the connection and checks that Marlin is reachable.
+
+		:param url: URL of the bridge ('tcp://', 'http://', plain host name) or serial port ('serial://')
+		:type url: str
+		:param timeout: Default timeout of a command in seconds
+		:type timeout: float, optional
+		:param connect_timeout: Timeout for establishing the connection in seconds
+		:type connect_timeout: float, optional
+		:param kwargs: Further arguments of the underlying HttpTransport or MarlinSerial
+		:return: Connected instance
+		:rtype: AsyncMarlin
+		:raises Exception: If unable to connect to Marlin
+		"""
+		marlin = cls(url, timeout=timeout)
+		try:
+			await marlin.__open(connect_timeout, kwargs)
+		except Exception as e:
+			await marlin.close()
+			raise Exception(f"Could not connect to Marlin at {url}: {e}")
+		return marlin
+
+	async def send_gcode(self, gcode: str, timeout: float or None = None) -> str or None:
+		"""
+		Sends a G-code command to Marlin.
+
+		:param gcode: The G-code command to send
+		:type gcode: str
+		:param timeout: Timeout in seconds, defaults to the timeout of the connection
+		:type timeout: float or None, optional
+		:return: The response from Marlin
+		:rtype: str or None
+		:raises Exception: If unable to send G-code
+		:raises asyncio.TimeoutError: If the command does not complete in time (M410 has been issued for moves)
+		"""
+		stop = _is_motion(gcode)
+		if self.__scheme == 'serial':
+			response = await self.__guarded(self.__run(self.__marlin_serial.send_gcode, gcode), timeout, stop)
+			response = response.decode('utf-8').replace('ok\n', '').strip()
+		else:
+			response = await self.__guarded(self.__request('/send_gcode', {'gcode': gcode}), timeout, stop)
+			response = response["response"]
+		if UNKNOWN_CMD_MSG.decode() in response:
+			raise Exception(f"Unknown command: {gcode}")
+		return response if response else None
+
+	async def send_gcode_batch(self, gcodes: list[str], timeout: float or None = None) -> list[str or None]:
+		"""
+		Sends an ordered list of G-code commands. Execution stops at the first line that fails.
+
+		:param gcodes: The G-code commands to send, in execution order
+		:type gcodes: list[str]
+		:param timeout: Timeout for the whole batch in seconds, defaults to the timeout of the connection
+		:type timeout: float or None, optional
+		:return: The response from Marlin for every line
+		:rtype: list[str or None]
+		:raises Exception: If unable to send the batch or if a line fails
+		"""
+		stop = any(_is_motion(gcode) for gcode in gcodes)
+		if self.__scheme == 'serial':
+			def batch() -> list[str or None]:
+				responses = []
+				for index, gcode in enumerate(gcodes):
+					r = self.__marlin_serial.send_gcode(gcode).decode('utf-8').replace('ok\n', '').strip()
+					if UNKNOWN_CMD_MSG.decode() in r:
+						raise Exception(f"G-code batch failed at line {index} ('{gcode}'): Unknown command")
+					responses.append(r if r else None)
+				return responses
+			return await self.__guarded(self.__run(batch), timeout, stop)
+
+		response = await self.__guarded(self.__request('/send_gcode_batch', {'gcode': list(gcodes)}), timeout, stop)
+		if "error" in response:
+			index = response.get("index")
+			if index is None:
+				raise Exception(f"Could not send G-code batch: {response['error']}")
+			raise Exception(f"G-code batch failed at line {index} ('{gcodes[index]}'): {response['error']}")
+		return [r if r else None for r in response["responses"]]
+
+	async def get_encoder_status(self, timeout: float or None = None) -> dict:
+		"""
+		Returns the x, y encoder values (only available through the bridge).
+
+		:param timeout: Timeout in seconds, defaults to the timeout of the connection
+		:type timeout: float or None, optional
+		:return: Dictionary with x, y encoder values
+		:rtype: dict
+		:raises Exception: If connected to a serial port
+		"""
+		if self.__scheme == 'serial':
+			raise Exception("Encoder values are only available through the bridge")
+		return await asyncio.wait_for(self.__request('/encoder_status'), timeout or self.timeout)
+
+	async def emergency(self) -> None:
+		"""
+		Stops movement immediately (M410), bypassing queued commands.
+
+		:return: None
+		:rtype: None
+		"""
+		self._log.critical("Emergency stop initiated.")
+		if self.__scheme == 'serial':
+			await asyncio.to_thread(self.__marlin_serial.emergency_nowait)
+		elif self.__scheme == 'tcp':
+			await asyncio.wait_for(self.__request('/emergency', {}), self.timeout)
+		else:
+			# not on the command thread, which may be blocked by the command being aborted
+			await asyncio.to_thread(self.__transport.post, '/emergency', {})
+
+	def add_event_listener(self, callback: Callable[[dict], None]) -> None:
+		"""
+		Registers a callable for asynchronous events of the bridge (busy, encoder, error).
+		Only available for 'tcp://' connections.
+
+		:param callback: Callable receiving the event (e.g.: {"event": "busy"})
+		:type callback: Callable[[dict], None]
+		:return: None
+		:rtype: None
+		:raises Exception: If the connection does not support events
+		"""
+		if self.__scheme != 'tcp':
+			raise Exception(f"Events are not supported by {self.url}, use a 'tcp://' connection")
+		self.__listeners.append(callback)
+
+	async def close(self) -> None:
+		"""
+		Closes the connection.
+
+		:return: None
+		:rtype: None
+		"""
+		if self.__writer is not None:
+			self.__writer.close()
+			try:
+				await self.__writer.wait_closed()
+			except OSError:
+				pass
+		if self.__reader_task is not None:
+			await asyncio.gather(self.__reader_task, return_exceptions=True)
+		if self.__transport is not None:
+			await self.__run(self.__transport.close)
+		if self.__marlin_serial is not None:
+			await self.__run(self.__marlin_serial.close)
+		if self.__executor is not None:
+			self.__executor.shutdown(wait=False)
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, exc_type, exc_val, exc_tb):
+		await self.close()
+
+	async def __open(self, connect_timeout: float, kwargs: dict) -> None:
+		if self.__scheme == 'tcp':
+			parsed = urlparse(self.url)
+			self.__reader, self.__writer = await asyncio.wait_for(
+				asyncio.open_connection(parsed.hostname, parsed.port or 5001), connect_timeout)
+			self.__reader_task = asyncio.create_task(self.__read())
+		else:
+			self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='async-marlin')
+			if self.__scheme == 'serial':
+				from openxyz.marlin_serial import MarlinSerial
+				self.__marlin_serial = await self.__run(MarlinSerial, urlparse(self.url).path, **kwargs)
+				return
+			from openxyz.transport import HttpTransport
+			self.__transport = HttpTransport(self.url, connect_timeout=connect_timeout, read_timeout=self.timeout,
+											 **kwargs)
+		await asyncio.wait_for(self.__request('/status'), connect_timeout + self.timeout)
+
+	async def __run(self, function, *args, **kwargs):
+		loop = asyncio.get_running_loop()
+		return await loop.run_in_executor(self.__executor, lambda: function(*args, **kwargs))
+
+	async def __guarded(self, awaitable, timeout: float or None, stop: bool):
+		"""
+		Awaits a command, issues the emergency stop if it moves (stop) and times out or is cancelled.
+		"""
+		try:
+			return await asyncio.wait_for(awaitable, timeout or self.timeout)
+		except (asyncio.TimeoutError, asyncio.CancelledError):
+			if not stop:
+				raise
+			try:
+				await asyncio.shield(self.emergency())
+			except Exception as e:
+				self._log.error(f"Emergency stop failed: {e}")
+			raise
+
+	async def __request(self, endpoint: str, payload: dict or None = None) -> dict:
+		if self.__scheme != 'tcp':
+			if payload is None:
+				return await self.__run(self.__transport.get, endpoint)
+			return await self.__run(self.__transport.post, endpoint, payload)
+
+		if self.__reader_task.done():
+			raise ConnectionError(f"Connection to {self.url} is closed")
+		request_id = next(self.__ids)
+		future = asyncio.get_running_loop().create_future()
+		self.__pending[request_id] = future
+		message = {"id": request_id, "endpoint": endpoint, "payload": payload or {}}
+		self.__writer.write((json.dumps(message, separators=(',', ':')) + '\n').encode())
+		try:
+			await self.__writer.drain()
+			body, status = await future
+		finally:
+			self.__pending.pop(request_id, None)
+		if status != 200:
+			raise Exception(f"{endpoint} failed with status {status}: {body}")
+		return body
+
+	async def __read(self) -> None:
+		try:
+			while True:
+				line = await self.__reader.readline()
+				if not line:
+					break
+				message = json.loads(line)
+				if "event" in message:
+					for callback in list(self.__listeners):
+						try:
+							callback(message)
+						except Exception as e:
+							self._log.warning(f"Event listener failed: {e}")
+					continue
+				future = self.__pending.get(message.get("id"))
+				if future is not None and not future.done():
+					future.set_result((message.get("body") or {}, message.get("status")))
+		except (OSError, ValueError) as e:
+			self._log.debug(f"Reader of {self.url} stopped: {e}")
+		finally:
+			for future in self.__pending.values():
+				if not future.done():
+					future.set_exception(ConnectionError(f"Connection to {self.url} closed"))
+
+
+def _is_motion(gcode: str) -> bool:
+	return gcode_verb(gcode) in MOTION_VERBS
@@ -0,0 +1,135 @@
+import decimal
+
+from openxyz.async_marlin import AsyncMarlin
+from openxyz.xyz_stage import GCode, format_move, parse_position
+
+
+class AsyncStage:
+	"""
+	asyncio counterpart of :class:`openxyz.xyz_stage.Stage`.
+
+	Like Stage, the commanded position is tracked locally, so reading :attr:`position` needs no round trip.
+	Every awaitable takes an optional per-command timeout; on timeout or cancellation of a move, the emergency stop
+	(M410) is issued by :class:`openxyz.async_marlin.AsyncMarlin`.
+
+	Use :meth:`create` to create an initialized instance.
+
+	:param marlin: Connected AsyncMarlin
+	:type marlin: AsyncMarlin
+	:param feedrate: Feed rate of moves without explicit feed rate in mm/min
+	:type feedrate: int, optional
+	"""
+
+	def __init__(self, marlin: AsyncMarlin, feedrate: int = 100):
+		self.marlin = marlin
+		self.feedrate = feedrate
+		self.__position = [None, None, None]
+
+	@classmethod
+	async def create(cls, marlin: AsyncMarlin, feedrate: int = 100, timeout: float or None = None) -> 'AsyncStage':
+		"""
+		Creates the stage and initializes it (see :meth:`initialize`).
+
+		:param marlin: Connected AsyncMarlin
+		:type marlin: AsyncMarlin
+		:param feedrate: Feed rate of moves without explicit feed rate in mm/min
+		:type feedrate: int, optional
+		:param timeout: Timeout of the initialization in seconds (includes homing)
+		:type timeout: float or None, optional
+		:return: Initialized stage
+		:rtype: AsyncStage
+		"""
+		stage = cls(marlin, feedrate=feedrate)
+		await stage.initialize(timeout=timeout)
+		return stage
+
+	async def initialize(self, timeout: float or None = None) -> None:
+		"""
+		Sets mm units and absolute positioning, homes untrusted axes and resets the feed rates in a single batch.
+
+		:param timeout: Timeout in seconds (includes homing)
+		:type timeout: float or None, optional
+		:return: None
+		:rtype: None
+		"""
+		await self.marlin.send_gcode_batch([
+			GCode.G21.value,
+			GCode.G90.value,
+			f"{GCode.G28.value} O",
+			f"{GCode.M203.value} X300 Y300 Z300",
+			f"{GCode.M220.value} S100",
+			f"{GCode.M117.value} Open-FML",
+		], timeout=timeout)
+		self.__position = [None, None, None]
+
+	@property
+	def position(self) -> tuple[decimal.Decimal or None, decimal.Decimal or None, decimal.Decimal or None]:
+		"""
+		:return: Commanded x, y, z position, None for axes which are unknown (e.g.: after homing)
+		:rtype: tuple
+		"""
+		return tuple(self.__position)
+
+	async def move_to(self, x: decimal.Decimal = None, y: decimal.Decimal = None, z: decimal.Decimal = None,
+					  feed: int = None, timeout: float or None = None) -> None:
+		"""
+		Moves all given axes with a single linear move, omitted axes keep their position.
+
+		:param x: Target x in mm
+		:param y: Target y in mm
+		:param z: Target z in mm
+		:param feed: Feed rate in mm/min, defaults to the feed rate of the stage
+		:type feed: int, optional
+		:param timeout: Timeout in seconds, M410 is issued if the move does not complete in time
+		:type timeout: float or None, optional
+		:return: None
+		:rtype: None
+		"""
+		words = format_move(x, y, z, self.feedrate if feed is None else feed)
+		if not words:
+			return
+		try:
+			await self.marlin.send_gcode(' '.join([GCode.G0.value] + words), timeout=timeout)
+		except BaseException:
+			# the stage may have stopped anywhere between start and target
+			self.__position = [None, None, None]
+			raise
+		for axis, value in enumerate((x, y, z)):
+			if value is not None:
+				self.__position[axis] = decimal.Decimal(str(value))
+
+	async def query_position(self, timeout: float or None = None) -> tuple[decimal.Decimal, decimal.Decimal, decimal.Decimal]:
+		"""
+		Queries the position from Marlin (M114) and re-synchronizes the commanded position.
+
+		:param timeout: Timeout in seconds
+		:type timeout: float or None, optional
+		:return: x, y, z position
+		:rtype: tuple[decimal.Decimal, decimal.Decimal, decimal.Decimal]
+		"""
+		x, y, z = parse_position(await self.marlin.send_gcode(GCode.M114.value, timeout=timeout))
+		self.__position = [x, y, z]
+		return x, y, z
+
+	async def get_encoder_status(self, timeout: float or None = None) -> dict:
+		"""
+		:param timeout: Timeout in seconds
+		:type timeout: float or None, optional
+		:return: Dictionary with x, y encoder values
+		:rtype: dict
+		"""
+		return await self.marlin.get_encoder_status(timeout=timeout)
+
+	async def send_gcode(self, gcode: str, timeout: float or None = None) -> str or None:
+		"""
+		Sends a raw G-code command. The commanded position is invalidated, since the command may move the stage.
+
+		:param gcode: The G-code command to send
+		:type gcode: str
+		:param timeout: Timeout in seconds
+		:type timeout: float or None, optional
+		:return: The response from Marlin
+		:rtype: str or None
+		"""
+		self.__position = [None, None, None]
+		return await self.marlin.send_gcode(gcode, timeout=timeout)
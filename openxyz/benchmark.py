@@ -0,0 +1,482 @@
+import argparse
+import datetime
+import json
+import logging
+import math
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+from typing import Callable, List
+
+from openxyz.simulator import FakeEncoderBoard, MarlinSimulator, PtySimulator, VirtualClock
+
+# version of the result layout, increased on incompatible changes
+SCHEMA_VERSION = 1
+# import time budgets in milliseconds (python -X importtime) of the modules loaded by scripts, CLI tools and workers
+IMPORT_BUDGETS = {
+	'openxyz': 10.0,
+	'openxyz.marlin': 60.0,
+	'openxyz.marlin_serial': 60.0,
+	'openxyz.xyz_stage': 100.0,
+	'openxyz.rpi': 500.0,
+}
+
+
+def summarize(latencies: List[float]) -> dict:
+	"""
+	Summarizes latencies.
+
+	:param latencies: Latencies in seconds
+	:type latencies: List[float]
+	:return: Count, mean, min, p50, p90, p99 and max in milliseconds
+	:rtype: dict
+	"""
+	ordered = sorted(latencies)
+	if not ordered:
+		return {"count": 0}
+
+	def percentile(p: float) -> float:
+		return ordered[min(len(ordered) - 1, int(math.ceil(p / 100.0 * len(ordered))) - 1)] * 1e3
+
+	return {
+		"count": len(ordered),
+		"mean_ms": sum(ordered) / len(ordered) * 1e3,
+		"min_ms": ordered[0] * 1e3,
+		"p50_ms": percentile(50),
+		"p90_ms": percentile(90),
+		"p99_ms": percentile(99),
+		"max_ms": ordered[-1] * 1e3,
+	}
+
+
+def measure(call: Callable[[int], None], count: int, warmup: int = 2) -> List[float]:
+	"""
+	Measures the latency of repeated calls.
+
+	:param call: Called with the number of the call
+	:type call: Callable[[int], None]
+	:param count: Number of measured calls
+	:type count: int
+	:param warmup: Number of calls before measuring
+	:type warmup: int, optional
+	:return: Latency of every measured call in seconds
+	:rtype: List[float]
+	"""
+	for i in range(warmup):
+		call(i)
+	latencies = []
+	for i in range(count):
+		start = time.perf_counter()
+		call(i)
+		latencies.append(time.perf_counter() - start)
+	return latencies
+
+
+def raster_path(width: float = 10.0, height: float = 10.0, step: float = 0.5) -> list:
+	"""
+	:return: Snake raster coordinates (like RectangularPath) starting at (0, 0)
+	:rtype: list
+	"""
+	columns, rows = int(round(width / step)) + 1, int(round(height / step)) + 1
+	path = []
+	for row in range(rows):
+		xs = range(columns) if row % 2 == 0 else reversed(range(columns))
+		path.extend((round(column * step, 6), round(row * step, 6)) for column in xs)
+	return path
+
+
+def spiral_path(center: tuple = (10.0, 10.0), radius: float = 5.0, step: float = 0.5) -> list:
+	"""
+	:return: Archimedean spiral coordinates (like CircularPath) from the center outward, step apart along the spiral
+		and between turns
+	:rtype: list
+	"""
+	path = [center]
+	angle = 0.0
+	while True:
+		r = step * angle / (2 * math.pi)
+		angle += step / max(r, step)
+		r = step * angle / (2 * math.pi)
+		if r > radius:
+			return path
+		path.append((round(center[0] + r * math.cos(angle), 6), round(center[1] + r * math.sin(angle), 6)))
+
+
+def bench_marlin_serial(count: int) -> dict:
+	"""
+	Latency of MarlinSerial.send_gcode on an in-process simulator, without bridge and motion time.
+
+	:param count: Number of commands per G-code
+	:type count: int
+	:return: Real latencies and simulated (virtual) time per command of M114 and G0
+	:rtype: dict
+	"""
+	from openxyz.marlin_serial import MarlinSerial
+
+	simulator = MarlinSimulator()
+	marlin_serial = MarlinSerial(None, mock=True, simulator=simulator)
+	results = {}
+	for name, gcode in (('M114', lambda i: 'M114'), ('G0', lambda i: f'G0 X{i % 2} F6000')):
+		start = simulator.clock.time()
+		latencies = measure(lambda i: marlin_serial.send_gcode(gcode(i)), count, warmup=0)
+		results[name] = summarize(latencies)
+		results[name]["virtual_mean_ms"] = (simulator.clock.time() - start) / count * 1e3
+	return results
+
+
+def bench_marlin(url: str, count: int) -> dict:
+	"""
+	Latency of Marlin.send_gcode through the bridge.
+
+	:param url: URL of the bridge
+	:type url: str
+	:param count: Number of commands per G-code
+	:type count: int
+	:return: Latencies of M114 and G0
+	:rtype: dict
+	"""
+	from openxyz.marlin import Marlin
+
+	marlin = Marlin(url)
+	try:
+		return {
+			'M114': summarize(measure(lambda i: marlin.send_gcode('M114'), count)),
+			'G0': summarize(measure(lambda i: marlin.send_gcode(f'G0 X{i % 2} F6000'), count)),
+		}
+	finally:
+		marlin.close()
+
+
+def bench_encoder_status(url: str, count: int) -> dict:
+	"""
+	Rate of encoder queries (/encoder_status) through the bridge.
+
+	:param url: URL of the bridge
+	:type url: str
+	:param count: Number of queries
+	:type count: int
+	:return: Queries per second and latencies
+	:rtype: dict
+	"""
+	from openxyz.marlin import Marlin
+
+	marlin = Marlin(url)
+	try:
+		latencies = measure(lambda i: marlin.get_encoder_status(), count)
+	finally:
+		marlin.close()
+	result = summarize(latencies)
+	result["queries_per_s"] = len(latencies) / sum(latencies)
+	return result
+
+
+def bench_stage_moves(url: str, count: int) -> dict:
+	"""
+	Round trip of Stage.move_to through the bridge (command, move completion, response).
+
+	:param url: URL of the bridge
+	:type url: str
+	:param count: Number of moves
+	:type count: int
+	:return: Latencies of the moves
+	:rtype: dict
+	"""
+	from openxyz.marlin import Marlin
+	from openxyz.xyz_stage import Stage
+
+	marlin = Marlin(url)
+	try:
+		stage = Stage(marlin, feedrate=6000)
+		return summarize(measure(lambda i: stage.move_to(x=i % 2, y=0), count))
+	finally:
+		marlin.close()
+
+
+def bench_scan(path: list) -> dict:
+	"""
+	Throughput of Stage.scan on an in-process simulator. The simulated (virtual) time covers motion and the serial
+	protocol as seen by Marlin, the real time the host side; points per hour are estimated from both.
+
+	:param path: Coordinates of the scan
+	:type path: list
+	:return: Points, virtual and real seconds, estimated points per hour, motion model estimate
+	:rtype: dict
+	"""
+	from openxyz.marlin import Marlin
+	from openxyz.xyz_stage import Stage
+
+	simulator = MarlinSimulator()
+	stage = Stage(Marlin(None, mock=True, simulator=simulator), feedrate=6000)
+	stage.move_to(x=path[0][0], y=path[0][1])
+	virtual_start, real_start = simulator.clock.time(), time.perf_counter()
+	points = stage.scan(path, lambda: None, lambda coordinate, data: None)
+	virtual = simulator.clock.time() - virtual_start
+	real = time.perf_counter() - real_start
+	return {
+		"points": points,
+		"virtual_s": virtual,
+		"real_s": real,
+		"points_per_hour": points * 3600.0 / (virtual + real),
+		"motion_estimate_s": stage.estimate(path),
+	}
+
+
+def import_time(module: str, repeat: int = 3) -> float:
+	"""
+	Measures the time to import a module (including its dependencies) in a fresh interpreter with python -X importtime.
+	Modules imported by the interpreter itself (e.g.: site) are not counted.
+
+	:param module: Module name (e.g.: 'openxyz.xyz_stage')
+	:type module: str
+	:param repeat: Number of measurements, the fastest one is returned
+	:type repeat: int, optional
+	:return: Import time in milliseconds
+	:rtype: float
+	"""
+	startup = set(_top_level_imports('pass'))
+	return min(sum(t for name, t in _top_level_imports(f'import {module}').items() if name not in startup)
+			   for _ in range(repeat))
+
+
+def check_import_budgets(budgets: dict = None) -> dict:
+	"""
+	Measures the import time of every module with a budget.
+
+	:param budgets: Budgets in milliseconds by module name, :data:`IMPORT_BUDGETS` by default
+	:type budgets: dict, optional
+	:return: {'import_ms': ..., 'budget_ms': ...} by module name
+	:rtype: dict
+	"""
+	budgets = IMPORT_BUDGETS if budgets is None else budgets
+	return {module: {"import_ms": import_time(module), "budget_ms": budget} for module, budget in budgets.items()}
+
+
+class LoopbackBridge:
+	"""
+	Runs rpi.py in a subprocess on loopback, with a simulated Marlin on a pseudo-terminal and fake encoders
+	(see :func:`serve_bridge`).
+
+	:param speed: Speed of the virtual clock of the simulator, None to run as fast as possible
+	:type speed: float, optional
+	:param timeout: Time to wait for the bridge to start in seconds
+	:type timeout: float, optional
+	"""
+
+	def __init__(self, speed: float = None, timeout: float = 30.0):
+		self.speed = speed
+		self.timeout = timeout
+		self.http_port = _free_port()
+		self.stream_port = _free_port()
+		self.__process = None
+
+	@property
+	def http_url(self) -> str:
+		return f'http://127.0.0.1:{self.http_port}'
+
+	@property
+	def stream_url(self) -> str:
+		return f'tcp://127.0.0.1:{self.stream_port}'
+
+	def __enter__(self):
+		command = [sys.executable, '-m', 'openxyz.benchmark', '--serve-bridge', str(self.http_port),
+				   str(self.stream_port)]
+		if self.speed:
+			command += ['--speed', str(self.speed)]
+		self.__process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		deadline = time.monotonic() + self.timeout
+		while True:
+			try:
+				with socket.create_connection(('127.0.0.1', self.stream_port), timeout=0.5):
+					pass
+				with socket.create_connection(('127.0.0.1', self.http_port), timeout=0.5):
+					return self
+			except OSError:
+				if self.__process.poll() is not None or time.monotonic() > deadline:
+					self.__exit__(None, None, None)
+					raise Exception("Loopback bridge did not start")
+				time.sleep(0.1)
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		if self.__process is not None:
+			self.__process.terminate()
+			try:
+				self.__process.wait(5)
+			except subprocess.TimeoutExpired:
+				self.__process.kill()
+			self.__process = None
+
+
+def serve_bridge(http_port: int, stream_port: int, speed: float = None) -> None:
+	"""
+	Runs the bridge (rpi.py) against a simulated Marlin and fake encoders, blocks until killed.
+
+	:param http_port: Port of the HTTP API
+	:type http_port: int
+	:param stream_port: Port of the stream channel
+	:type stream_port: int
+	:param speed: Speed of the virtual clock, None to run as fast as possible
+	:type speed: float, optional
+	:return: None
+	:rtype: None
+	"""
+	simulator = MarlinSimulator(clock=VirtualClock(speed))
+	FakeEncoderBoard(simulator).install()
+	os.environ['OPENXYZ_SERIAL_PORT'] = PtySimulator(simulator).start()
+
+	from openxyz import rpi
+	from openxyz.stream_server import StreamServer
+
+	rpi.start()
+	stream_server = StreamServer(('127.0.0.1', stream_port), rpi.HANDLERS, worker=rpi.marlin_worker,
+								 immediate=('/emergency', '/status'))
+	stream_server.start()
+	rpi.app.run(host='127.0.0.1', port=http_port, threaded=True)
+
+
+def run(count: int = 50, bridge: bool = True) -> dict:
+	"""
+	Runs all benchmarks.
+
+	:param count: Number of commands, queries and moves per measurement
+	:type count: int, optional
+	:param bridge: If False, only the in-process benchmarks run
+	:type bridge: bool, optional
+	:return: Results, see :func:`main` for the layout
+	:rtype: dict
+	"""
+	log = logging.getLogger(__name__)
+	results = {}
+	log.info("MarlinSerial.send_gcode")
+	results["marlin_serial.send_gcode"] = bench_marlin_serial(count)
+	if bridge:
+		with LoopbackBridge() as loopback:
+			for transport, url in (('http', loopback.http_url), ('tcp', loopback.stream_url)):
+				log.info(f"Marlin.send_gcode ({transport})")
+				results[f"marlin.send_gcode.{transport}"] = bench_marlin(url, count)
+				log.info(f"/encoder_status ({transport})")
+				results[f"encoder_status.{transport}"] = bench_encoder_status(url, count)
+			log.info("Stage.move_to")
+			results["stage.move_to"] = bench_stage_moves(loopback.http_url, count)
+	for name, path in (('raster', raster_path()), ('spiral', spiral_path())):
+		log.info(f"Stage.scan ({name})")
+		results[f"scan.{name}"] = bench_scan(path)
+	log.info("Import times")
+	results["import"] = {module: {"import_ms": result["import_ms"]}
+						 for module, result in check_import_budgets().items()}
+	return results
+
+
+def compare(baseline: dict, current: dict, threshold: float = 0.1) -> List[str]:
+	"""
+	Lists the metrics which changed by more than a threshold between two result files.
+
+	:param baseline: Results of a previous run
+	:type baseline: dict
+	:param current: Results of this run
+	:type current: dict
+	:param threshold: Relative change
+	:type threshold: float, optional
+	:return: One line per changed metric
+	:rtype: List[str]
+	"""
+	old, new = _flatten(baseline.get("results", {})), _flatten(current.get("results", {}))
+	lines = []
+	for key in sorted(old.keys() & new.keys()):
+		if old[key] and abs(new[key] - old[key]) / abs(old[key]) > threshold:
+			lines.append(f"{key}: {old[key]:.4g} -> {new[key]:.4g} ({(new[key] / old[key] - 1) * 100:+.1f} %)")
+	return lines
+
+
+def _flatten(results: dict, prefix: str = '') -> dict:
+	flat = {}
+	for key, value in results.items():
+		if isinstance(value, dict):
+			flat.update(_flatten(value, f'{prefix}{key}.'))
+		elif isinstance(value, (int, float)) and key != 'count':
+			flat[prefix + key] = float(value)
+	return flat
+
+
+def _top_level_imports(code: str) -> dict:
+	# cumulative import time in milliseconds of every module imported at the top level by code
+	output = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True,
+							check=True).stderr
+	times = {}
+	for line in output.splitlines():
+		if not line.startswith('import time:'):
+			continue
+		_, cumulative, name = line.split('|')
+		if cumulative.strip().isdigit() and not name.startswith('  ', 1):
+			times[name.strip()] = int(cumulative) / 1e3
+	return times
+
+
+def _free_port() -> int:
+	with socket.socket() as s:
+		s.bind(('127.0.0.1', 0))
+		return s.getsockname()[1]
+
+
+def _revision() -> str or None:
+	try:
+		return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__), capture_output=True,
+							  text=True, timeout=5).stdout.strip() or None
+	except (OSError, subprocess.SubprocessError):
+		return None
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description="Benchmarks OpenXYZ against a simulated Marlin and fake encoders.")
+	parser.add_argument('-o', '--output', default='benchmark.json', help="JSON result file")
+	parser.add_argument('-n', '--count', type=int, default=50, help="commands, queries and moves per measurement")
+	parser.add_argument('--no-bridge', action='store_true', help="skip the benchmarks through rpi.py")
+	parser.add_argument('--compare', help="JSON result file of a previous run")
+	parser.add_argument('--import-budget', action='store_true',
+						help="only check the import times, exit with status 1 if a module exceeds its budget")
+	parser.add_argument('--serve-bridge', nargs=2, type=int, metavar=('HTTP_PORT', 'STREAM_PORT'),
+						help=argparse.SUPPRESS)
+	parser.add_argument('--speed', type=float, default=None, help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.serve_bridge:
+		serve_bridge(*args.serve_bridge, speed=args.speed)
+		return
+
+	if args.import_budget:
+		exceeded = False
+		for module, result in check_import_budgets().items():
+			over = result["import_ms"] > result["budget_ms"]
+			exceeded |= over
+			print(f"{module}: {result['import_ms']:.1f} ms (budget {result['budget_ms']:.0f} ms){' EXCEEDED' if over else ''}")
+		sys.exit(1 if exceeded else 0)
+
+	logging.basicConfig(level=logging.INFO, format="%(asctime)s\t[%(levelname)s]\t%(message)s")
+	# per-command logging of the clients is part of the scan, but not of the report
+	for name in ('openxyz.marlin', 'openxyz.marlin_serial', 'openxyz.xyz_stage', 'openxyz.simulator'):
+		logging.getLogger(name).setLevel(logging.WARNING)
+
+	report = {
+		"schema": SCHEMA_VERSION,
+		"created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+		"revision": _revision(),
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"parameters": {"count": args.count, "bridge": not args.no_bridge},
+		"results": run(args.count, bridge=not args.no_bridge),
+	}
+	with open(args.output, 'w') as f:
+		json.dump(report, f, indent=2)
+	print(json.dumps(report["results"], indent=2))
+
+	if args.compare:
+		with open(args.compare, 'r') as f:
+			baseline = json.load(f)
+		for line in compare(baseline, report) or ["No changes above 10 %"]:
+			print(line)
+
+
+if __name__ == "__main__":
+	main()
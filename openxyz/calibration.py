@@ -0,0 +1,236 @@
+import decimal
+import logging
+from typing import Sequence
+
+import numpy as np
+
+from openxyz.settle import COUNTER_MODULUS
+
+
+def signed_counts(counts) -> np.ndarray:
+	"""
+	Converts raw (unsigned 32 bit) encoder counters into signed counts.
+
+	:param counts: Raw counter values
+	:return: Signed counts
+	:rtype: np.ndarray
+	"""
+	counts = np.asarray(counts, dtype=np.int64)
+	return (counts + COUNTER_MODULUS // 2) % COUNTER_MODULUS - COUNTER_MODULUS // 2
+
+
+class Calibration:
+	"""
+	Encoder scale and position error map of the x, y axes.
+
+	Encoder counts are converted to millimetres with a per-axis linear fit (``offset + scale * counts``). The
+	remaining difference between reached (encoder) and commanded position, e.g. the lead screw error, is stored on a
+	regular grid and interpolated bilinearly; outside of the grid the nearest edge value is used.
+
+	Use :meth:`fit` or :func:`calibrate` to create a calibration.
+
+	:param scale: x, y millimetres per count
+	:type scale: Sequence[float]
+	:param offset: x, y position of count zero in mm
+	:type offset: Sequence[float]
+	:param xs: Increasing x coordinates of the error grid in mm
+	:type xs: Sequence[float]
+	:param ys: Increasing y coordinates of the error grid in mm
+	:type ys: Sequence[float]
+	:param errors: (len(xs), len(ys), 2) reached minus commanded x, y position in mm
+	:type errors: np.ndarray
+	"""
+
+	def __init__(self, scale: Sequence[float], offset: Sequence[float], xs: Sequence[float], ys: Sequence[float],
+				 errors: np.ndarray):
+		self.scale = np.asarray(scale, dtype=np.float64)
+		self.offset = np.asarray(offset, dtype=np.float64)
+		self.xs = np.asarray(xs, dtype=np.float64)
+		self.ys = np.asarray(ys, dtype=np.float64)
+		self.errors = np.asarray(errors, dtype=np.float64)
+		if self.errors.shape != (len(self.xs), len(self.ys), 2):
+			raise ValueError(f"Error grid has shape {self.errors.shape}, expected {(len(self.xs), len(self.ys), 2)}")
+
+	@classmethod
+	def fit(cls, commanded: np.ndarray, counts: np.ndarray, counts_per_mm: Sequence[float] = None) -> 'Calibration':
+		"""
+		Fits a calibration to positions measured on a grid (see :func:`measure`).
+
+		:param commanded: (n, 2) commanded x, y positions in mm, every combination of the grid coordinates
+		:type commanded: np.ndarray
+		:param counts: (n, 2) raw or signed x, y encoder counts at these positions
+		:type counts: np.ndarray
+		:param counts_per_mm: Known x, y encoder resolution, only the offsets are fitted if given (the error map then
+			also contains the linear error of the axes)
+		:type counts_per_mm: Sequence[float], optional
+		:return: Calibration
+		:rtype: Calibration
+		:raises ValueError: If the positions do not cover a full grid
+		"""
+		commanded = np.asarray(commanded, dtype=np.float64)[:, :2]
+		counts = signed_counts(counts)[:, :2].astype(np.float64)
+		xs, x_index = np.unique(commanded[:, 0], return_inverse=True)
+		ys, y_index = np.unique(commanded[:, 1], return_inverse=True)
+		if len(xs) < 2 or len(ys) < 2:
+			raise ValueError("Calibration needs at least 2 x 2 grid positions")
+
+		scale, offset = np.empty(2), np.empty(2)
+		for axis in range(2):
+			if counts_per_mm is None:
+				scale[axis], offset[axis] = np.polyfit(counts[:, axis], commanded[:, axis], 1)
+			else:
+				scale[axis] = 1.0 / counts_per_mm[axis]
+				offset[axis] = np.mean(commanded[:, axis] - scale[axis] * counts[:, axis])
+
+		reached = offset + scale * counts
+		# average repeated measurements of a grid position
+		sums = np.zeros((len(xs), len(ys), 2))
+		hits = np.zeros((len(xs), len(ys)))
+		np.add.at(sums, (x_index, y_index), reached - commanded)
+		np.add.at(hits, (x_index, y_index), 1)
+		if (hits == 0).any():
+			raise ValueError(f"{int((hits == 0).sum())} grid positions were not measured")
+		return cls(scale, offset, xs, ys, sums / hits[..., None])
+
+	def counts_to_mm(self, counts) -> np.ndarray:
+		"""
+		:param counts: (..., 2) raw or signed x, y encoder counts
+		:return: (..., 2) x, y positions in mm
+		:rtype: np.ndarray
+		"""
+		return self.offset + self.scale * signed_counts(counts)
+
+	def error(self, positions) -> np.ndarray:
+		"""
+		Interpolates the position error.
+
+		:param positions: (..., 2+) commanded x, y(, z) positions in mm
+		:return: (..., 2) expected reached minus commanded x, y position in mm
+		:rtype: np.ndarray
+		"""
+		positions = np.asarray(positions, dtype=np.float64)[..., :2]
+		ix, tx = _cell(self.xs, positions[..., 0])
+		iy, ty = _cell(self.ys, positions[..., 1])
+		tx, ty = tx[..., None], ty[..., None]
+		e = self.errors
+		return ((1 - tx) * (1 - ty) * e[ix, iy] + tx * (1 - ty) * e[ix + 1, iy]
+				+ (1 - tx) * ty * e[ix, iy + 1] + tx * ty * e[ix + 1, iy + 1])
+
+	def correct(self, targets, iterations: int = 2) -> np.ndarray:
+		"""
+		Computes the positions to command so the stage reaches the targets, for whole paths at once.
+
+		:param targets: (n, 2) or (n, 3) target positions in mm, z is passed through
+		:param iterations: Fixed point iterations of command = target - error(command)
+		:type iterations: int, optional
+		:return: Positions to command, same shape as targets
+		:rtype: np.ndarray
+		"""
+		targets = np.array([[float(v) for v in t] for t in targets], dtype=np.float64) \
+			if not isinstance(targets, np.ndarray) else targets.astype(np.float64)
+		commands = targets.copy()
+		for _ in range(max(iterations, 1)):
+			commands[..., :2] = targets[..., :2] - self.error(commands)
+		return commands
+
+	def correct_path(self, coordinates, decimals: int = 4) -> list:
+		"""
+		Corrects the coordinates of a path (see :meth:`correct`), e.g. for :meth:`openxyz.xyz_stage.Stage.move_to`.
+
+		:param coordinates: Path or sequence of (x, y) or (x, y, z) coordinates
+		:param decimals: Decimal places of the corrected coordinates
+		:type decimals: int, optional
+		:return: Corrected coordinates as tuples of decimal.Decimal
+		:rtype: list
+		"""
+		coordinates = list(getattr(coordinates, 'coordinates', coordinates))
+		if not coordinates:
+			return []
+		corrected = np.round(self.correct(coordinates), decimals)
+		return [tuple(decimal.Decimal(f"{v:.{decimals}f}") for v in row) for row in corrected]
+
+	def save(self, filename: str) -> None:
+		"""
+		Saves the calibration as NumPy .npz file.
+
+		:param filename: Path of the file
+		:type filename: str
+		:return: None
+		:rtype: None
+		"""
+		with open(filename, 'wb') as f:
+			np.savez(f, scale=self.scale, offset=self.offset, xs=self.xs, ys=self.ys, errors=self.errors)
+
+	@classmethod
+	def load(cls, filename: str) -> 'Calibration':
+		"""
+		Loads a calibration saved with :meth:`save`.
+
+		:param filename: Path of the file
+		:type filename: str
+		:return: Calibration
+		:rtype: Calibration
+		"""
+		with np.load(filename) as data:
+			return cls(data['scale'], data['offset'], data['xs'], data['ys'], data['errors'])
+
+
+def _cell(grid: np.ndarray, values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+	# index of the grid interval containing every value and the position within it, clamped to the grid
+	values = np.clip(values, grid[0], grid[-1])
+	index = np.clip(np.searchsorted(grid, values, side='right') - 1, 0, len(grid) - 2)
+	t = (values - grid[index]) / (grid[index + 1] - grid[index])
+	return index, t
+
+
+def measure(stage, xs: Sequence, ys: Sequence, window: int = 2, samples: int = 5,
+			timeout: float = 5.0) -> tuple[np.ndarray, np.ndarray]:
+	"""
+	Moves the stage to every grid position (snake order) and reads the encoders once it has settled.
+
+	:param stage: Stage connected to the bridge
+	:type stage: openxyz.xyz_stage.Stage
+	:param xs: x coordinates of the grid in mm
+	:type xs: Sequence
+	:param ys: y coordinates of the grid in mm
+	:type ys: Sequence
+	:param window: Settle window in counts, see :meth:`openxyz.xyz_stage.Stage.wait_settled`
+	:type window: int, optional
+	:param samples: Consecutive settled samples
+	:type samples: int, optional
+	:param timeout: Settle timeout in seconds
+	:type timeout: float, optional
+	:return: (n, 2) commanded positions in mm, (n, 2) signed encoder counts
+	:rtype: tuple[np.ndarray, np.ndarray]
+	"""
+	log = logging.getLogger(__name__)
+	commanded, counts = [], []
+	for row, y in enumerate(ys):
+		for x in (xs if row % 2 == 0 else list(reversed(xs))):
+			stage.move_to(x=x, y=y)
+			stage.wait_settled(window=window, samples=samples, timeout=timeout)
+			status = stage.get_encoder_status()
+			commanded.append((float(x), float(y)))
+			counts.append((status["x"], status["y"]))
+			log.debug(f"Calibration point ({x}, {y}): {status['x']}, {status['y']}")
+	return np.array(commanded), signed_counts(counts)
+
+
+def calibrate(stage, xs: Sequence, ys: Sequence, counts_per_mm: Sequence[float] = None, **kwargs) -> Calibration:
+	"""
+	Measures a grid (see :func:`measure`) and fits a calibration to it (see :meth:`Calibration.fit`).
+
+	:param stage: Stage connected to the bridge
+	:type stage: openxyz.xyz_stage.Stage
+	:param xs: x coordinates of the grid in mm
+	:type xs: Sequence
+	:param ys: y coordinates of the grid in mm
+	:type ys: Sequence
+	:param counts_per_mm: Known x, y encoder resolution
+	:type counts_per_mm: Sequence[float], optional
+	:param kwargs: Settle parameters of :func:`measure`
+	:return: Calibration
+	:rtype: Calibration
+	"""
+	commanded, counts = measure(stage, xs, ys, **kwargs)
+	return Calibration.fit(commanded, counts, counts_per_mm=counts_per_mm)
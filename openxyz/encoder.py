@@ -118,18 +118,29 @@ class EncoderAxis(enum.Enum):
 	ENCODER_AXIS_Z = 2
 
 
+BYTE_WIDTHS = {
+	ByteWidth.BYTE_WIDTH_1.value: 1,
+	ByteWidth.BYTE_WIDTH_2.value: 2,
+	ByteWidth.BYTE_WIDTH_3.value: 3,
+	ByteWidth.BYTE_WIDTH_4.value: 4,
+}
+
+
 class LS7366R:
-	def __init__(self, bus: int, cs_pins: Dict[EncoderAxis, int]):
+	def __init__(self, bus: int, cs_pins: Dict[EncoderAxis, int], spi_speed: int = 100_000):
 		self._log = logging.getLogger(__name__)
 		self.__bus = bus
 		self.__spi_mode = 0
-		self.__spi_speed = 100_000
+		self.__spi_speed = spi_speed
 		self.__spi = spidev.SpiDev()
 		self.__spi.open(bus=self.__bus, device=0)
 		self.__spi.no_cs = False
 		self.__spi.max_speed_hz = self.__spi_speed
 		self.__spi.mode = self.__spi_mode
 		self.__cs_pins = cs_pins
+		# MDR0/MDR1 as last written by the driver, so reads need no extra transaction to know the byte width
+		self.__mdr0 = {}
+		self.__mdr1 = {}
 
 		GPIO.setmode(GPIO.BCM)
 		for pin in self.__cs_pins.values():
@@ -140,7 +151,7 @@ class LS7366R:
 		self.initialize()
 
 	def initialize(self):
-		for axis in EncoderAxis:
+		for axis in self.__cs_pins:
 			self.clear_mode_register_0(axis)
 			self.clear_mode_register_1(axis)
 			self.clear_counter(axis)
@@ -164,6 +175,16 @@ class LS7366R:
 	def __del__(self):
 		GPIO.cleanup()
 
+	@property
+	def spi_speed(self) -> int:
+		return self.__spi_speed
+
+	@spi_speed.setter
+	def spi_speed(self, speed: int):
+		# SPI clock in Hz
+		self.__spi_speed = speed
+		self.__spi.max_speed_hz = speed
+
 	def __slave_select(self, encoder_axis: EncoderAxis, select: bool):
 		GPIO.output(self.__cs_pins[encoder_axis], not select)
 
@@ -179,11 +200,22 @@ class LS7366R:
 			self.__slave_select(encoder_axis, False)
 		return r
 
+	def __transfer(self, encoder_axis: EncoderAxis, opcode: Opcode, length: int) -> List[int]:
+		# opcode and response in a single transaction
+		self.__slave_select(encoder_axis, True)
+		try:
+			r = self.__spi.xfer2([opcode.value] + [0] * length)
+		finally:
+			self.__slave_select(encoder_axis, False)
+		return r[1:]
+
 	def clear_mode_register_0(self, encoder_axis: EncoderAxis):
 		self.__write(encoder_axis, [Opcode.CLR_MDR0.value], True)
+		self.__mdr0[encoder_axis] = 0x00
 
 	def clear_mode_register_1(self, encoder_axis: EncoderAxis):
 		self.__write(encoder_axis, [Opcode.CLR_MDR1.value], True)
+		self.__mdr1[encoder_axis] = 0x00
 
 	def clear_counter(self, encoder_axis: EncoderAxis):
 		self.__write(encoder_axis, [Opcode.CLR_CNTR.value], True)
@@ -192,42 +224,52 @@ class LS7366R:
 		self.__write(encoder_axis, [Opcode.CLR_STR.value], True)
 
 	def read_mode_register_0(self, encoder_axis: EncoderAxis):
-		self.__write(encoder_axis, [Opcode.READ_MDR0.value], False)
-		response = self.__read(encoder_axis, 1, True)
-		return response[0]
+		mdr_0 = self.__transfer(encoder_axis, Opcode.READ_MDR0, 1)[0]
+		self.__mdr0[encoder_axis] = mdr_0
+		return mdr_0
 
 	def read_mode_register_1(self, encoder_axis: EncoderAxis):
-		self.__write(encoder_axis, [Opcode.READ_MDR1.value], False)
-		response = self.__read(encoder_axis, 1, True)
-		return response[0]
+		mdr_1 = self.__transfer(encoder_axis, Opcode.READ_MDR1, 1)[0]
+		self.__mdr1[encoder_axis] = mdr_1
+		return mdr_1
+
+	def __cached_mode_register_1(self, encoder_axis: EncoderAxis) -> int:
+		mdr_1 = self.__mdr1.get(encoder_axis)
+		if mdr_1 is None:
+			mdr_1 = self.read_mode_register_1(encoder_axis)
+		return mdr_1
 
 	def command_byte_width(self, encoder_axis: EncoderAxis) -> int:
-		mdr_1 = self.read_mode_register_1(encoder_axis)
-		if (mdr_1 & 0x03) == ByteWidth.BYTE_WIDTH_4.value:
-			return 4
-		elif (mdr_1 & 0x03) == ByteWidth.BYTE_WIDTH_3.value:
-			return 3
-		elif (mdr_1 & 0x03) == ByteWidth.BYTE_WIDTH_2.value:
-			return 2
-		else:
-			return 1
+		return BYTE_WIDTHS[self.__cached_mode_register_1(encoder_axis) & 0x03]
 
 	def counting_enabled(self, encoder_axis: EncoderAxis) -> bool:
-		mdr_1 = self.read_mode_register_1(encoder_axis)
+		mdr_1 = self.__cached_mode_register_1(encoder_axis)
 		return (mdr_1 & 0x04) == 0
 
 	def read_counter(self, encoder_axis: EncoderAxis) -> int:
-		current_byte_width = self.command_byte_width(encoder_axis)
-		self.__write(encoder_axis, [Opcode.READ_CNTR.value], False)
-		response = self.__read(encoder_axis, current_byte_width, True)
+		response = self.__transfer(encoder_axis, Opcode.READ_CNTR, self.command_byte_width(encoder_axis))
 		return int.from_bytes(response, byteorder='big')
 
 	def read_output_register(self, encoder_axis: EncoderAxis) -> int:
-		current_byte_width = self.command_byte_width(encoder_axis)
-		self.__write(encoder_axis, [Opcode.READ_OTR.value], False)
-		response = self.__read(encoder_axis, current_byte_width, True)
+		response = self.__transfer(encoder_axis, Opcode.READ_OTR, self.command_byte_width(encoder_axis))
 		return int.from_bytes(response, byteorder='big')
 
+	def latch_counters(self, encoder_axes: List[EncoderAxis] = None):
+		# copies CNTR to OTR of all given axes at the same instant: all chips are selected and receive one LOAD_OTR
+		pins = [self.__cs_pins[axis] for axis in (encoder_axes or self.__cs_pins)]
+		GPIO.output(pins, False)
+		try:
+			self.__spi.writebytes([Opcode.LOAD_OTR.value])
+		finally:
+			GPIO.output(pins, True)
+
+	def read_counters(self, encoder_axes: List[EncoderAxis] = None) -> Dict[EncoderAxis, int]:
+		# consistent snapshot of several axes: counters are latched simultaneously, then each output register is read
+		# in a single transaction
+		encoder_axes = list(encoder_axes or self.__cs_pins)
+		self.latch_counters(encoder_axes)
+		return {axis: self.read_output_register(axis) for axis in encoder_axes}
+
 	def read_status(self, encoder_axis: EncoderAxis) -> Status:
 		self.__write(encoder_axis, [Opcode.READ_STR.value], False)
 		response = self.__read(encoder_axis, 1, True)
@@ -235,15 +277,16 @@ class LS7366R:
 
 	def write_mode_register_0(self, encoder_axis: EncoderAxis, mdr: MDR_0):
 		self.__write(encoder_axis, [Opcode.WRITE_MDR0.value, mdr.value], True)
+		self.__mdr0[encoder_axis] = mdr.value
 
 	def write_mode_register_1(self, encoder_axis: EncoderAxis, mdr: MDR_1):
 		self.__write(encoder_axis, [Opcode.WRITE_MDR1.value, mdr.value], True)
+		self.__mdr1[encoder_axis] = mdr.value
 
 	def write_data_register(self, encoder_axis: EncoderAxis, dtr: int):
 		current_byte_width = self.command_byte_width(encoder_axis)
 		dtr_as_bytes = dtr.to_bytes(current_byte_width, 'big')
-		self.__write(encoder_axis, [Opcode.WRITE_DTR.value], False)
-		self.__write(encoder_axis, list(dtr_as_bytes), True)
+		self.__write(encoder_axis, [Opcode.WRITE_DTR.value] + list(dtr_as_bytes), True)
 
 	def load_data_register_to_output_register(self, encoder_axis: EncoderAxis):
 		self.__write(encoder_axis, [Opcode.LOAD_OTR.value], True)
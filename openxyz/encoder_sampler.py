@@ -0,0 +1,135 @@
+import logging
+import struct
+import threading
+import time
+from typing import Callable, Tuple
+
+# layout of a sample, np.dtype(SAMPLE_FIELDS) reads the raw buffer returned by EncoderSampler.samples_since
+SAMPLE_FIELDS = [('t', '<f8'), ('x', '<i8'), ('y', '<i8'), ('z', '<i8')]
+SAMPLE = struct.Struct('<dqqq')
+
+
+class EncoderSampler:
+	"""
+	Samples the encoders from a background thread into a fixed-size ring buffer.
+
+	Samples are (t, x, y, z) records with t as UNIX timestamp in seconds, packed into a preallocated buffer, so
+	sampling creates no objects per sample. Every sample has a sequence number (0 for the first sample ever taken),
+	the newest ``capacity`` samples are retained.
+
+	:param read: Callable returning the x, y, z counters (e.g.: a latched LS7366R snapshot)
+	:type read: Callable[[], Tuple[int, int, int]]
+	:param capacity: Number of samples retained
+	:type capacity: int, optional
+	:param interval: Sampling interval in seconds
+	:type interval: float, optional
+	"""
+
+	def __init__(self, read: Callable[[], Tuple[int, int, int]], capacity: int = 65536, interval: float = 0.001):
+		self._log = logging.getLogger(__name__)
+		self.read = read
+		self.capacity = capacity
+		self.interval = interval
+		self.__buffer = bytearray(capacity * SAMPLE.size)
+		self.__count = 0
+		self.__lock = threading.Lock()
+		self.__stop = threading.Event()
+		self.__thread = None
+
+	@property
+	def running(self) -> bool:
+		return self.__thread is not None and self.__thread.is_alive()
+
+	@property
+	def sequence(self) -> int:
+		"""
+		:return: Sequence number of the next sample
+		:rtype: int
+		"""
+		return self.__count
+
+	def start(self, interval: float = None) -> None:
+		"""
+		Starts sampling, sequence numbers continue where a previous run stopped.
+
+		:param interval: Sampling interval in seconds, defaults to the current interval
+		:type interval: float, optional
+		:return: None
+		:rtype: None
+		"""
+		if interval is not None:
+			self.interval = interval
+		if self.running:
+			return
+		self.__stop.clear()
+		self.__thread = threading.Thread(target=self.__run, name='encoder-sampler', daemon=True)
+		self.__thread.start()
+
+	def stop(self, timeout: float = 1.0) -> None:
+		"""
+		Stops sampling, retained samples stay available.
+
+		:param timeout: Time to wait for the sampling thread in seconds
+		:type timeout: float, optional
+		:return: None
+		:rtype: None
+		"""
+		self.__stop.set()
+		if self.__thread is not None:
+			self.__thread.join(timeout)
+			self.__thread = None
+
+	def sample(self) -> None:
+		"""
+		Takes a single sample.
+
+		:return: None
+		:rtype: None
+		"""
+		x, y, z = self.read()
+		t = time.time()
+		with self.__lock:
+			SAMPLE.pack_into(self.__buffer, (self.__count % self.capacity) * SAMPLE.size, t, x, y, z)
+			self.__count += 1
+
+	def samples_since(self, since: int = 0, limit: int = None) -> Tuple[int, int, bytes]:
+		"""
+		Returns the retained samples starting at a sequence number.
+
+		:param since: Sequence number of the first requested sample
+		:type since: int, optional
+		:param limit: Maximum number of samples
+		:type limit: int, optional
+		:return: Sequence number of the first returned sample (larger than since if samples were overwritten),
+			sequence number to request next, packed samples (see SAMPLE_FIELDS)
+		:rtype: Tuple[int, int, bytes]
+		"""
+		with self.__lock:
+			end = self.__count
+			first = min(max(since, end - self.capacity, 0), end)
+			if limit is not None:
+				end = min(end, first + limit)
+			start_slot, end_slot = first % self.capacity, end % self.capacity
+			if end - first == 0:
+				data = b''
+			elif start_slot < end_slot:
+				data = bytes(self.__buffer[start_slot * SAMPLE.size:end_slot * SAMPLE.size])
+			else:
+				data = bytes(self.__buffer[start_slot * SAMPLE.size:]) + bytes(self.__buffer[:end_slot * SAMPLE.size])
+		return first, end, data
+
+	def __run(self) -> None:
+		deadline = time.monotonic()
+		while not self.__stop.is_set():
+			try:
+				self.sample()
+			except Exception as e:
+				self._log.error(f"Encoder sampling failed: {e}")
+				self.__stop.wait(1.0)
+			deadline += self.interval
+			delay = deadline - time.monotonic()
+			if delay > 0:
+				self.__stop.wait(delay)
+			else:
+				# fell behind, do not catch up with a burst of samples
+				deadline = time.monotonic()
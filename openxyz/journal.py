@@ -0,0 +1,191 @@
+import hashlib
+import logging
+import os
+import struct
+import time
+from typing import Iterable, Sequence
+
+import numpy as np
+
+JOURNAL_EXTENSION = '.journal'
+MAGIC = b'OXYZJRN2'
+# magic, sha256 path fingerprint, number of points
+HEADER = struct.Struct('<8s32sQ')
+# index of a completed point, position of the result sink after its result
+RECORD = struct.Struct('<QQ')
+
+
+def path_fingerprint(coordinates: Iterable[Sequence]) -> bytes:
+	"""
+	Identifies a path by its coordinates and their order.
+
+	:param coordinates: Coordinates in scan order
+	:type coordinates: Iterable[Sequence]
+	:return: SHA-256 digest of the coordinates
+	:rtype: bytes
+	"""
+	digest = hashlib.sha256()
+	for coordinate in coordinates:
+		digest.update(' '.join(str(v) for v in coordinate).encode())
+		digest.update(b'\n')
+	return digest.digest()
+
+
+class ScanJournal:
+	"""
+	Append-only record of the completed points of a scan, used to resume a scan after a crash.
+
+	The journal starts with the fingerprint and length of the path, followed by the index of every point whose result
+	was handed to the result sink and the position of the sink after it (file offset or number of rows). Records are
+	written through a buffer and synced to disk (fsync) every ``sync_every`` points or ``sync_interval`` seconds, see
+	:attr:`due`; a truncated last record is ignored on load. Before resuming, :meth:`restore` drops the records of
+	results missing from the sink, and the sink is truncated to the returned position, which also drops results that
+	were written after the last record. Points completed after the last sync are scanned again on resume.
+
+	:param filename: Path of the journal, created if it does not exist
+	:type filename: str
+	:param fingerprint: Fingerprint of the path, see :func:`path_fingerprint`
+	:type fingerprint: bytes
+	:param points: Number of points of the path
+	:type points: int
+	:param sync_every: Number of records after which a sync is due
+	:type sync_every: int, optional
+	:param sync_interval: Time in seconds after which a sync is due
+	:type sync_interval: float, optional
+	:raises ValueError: If the journal belongs to a different path
+	"""
+
+	def __init__(self, filename: str, fingerprint: bytes, points: int, sync_every: int = 256,
+				 sync_interval: float = 2.0):
+		self._log = logging.getLogger(__name__)
+		self.filename = filename
+		self.points = points
+		self.sync_every = sync_every
+		self.sync_interval = sync_interval
+		self.__completed = np.zeros(points, dtype=bool)
+		self.__records = np.zeros(0, dtype=[('index', '<u8'), ('position', '<u8')])
+		self.position = 0  # position of the result sink after the last recorded point
+		self.__unsynced = 0
+		self.__last_sync = time.monotonic()
+
+		if os.path.exists(filename) and os.path.getsize(filename) >= HEADER.size:
+			with open(filename, 'rb') as f:
+				raw = f.read()
+			magic, journal_fingerprint, journal_points = HEADER.unpack_from(raw)
+			if magic != MAGIC:
+				raise ValueError(f"{filename} is not a scan journal")
+			if journal_fingerprint != fingerprint or journal_points != points:
+				raise ValueError(f"Journal {filename} belongs to a different path")
+			records = (len(raw) - HEADER.size) // RECORD.size
+			self.__records = np.frombuffer(raw, dtype=self.__records.dtype, count=records, offset=HEADER.size)
+			indices = self.__records['index']
+			self.__completed[indices[indices < points]] = True
+			if records:
+				self.position = int(self.__records['position'][-1])
+			self.__file = open(filename, 'r+b')
+			# drop a truncated last record
+			self.__file.truncate(HEADER.size + records * RECORD.size)
+			self.__file.seek(0, os.SEEK_END)
+			self._log.info(f"Journal {filename}: {len(self)} of {points} points completed")
+		else:
+			self.__file = open(filename, 'wb')
+			self.__file.write(HEADER.pack(MAGIC, fingerprint, points))
+			self.sync()
+
+	def __len__(self) -> int:
+		# number of completed points
+		return int(np.count_nonzero(self.__completed))
+
+	@property
+	def finished(self) -> bool:
+		return len(self) == self.points
+
+	def completed(self, index: int) -> bool:
+		"""
+		:return: True if the point was completed
+		:rtype: bool
+		"""
+		return bool(self.__completed[index])
+
+	def remaining(self) -> np.ndarray:
+		"""
+		:return: Indices of the points not completed yet, in path order
+		:rtype: np.ndarray
+		"""
+		return np.flatnonzero(~self.__completed)
+
+	def record(self, index: int, position: int = 0) -> None:
+		"""
+		Marks a point as completed (written on the next sync at the latest).
+
+		:param index: Index of the point in the path
+		:type index: int
+		:param position: Position of the result sink after the result of the point
+		:type position: int, optional
+		:return: None
+		:rtype: None
+		"""
+		self.__file.write(RECORD.pack(index, position))
+		self.__completed[index] = True
+		self.position = position
+		self.__unsynced += 1
+
+	def restore(self, size: int) -> int:
+		"""
+		Drops the records of points whose results are missing from the result sink (e.g.: the journal reached the disk
+		before the results), these points are scanned again. Called before the first :meth:`record`.
+
+		:param size: Position of the end of the result sink
+		:type size: int
+		:return: Position after the result of the last kept record, the sink has to be truncated to it
+		:rtype: int
+		"""
+		records = int(np.count_nonzero(np.cumprod(self.__records['position'] <= size)))
+		if records < len(self.__records):
+			self._log.warning(f"Journal {self.filename}: results of {len(self.__records) - records} points are "
+							  f"missing, scanning them again")
+			self.__records = self.__records[:records]
+			self.__completed[:] = False
+			indices = self.__records['index']
+			self.__completed[indices[indices < self.points]] = True
+			self.__file.truncate(HEADER.size + records * RECORD.size)
+			self.__file.seek(0, os.SEEK_END)
+			self.sync()
+		self.position = int(self.__records['position'][-1]) if records else 0
+		return self.position
+
+	@property
+	def due(self) -> bool:
+		# True if records are waiting longer than sync_every records or sync_interval seconds
+		return self.__unsynced > 0 and (self.__unsynced >= self.sync_every
+										or time.monotonic() - self.__last_sync >= self.sync_interval)
+
+	def sync(self) -> None:
+		"""
+		Writes all records to disk.
+
+		:return: None
+		:rtype: None
+		"""
+		self.__file.flush()
+		os.fsync(self.__file.fileno())
+		self.__unsynced = 0
+		self.__last_sync = time.monotonic()
+
+	def close(self) -> None:
+		"""
+		Syncs and closes the journal.
+
+		:return: None
+		:rtype: None
+		"""
+		if self.__file.closed:
+			return
+		self.sync()
+		self.__file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
@@ -1,40 +1,71 @@
-import json
 import logging
 import time
-import requests
+
+from typing import Callable
+
+from openxyz import metrics
+
+COMMANDS = metrics.counter('openxyz_client_commands_total', 'G-code commands sent by the client', ('verb',))
+COMMAND_SECONDS = metrics.histogram('openxyz_client_command_seconds', 'Round trip of a G-code command', ('verb',))
+BATCH_SECONDS = metrics.histogram('openxyz_client_batch_seconds', 'Round trip of a G-code batch')
+ERRORS = metrics.counter('openxyz_client_errors_total', 'Failed G-code commands and batches', ('kind',))
 
 
 class Marlin:
 	"""
 	Abstracts the connection to a Marlin (either via IP or USB).
 
-	:param ip: IP address of Marlin
+	The transport is selected by the scheme of ``ip``: a plain host name or IP address (e.g.: 'openxyz') and
+	'http://host:port' use the HTTP API of the bridge, 'tcp://host:port' uses its persistent stream channel.
+
+	:param ip: IP address, host name or URL of the bridge
 	:type ip: str, optional
-	:param mock: If True, use a mock Marlin connection
+	:param mock: If True, talk to a simulated Marlin in-process instead of the bridge
 	:type mock: bool, optional
+	:param connect_timeout: Timeout for establishing a connection in seconds
+	:type connect_timeout: float, optional
+	:param read_timeout: Timeout for receiving a response in seconds (has to cover the longest move)
+	:type read_timeout: float, optional
+	:param max_retries: Maximum number of retries of a failed request (commands only if they did not reach the bridge)
+	:type max_retries: int, optional
+	:param backoff_base: Backoff before the first retry in seconds, doubled with every retry
+	:type backoff_base: float, optional
+	:param backoff_max: Upper bound of the backoff in seconds
+	:type backoff_max: float, optional
+	:param simulator: Simulated Marlin used in mock mode, e.g. with a virtual clock running faster than real time
+	:type simulator: openxyz.simulator.MarlinSimulator, optional
 	:raises Exception: If unable to connect to Marlin
 	"""
 
-	def __init__(self, ip: str, mock: bool = False):
+	def __init__(self, ip: str, mock: bool = False, connect_timeout: float = 3.05, read_timeout: float = 120.0,
+				 max_retries: int = 5, backoff_base: float = 0.5, backoff_max: float = 30.0, simulator=None):
 		self._log = logging.getLogger(__name__)
 		self._mock = mock
 		if self._mock:
+			from openxyz.marlin_serial import MarlinSerial
+
 			self.ip = None
 			self.url = None
-			self._log.info("[Mock Marlin] Using mock Marlin.")
+			self._transport = None
+			# serial connection to the simulator, as the bridge would use it
+			self._serial = MarlinSerial(None, mock=True, simulator=simulator)
+			self._log.info("[Mock Marlin] Using simulated Marlin.")
 			return
 
+		# requests is only loaded for a connection to the bridge
+		from openxyz.transport import open_transport
+
 		self.ip = ip
-		self.url = f'http://{self.ip}:5000'
+		self.url = ip if '://' in ip else f'http://{self.ip}:5000'
 		logging.info(f"[Connecting to Marlin] {self.ip}")
 		try:
-			response = requests.get(f'{self.url}/status')
-		except requests.exceptions.ConnectionError:
-			raise Exception(f"Could not connect to Marlin at {self.ip}")
-		if response.status_code == 200:
-			logging.info(f"\tconnected!")
-		else:
-			raise Exception(f"Could not connect to Marlin: {response.text}")
+			self._transport = open_transport(self.url, connect_timeout=connect_timeout, read_timeout=read_timeout,
+											 max_retries=max_retries, backoff_base=backoff_base,
+											 backoff_max=backoff_max)
+			self._transport.get('/status')
+		except Exception as e:
+			raise Exception(f"Could not connect to Marlin at {self.ip}: {e}")
+		logging.info(f"\tconnected!")
 
 	def send_gcode(self, gcode: str) -> str or None:
 		"""
@@ -46,33 +77,68 @@ class Marlin:
 		:rtype: str or None
 		:raises Exception: If unable to send G-code
 		"""
-		if self._mock:
-			self._log.info(f"\tSending G-code: {gcode}")
-			return
-
-		payload = {'gcode': gcode}
-
-		retry_count = 0
-		while True:
-			try:
-				response = requests.post(f'{self.url}/send_gcode', json=payload)
-				while response.status_code != 200:
-					response = requests.post(f'{self.url}/send_gcode', json=payload)
-					if response.status_code == 200:
-						break
-				if response.status_code == 200:
-					break
-			except:
-				self._log.warning(f"({retry_count})\tCould not send G-code, retrying...")
-				time.sleep(5)
-				retry_count += 1
-
-		response = response.text
-		response = json.loads(response)["response"]
+		verb = metrics.gcode_verb(gcode)
+		start = time.perf_counter()
+		try:
+			if self._mock:
+				self._log.debug(f"\tSending G-code: {gcode}")
+				response = self._serial.send_gcode(gcode).decode('utf-8').replace('ok\n', '').strip()
+			else:
+				response = self._transport.post('/send_gcode', {'gcode': gcode})["response"]
+		except Exception:
+			ERRORS.labels('request').inc()
+			raise
+		COMMANDS.labels(verb).inc()
+		COMMAND_SECONDS.labels(verb).observe(time.perf_counter() - start)
 		if "echo:Unknown command:" in response:
+			ERRORS.labels('unknown_command').inc()
 			raise Exception(f"Unknown command: {gcode}")
 		return response if response else None
 
+	def send_gcode_batch(self, gcodes: list[str]) -> list[str or None]:
+		"""
+		Sends an ordered list of G-code commands to Marlin in a single round trip.
+		Execution stops at the first line that fails.
+
+		:param gcodes: The G-code commands to send, in execution order
+		:type gcodes: list[str]
+		:return: The response from Marlin for every line
+		:rtype: list[str or None]
+		:raises Exception: If unable to send the batch or if a line fails
+		"""
+		if self._mock:
+			return [self.send_gcode(gcode) for gcode in gcodes]
+
+		start = time.perf_counter()
+		try:
+			response = self._transport.post('/send_gcode_batch', {'gcode': list(gcodes)})
+		except Exception:
+			ERRORS.labels('request').inc()
+			raise
+		BATCH_SECONDS.observe(time.perf_counter() - start)
+		for gcode in gcodes[:len(response.get("responses", ()))]:
+			COMMANDS.labels(metrics.gcode_verb(gcode)).inc()
+		if "error" in response:
+			ERRORS.labels('batch').inc()
+			index = response.get("index")
+			if index is None:
+				raise Exception(f"Could not send G-code batch: {response['error']}")
+			raise Exception(f"G-code batch failed at line {index} ('{gcodes[index]}'): {response['error']}")
+		return [r if r else None for r in response["responses"]]
+
+	def emergency(self) -> None:
+		"""
+		Stops movement immediately (M410). Commands queued on the bridge are cancelled.
+
+		:return: None
+		:rtype: None
+		"""
+		if self._mock:
+			self._log.critical("\tEmergency stop initiated.")
+			self._serial.send_gcode('M410')
+			return
+		self._transport.post('/emergency', {})
+
 	def get_encoder_status(self) -> dict:
 		"""
 		Returns the x, y encoder values.
@@ -80,6 +146,103 @@ class Marlin:
 		:return: Dictionary with x, y encoder values
 		:rtype: dict
 		"""
-		response = requests.get(f'{self.url}/encoder_status')
-		response = json.loads(response.text)
-		return response
\ No newline at end of file
+		return self._transport.get('/encoder_status')
+
+	def wait_settled(self, window: int = 2, samples: int = 5, timeout: float = 5.0, interval: float = 0.001) -> dict:
+		"""
+		Waits until all moves are completed (M400) and the encoders stay within a window for a number of consecutive
+		samples.
+
+		:param window: Maximum spread of every encoder during the stable samples in counts
+		:type window: int, optional
+		:param samples: Number of consecutive samples which have to stay within the window
+		:type samples: int, optional
+		:param timeout: Maximum time to wait for settling after M400 in seconds
+		:type timeout: float, optional
+		:param interval: Time between samples in seconds
+		:type interval: float, optional
+		:return: Dictionary with 'settled', the measured 'settle_time' in seconds and the x, y encoder values
+		:rtype: dict
+		"""
+		if self._mock:
+			self._serial.synchronize()
+			return {"settled": True, "settle_time": 0.0, "x": 0, "y": 0}
+		return self._transport.post('/wait_settled', {
+			"window": window, "samples": samples, "timeout": timeout, "interval": interval
+		})
+
+	def set_encoder_sampling(self, enable: bool, interval: float = None) -> dict:
+		"""
+		Starts or stops sampling the encoders on the bridge in the background.
+
+		:param enable: True to start, False to stop sampling
+		:type enable: bool
+		:param interval: Sampling interval in seconds
+		:type interval: float, optional
+		:return: Dictionary with the sampling state ('running', 'interval', 'sequence')
+		:rtype: dict
+		"""
+		return self._transport.post('/encoder_sampling', {"enable": enable, "interval": interval})
+
+	def get_encoder_samples(self, since: int = 0, limit: int = None) -> tuple:
+		"""
+		Returns the encoder values sampled on the bridge (see :meth:`set_encoder_sampling`) since a sequence number.
+		Pass the returned sequence number as ``since`` to get only new samples with the next call.
+
+		:param since: Sequence number of the first sample
+		:type since: int, optional
+		:param limit: Maximum number of samples
+		:type limit: int, optional
+		:return: Structured array with fields t (UNIX time in seconds), x, y, z and the sequence number to request next
+		:rtype: tuple[numpy.ndarray, int]
+		"""
+		import base64
+		import numpy as np
+
+		body = self._transport.post('/encoder_samples', {"since": since, "limit": limit})
+		dtype = np.dtype([tuple(field) for field in body["fields"]])
+		samples = np.frombuffer(base64.b64decode(body["data"]), dtype=dtype)
+		if body["first"] > since:
+			self._log.warning(f"{body['first'] - since} encoder samples were overwritten before they were read.")
+		return samples, body["next"]
+
+	def add_event_listener(self, callback: Callable[[dict], None]) -> None:
+		"""
+		Registers a callable for asynchronous events of the bridge (busy, encoder, error).
+		Only available for 'tcp://' connections.
+
+		:param callback: Callable receiving the event (e.g.: {"event": "busy"})
+		:type callback: Callable[[dict], None]
+		:return: None
+		:rtype: None
+		:raises Exception: If the transport does not support events
+		"""
+		if not hasattr(self._transport, 'add_listener'):
+			raise Exception(f"Events are not supported by {self.url}, use a 'tcp://' connection")
+		self._transport.add_listener(callback)
+
+	def subscribe_encoder(self, interval: float = 0.1) -> None:
+		"""
+		Requests encoder events from the bridge every interval seconds. Only available for 'tcp://' connections.
+
+		:param interval: Interval between encoder events in seconds
+		:type interval: float, optional
+		:return: None
+		:rtype: None
+		:raises Exception: If the transport does not support events
+		"""
+		if not hasattr(self._transport, 'subscribe'):
+			raise Exception(f"Events are not supported by {self.url}, use a 'tcp://' connection")
+		self._transport.subscribe('encoder', interval)
+
+	def close(self) -> None:
+		"""
+		Closes the connection to Marlin.
+
+		:return: None
+		:rtype: None
+		"""
+		if self._transport is not None:
+			self._transport.close()
+		if self._mock:
+			self._serial.close()
@@ -14,12 +14,94 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import collections
+import re
+import threading
 import time
 import serial
 import logging
 
+from openxyz import metrics
+from openxyz.utils import checksum, iter_gcode
+
 BUSY_MSG = b'echo:busy: processing\n'
 OK_MSG = b'ok\n'
+UNKNOWN_CMD_MSG = b'echo:Unknown command:'
+ERROR_MSG = b'Error:'
+
+BUFSIZE = 4  # Marlin command buffer size (BUFSIZE in Configuration_adv.h)
+# default baud rate of the port, firmware built from documentation/marlin/Configuration.h (BAUDRATE 250000) needs
+# baudrate=250000 (OPENXYZ_BAUDRATE=250000 for the bridge)
+BAUDRATE = 115200
+PORT_TIMEOUT = 0.25  # s, longest blocking read, bounds how late a deadline is noticed
+RESEND_PATTERN = re.compile(rb'^(?:Resend:|rs)\s*N?(\d+)')
+ADVANCED_OK_PATTERN = re.compile(rb'\bB(\d+)')
+
+COMMANDS = metrics.counter('openxyz_serial_commands_total', 'G-code commands sent to Marlin', ('verb',))
+COMMAND_SECONDS = metrics.histogram('openxyz_serial_command_seconds', 'Time from sending a command until it returns',
+									('verb',))
+OK_WAIT_SECONDS = metrics.histogram('openxyz_serial_ok_wait_seconds', "Time waiting for the 'ok' of a command",
+									('verb',))
+M400_SECONDS = metrics.histogram('openxyz_serial_m400_seconds', 'Time waiting for moves to complete (M400)')
+BUSY = metrics.counter('openxyz_serial_busy_total', 'Busy keepalive messages received from Marlin')
+RESENDS = metrics.counter('openxyz_serial_resends_total', 'Lines resent on request of Marlin')
+ERRORS = metrics.counter('openxyz_serial_errors_total', 'Serial errors, timeouts and errors reported by Marlin',
+						 ('kind',))
+
+
+class LineKind:
+	"""
+	Kinds of lines sent by Marlin, see :func:`classify_line`.
+	"""
+	OK = 'ok'
+	BUSY = 'busy'
+	RESEND = 'resend'
+	ERROR = 'error'
+	ECHO = 'echo'
+	DATA = 'data'
+
+
+def classify_line(line: bytes) -> str:
+	"""
+	:param line: Line received from Marlin (e.g.: b'ok\\n')
+	:type line: bytes
+	:return: LineKind of the line, DATA for reports (e.g.: M114 positions)
+	:rtype: str
+	"""
+	if line.startswith(b'ok'):
+		return LineKind.OK
+	if line.startswith(b'echo:busy'):
+		return LineKind.BUSY
+	if RESEND_PATTERN.match(line):
+		return LineKind.RESEND
+	if line.startswith(ERROR_MSG) or line.startswith(UNKNOWN_CMD_MSG):
+		return LineKind.ERROR
+	if line.startswith(b'echo:'):
+		return LineKind.ECHO
+	return LineKind.DATA
+
+
+def is_motion_command(cmd: str) -> bool:
+	"""
+	:param cmd: Command string (e.g.: 'G0 X1')
+	:type cmd: str
+	:return: True if the command is a linear move (G0/G1)
+	:rtype: bool
+	"""
+	return re.match(r'G[01](?!\d)', cmd) is not None
+
+
+class _InFlight:
+	"""
+	A numbered line (or an out-of-band line without number) which has been written to Marlin but not yet
+	acknowledged with 'ok'.
+	"""
+	__slots__ = ('line_number', 'cmd', 'response')
+
+	def __init__(self, line_number: int, cmd: str, response: bytearray):
+		self.line_number = line_number
+		self.cmd = cmd
+		self.response = response
 
 
 class MarlinSerial:
@@ -28,16 +110,64 @@ class MarlinSerial:
 
 	:param tty: Serial port (e.g.: '/dev/ttyACM0')
 	:type tty: str
-	:param mock: If True, use a mock serial connection
+	:param mock: If True, talk to a simulated Marlin (see :class:`openxyz.simulator.MarlinSimulator`) instead of tty
 	:type mock: bool, optional
+	:param streaming: If True, moves are streamed into the Marlin planner instead of waiting for M400 after each move
+	:type streaming: bool, optional
+	:param buffer_size: Number of lines which may be in flight in streaming mode (Marlin BUFSIZE)
+	:type buffer_size: int, optional
+	:param timeout: Maximum time without any message from Marlin in seconds, busy keepalives extend it
+	:type timeout: float, optional
+	:param baudrate: Baud rate of tty (BAUDRATE of the Marlin configuration)
+	:type baudrate: int, optional
+	:param simulator: Simulated Marlin used in mock mode, e.g. with a virtual clock running faster than real time
+	:type simulator: openxyz.simulator.MarlinSimulator, optional
 	"""
 
-	def __init__(self, tty: str, mock: bool = False):
+	def __init__(self, tty: str, mock: bool = False, streaming: bool = False, buffer_size: int = BUFSIZE,
+				 timeout: float = 25.0, baudrate: int = BAUDRATE, simulator=None):
 		self.log = logging.getLogger(__name__)
 		self.sim = mock
-		if not self.sim:
-			self.ser = serial.Serial(port=tty, baudrate=115200, timeout=0.25)
-			self.clear()
+		self.streaming = streaming
+		self.timeout = timeout
+		# optional callable, invoked for every busy keepalive message of Marlin
+		self.on_busy = None
+		if self.sim:
+			from openxyz.simulator import MarlinSimulator
+			self.ser = simulator if simulator is not None else MarlinSimulator()
+			self.log.info('Using simulated Marlin.')
+		else:
+			self.ser = serial.Serial(port=tty, baudrate=baudrate, timeout=PORT_TIMEOUT)
+		# received bytes which do not form a complete line yet
+		self.__received = bytearray()
+		# 'ok's still to come for commands nobody waits for anymore (e.g.: interrupted by Ctrl-C, emergency_nowait),
+		# they precede the reply of the next command
+		self.__stray_oks = 0
+		# 'ok's of M410 written by emergency_nowait while a command waits for its reply, they follow that reply
+		self.__trailing_oks = 0
+		# True while a command waits for its reply (non-streaming mode)
+		self.__waiting = False
+		# emergency_nowait() writes from other threads
+		self.__write_lock = threading.Lock()
+		self.clear()
+
+		# streaming state
+		self.__buffer_size = buffer_size
+		self.__window = buffer_size
+		self.__line_number = 0
+		# line number of the last acknowledged streamed line, lines are acknowledged in order
+		self.__acknowledged = 0
+		# 'ok's which answer resend requests instead of lines
+		self.__resend_oks = 0
+		# first line of the last resend, and the number of lines behind the rejected one which may still request it
+		self.__resend_from = None
+		self.__stale_resends = 0
+		self.__history = collections.OrderedDict()
+		self.__in_flight = collections.deque()
+		# streamed moves which Marlin rejected, reported by synchronize()
+		self.__rejected_moves = []
+		if self.streaming:
+			self.__reset_line_number()
 
 	def clear(self) -> None:
 		"""
@@ -46,26 +176,23 @@ class MarlinSerial:
 		:return: None
 		:rtype: None
 		"""
-		if self.sim:
-			self.log.info('Clearing serial buffer.')
-		else:
-			self.ser.flush()
-			self.ser.reset_input_buffer()
+		self.ser.flush()
+		self.ser.reset_input_buffer()
+		self.__received.clear()
+		with self.__write_lock:
+			self.__stray_oks = 0
+			self.__trailing_oks = 0
 
 	def read(self) -> bytes:
 		"""
 		Reads a line from serial interface.
 
-		:return: Line read from serial interface
+		:return: Line read from serial interface, empty if there is none within the port timeout
 		:rtype: bytes
 		"""
-		if self.sim:
-			time.sleep(0.5)
-			return b'ok\n'
-		else:
-			msg = self.ser.readline()
-			self.log.debug('Read from serial port: {:s}'.format(str(msg)))
-			return msg
+		msg = self.__read_line(time.monotonic()) or b''
+		self.log.debug('Read from serial port: {:s}'.format(str(msg)))
+		return msg
 
 	def close(self) -> None:
 		"""
@@ -75,30 +202,104 @@ class MarlinSerial:
 		:rtype: None
 		"""
 		self.log.info('Closing serial port.')
-		if not self.sim:
-			self.ser.close()
+		self.ser.close()
 
 	def send_gcode(self, cmd: str) -> bytes:
 		"""
 		Sends command via serial.
 
+		In streaming mode, moves (G0/G1) return as soon as they have been handed to Marlin and an empty response
+		is returned for them. All other commands wait for their own 'ok', which Marlin only sends once all
+		previously streamed lines have been processed.
+
 		:param cmd: Command string (e.g.: 'M122')
 		:return: None
 		"""
-		if self.sim:
-			self.log.info('Sending: {:s}'.format(str(cmd)))
-		else:
-			self.log.debug('Write to serial port: {:s}'.format(str(cmd)))
+		verb = metrics.gcode_verb(cmd)
+		start = time.perf_counter()
+		try:
+			response = self.__send_gcode(cmd, verb)
+		except serial.SerialException:
+			ERRORS.labels('serial').inc()
+			raise
+		elapsed = time.perf_counter() - start
+		COMMANDS.labels(verb).inc()
+		COMMAND_SECONDS.labels(verb).observe(elapsed)
+		if verb == 'M400':
+			M400_SECONDS.observe(elapsed)
+		return response
+
+	def __send_gcode(self, cmd: str, verb: str) -> bytes:
+		if self.streaming:
+			entry = self.__stream_line(cmd)
+			if is_motion_command(cmd):
+				return b''
+			start = time.perf_counter()
+			self.__drain(until=entry)
+			OK_WAIT_SECONDS.labels(verb).observe(time.perf_counter() - start)
+			return bytes(entry.response)
+
+		self.log.debug('Write to serial port: {:s}'.format(str(cmd)))
+		with self.__write_lock:
 			self.ser.write((cmd + '\n').encode())
 			self.ser.flush()
+			self.__waiting = True
+		start = time.perf_counter()
 		response = self.__wait_cmd_completed()
+		OK_WAIT_SECONDS.labels(verb).observe(time.perf_counter() - start)
 
 		# if command is a movement command, wait for it to be completed
-		if cmd.startswith('G0') or cmd.startswith('G1'):
+		if is_motion_command(cmd):
 			self.__wait_move_completed()
 
 		return response
 
+	def send_program(self, program) -> int:
+		"""
+		Sends a G-code program command by command (see :func:`openxyz.utils.iter_gcode`). Line numbers, checksums and
+		comments of the program are dropped, the commands are numbered again in streaming mode.
+
+		:param program: Path of a G-code file or iterable of lines
+		:type program: str or Iterable[str]
+		:return: Number of commands sent
+		:rtype: int
+		:raises ValueError: If a line of the program is invalid, before it is sent
+		:raises IOError: If Marlin rejects a command
+		"""
+		count = 0
+		for command in iter_gcode(program):
+			response = self.send_gcode(str(command))
+			if UNKNOWN_CMD_MSG in response or ERROR_MSG in response:
+				raise IOError(f"Marlin rejected '{command}': {response.decode(errors='replace').strip()}")
+			count += 1
+		if self.streaming:
+			# streamed moves return before Marlin answered them
+			self.synchronize()
+		return count
+
+	def synchronize(self) -> None:
+		"""
+		Blocks until all sent commands are acknowledged and all moves are completed (M400).
+
+		:return: None
+		:rtype: None
+		:raises IOError: If Marlin rejected streamed moves since the last call
+		"""
+		self.send_gcode('M400')
+		if self.__rejected_moves:
+			rejected, self.__rejected_moves = self.__rejected_moves, []
+			raise IOError('Marlin rejected {:d} streamed moves: {:s}'.format(len(rejected), '; '.join(
+				'N{:d} {:s}: {:s}'.format(n, cmd, response.decode(errors='replace'))
+				for n, cmd, response in rejected)))
+
+	@property
+	def in_flight(self) -> int:
+		"""
+		:return: Number of streamed lines which have not been acknowledged yet
+		:rtype: int
+		"""
+		return len(self.__in_flight)
+
 	def emergency(self) -> None:
 		"""
 		Stops movement immediately but allows further commands (M410).
@@ -106,41 +307,65 @@ class MarlinSerial:
 		:return: None
 		:rtype: None
 		"""
+		self.log.critical('Emergency stop initiated.')
 		self.send_gcode('M410')
+
+	def emergency_nowait(self) -> None:
+		"""
+		Writes M410 without waiting for a response. Unlike :meth:`emergency`, this may be called from another thread
+		while a command is in progress. Marlin only executes it ahead of queued commands if EMERGENCY_PARSER is enabled.
+		The 'ok' of M410 is discarded by the thread reading the responses.
+
+		:return: None
+		:rtype: None
+		"""
 		self.log.critical('Emergency stop initiated.')
-		self.__wait_cmd_completed()
+		with self.__write_lock:
+			self.ser.write(b'M410\n')
+			self.ser.flush()
+			if self.streaming:
+				# acknowledged in order with the streamed lines
+				self.__in_flight.append(_InFlight(None, 'M410', bytearray()))
+			elif self.__waiting:
+				# Marlin answers the command in progress first
+				self.__trailing_oks += 1
+			else:
+				self.__stray_oks += 1
 
-	def __wait_cmd_completed(self, max_tries: int = 100) -> bytes:
+	def __wait_cmd_completed(self) -> bytes:
 		"""
 		Waits for a command to be completed.
 		HOST_KEEPALIVE_FEATURE has to be enabled in Marlin configuration.
 		Marlin is expected to send a 'busy' message once a second (DEFAULT_KEEPALIVE_INTERVAL 1).
 
-		:param max_tries: Maximum number of tries to receive 'ok' message.
-		:type max_tries: int
-		:return: All received messages
+		:return: All received messages up to and including 'ok', without busy messages
 		:rtype: bytes
+		:raises IOError: If Marlin is silent for longer than the timeout
 		"""
-		msg = b''
+		response = bytearray()
 		try:
-			counter = 0
 			while True:
-				res = self.ser.read()
-				if res:
-					msg += res
-				if BUSY_MSG in msg:
-					counter = 0
-					msg = b''
-				if OK_MSG in msg:
-					break
-				counter += 1
-				if counter > max_tries:
-					raise IOError('Timeout while waiting for a command to be completed: {:s}'.format(str(msg)))
+				msg = self.__read_message()
+				kind = classify_line(msg)
+				if kind == LineKind.OK and self.__take_stray_ok():
+					# answer of a command written before this one (e.g.: M410 written between two commands), with
+					# everything before it
+					response = bytearray()
+					continue
+				response += msg
+				if kind == LineKind.OK:
+					self.__finish_command(0)
+					return bytes(response)
+				if kind == LineKind.ERROR:
+					self.__count_error(msg)
 		except KeyboardInterrupt:
+			# the 'ok' of the interrupted command precedes the one of M410
+			self.__finish_command(1)
 			self.emergency()
 			raise
-
-		return msg + self.ser.read()
+		except BaseException:
+			self.__finish_command(0)
+			raise
 
 	def __wait_move_completed(self) -> None:
 		"""
@@ -149,9 +374,203 @@ class MarlinSerial:
 		:return: None
 		:rtype: None
 		"""
-		self.clear()
 		self.send_gcode('M400')
 
+	def __finish_command(self, unanswered: int) -> None:
+		# 'ok's of M410 written during the command and of an unanswered command precede the next reply
+		with self.__write_lock:
+			self.__stray_oks += self.__trailing_oks + unanswered
+			self.__trailing_oks = 0
+			self.__waiting = False
+
+	def __take_stray_ok(self) -> bool:
+		with self.__write_lock:
+			if not self.__stray_oks:
+				return False
+			self.__stray_oks -= 1
+			return True
+
+	def __notify_busy(self) -> None:
+		BUSY.inc()
+		if self.on_busy is not None:
+			self.on_busy()
+
+	def __reset_line_number(self) -> None:
+		"""
+		Resets the line number of Marlin (M110), the next streamed line is N1.
+
+		:return: None
+		:rtype: None
+		"""
+		with self.__write_lock:
+			self.ser.write(b'M110 N0\n')
+			self.ser.flush()
+			self.__waiting = True
+		self.__wait_cmd_completed()
+		self.__line_number = 0
+		self.__acknowledged = 0
+		self.__resend_from = None
+		self.__stale_resends = 0
+		self.__history.clear()
+
+	def __stream_line(self, cmd: str) -> _InFlight:
+		"""
+		Sends a command with line number and checksum as soon as a slot in the Marlin command buffer is free.
+
+		:param cmd: Command string
+		:type cmd: str
+		:return: In-flight entry of the command
+		:rtype: _InFlight
+		"""
+		while len(self.__in_flight) >= self.__window:
+			self.__process_message(self.__read_message())
+
+		self.__line_number += 1
+		self.__history[self.__line_number] = cmd
+		while len(self.__history) > 8 * self.__buffer_size:
+			self.__history.popitem(last=False)
+		entry = _InFlight(self.__line_number, cmd, bytearray())
+		self.__write_line(entry)
+		return entry
+
+	def __write_line(self, entry: _InFlight) -> None:
+		line = 'N{:d} {:s}'.format(entry.line_number, entry.cmd)
+		line = '{:s}*{:d}\n'.format(line, checksum(line))
+		self.log.debug('Write to serial port: {:s}'.format(line.strip()))
+		with self.__write_lock:
+			self.ser.write(line.encode())
+			self.__in_flight.append(entry)
+
+	def __drain(self, until: _InFlight or None = None) -> None:
+		"""
+		Processes messages of Marlin until the given entry (or every in-flight line) is acknowledged.
+
+		:param until: In-flight entry to wait for, None waits for all
+		:type until: _InFlight or None
+		:return: None
+		:rtype: None
+		"""
+		# emergency_nowait() appends to the deque from other threads, it is not iterated here
+		while self.__in_flight and (until is None or self.__acknowledged < until.line_number):
+			self.__process_message(self.__read_message())
+
+	def __read_message(self) -> bytes:
+		"""
+		Reads a complete line from Marlin. Busy messages extend the timeout.
+
+		:return: Line read from serial interface
+		:rtype: bytes
+		:raises IOError: If Marlin is silent for longer than the timeout
+		"""
+		deadline = time.monotonic() + self.timeout
+		while True:
+			msg = self.__read_line(deadline)
+			if msg is None:
+				ERRORS.labels('timeout').inc()
+				raise IOError('No message from Marlin for {:.1f} s, {:d} lines in flight: {:s}'.format(
+					self.timeout, len(self.__in_flight), str(bytes(self.__received))))
+			self.log.debug('Read from serial port: {:s}'.format(str(msg)))
+			if classify_line(msg) == LineKind.BUSY:
+				deadline = time.monotonic() + self.timeout
+				self.__notify_busy()
+				continue
+			return msg
+
+	def __read_line(self, deadline: float) -> bytes or None:
+		"""
+		Returns the next received line. Everything the port has buffered is read at once, the remaining lines are
+		returned by the next calls without reading.
+
+		:param deadline: time.monotonic() after which no more reads are started
+		:type deadline: float
+		:return: Line including the newline, None if there is no complete line before the deadline
+		:rtype: bytes or None
+		"""
+		while True:
+			end = self.__received.find(b'\n')
+			if end >= 0:
+				line = bytes(self.__received[:end + 1])
+				del self.__received[:end + 1]
+				return line
+			# blocks until the first byte arrives or the port timeout, then takes the rest of the port buffer
+			self.__received += self.ser.read(max(1, self.ser.in_waiting))
+			if b'\n' not in self.__received and time.monotonic() > deadline:
+				return None
+
+	def __process_message(self, msg: bytes) -> None:
+		"""
+		Updates the in-flight bookkeeping with a message received from Marlin.
+
+		:param msg: Line received from Marlin
+		:type msg: bytes
+		:return: None
+		:rtype: None
+		"""
+		kind = classify_line(msg)
+		if kind == LineKind.OK:
+			if self.__resend_oks:
+				self.__resend_oks -= 1
+				return
+			if not self.__in_flight:
+				return
+			entry = self.__in_flight.popleft()
+			entry.response += msg
+			if entry.line_number is not None:
+				self.__acknowledged = entry.line_number
+				if self.__resend_from is not None and entry.line_number >= self.__resend_from:
+					self.__stale_resends = 0
+			if is_motion_command(entry.cmd) and (ERROR_MSG in entry.response or UNKNOWN_CMD_MSG in entry.response):
+				# nobody waits for the response of a streamed move
+				errors = (line.strip() for line in entry.response.splitlines() if not line.startswith(b'ok'))
+				self.__rejected_moves.append((entry.line_number, entry.cmd, b' '.join(errors)))
+			# ADVANCED_OK reports the free slots of the command buffer, otherwise assume BUFSIZE
+			advanced_ok = ADVANCED_OK_PATTERN.search(msg)
+			if advanced_ok:
+				self.__window = max(1, min(self.__buffer_size, len(self.__in_flight) + int(advanced_ok.group(1))))
+			return
+
+		if kind == LineKind.RESEND:
+			line_number = int(RESEND_PATTERN.match(msg).group(1))
+			# Marlin answers the rejected line with 'ok' after the resend request
+			self.__resend_oks += 1
+			if self.__stale_resends and line_number == self.__resend_from:
+				# lines which were in flight behind the rejected one request the same resend
+				self.__stale_resends -= 1
+				return
+			self.log.warning('Marlin requested resend of line {:d}.'.format(line_number))
+			RESENDS.inc()
+			if line_number not in self.__history:
+				raise IOError('Cannot resend line {:d}, it is no longer in the history.'.format(line_number))
+			# lines from the requested one on are not in the Marlin command buffer (rejected or lost), out-of-band
+			# lines are not numbered and were accepted
+			with self.__write_lock:
+				rejected = [entry for entry in self.__in_flight
+							if entry.line_number is not None and entry.line_number >= line_number]
+				self.__in_flight = collections.deque(entry for entry in self.__in_flight if entry not in rejected)
+			self.__resend_from = line_number
+			self.__stale_resends = max(len(rejected) - 1, 0)
+			# the callers keep waiting for the same entries
+			entries = {entry.line_number: entry for entry in rejected}
+			for n in range(line_number, self.__line_number + 1):
+				self.__write_line(entries.get(n) or _InFlight(n, self.__history[n], bytearray()))
+			return
+
+		if msg.startswith(ERROR_MSG) and b'Last Line' in msg:
+			# line number / checksum errors are always followed by a resend request
+			self.log.warning('Read from serial port: {:s}'.format(str(msg)))
+			return
+
+		self.__count_error(msg)
+		if self.__in_flight:
+			self.__in_flight[0].response += msg
+
+	@staticmethod
+	def __count_error(msg: bytes) -> None:
+		if msg.startswith(ERROR_MSG):
+			ERRORS.labels('error').inc()
+		elif msg.startswith(UNKNOWN_CMD_MSG):
+			ERRORS.labels('unknown_command').inc()
+
 
 if __name__ == "__main__":
 	# Example usage
@@ -0,0 +1,288 @@
+import bisect
+import re
+import threading
+from typing import Dict, Sequence, Tuple
+
+# latency buckets in seconds, from fast serial round trips to long moves
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_VERB = re.compile(r'\s*(?:N\d+\s+)?([GMT]\d+)', re.IGNORECASE)
+
+
+def gcode_verb(gcode: str) -> str:
+	"""
+	:param gcode: G-code line (e.g.: 'G0 X1 F100')
+	:type gcode: str
+	:return: Command of the line (e.g.: 'G0'), 'other' if there is none (bounds the number of label values)
+	:rtype: str
+	"""
+	match = _VERB.match(gcode)
+	return match.group(1).upper() if match else 'other'
+
+
+class Counter:
+	"""
+	Monotonic counter, optionally split by labels.
+
+	:param name: Metric name (e.g.: 'openxyz_serial_busy_total')
+	:type name: str
+	:param documentation: Help text
+	:type documentation: str
+	:param labels: Label names
+	:type labels: Sequence[str], optional
+	"""
+
+	type = 'counter'
+
+	def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+		self.name = name
+		self.documentation = documentation
+		self.label_names = tuple(labels)
+		self._lock = threading.Lock()
+		self._values = {}
+
+	def labels(self, *values) -> '_Child':
+		"""
+		:param values: Label values, in the order of the label names
+		:return: Counter of the label values
+		"""
+		return _Child(self, tuple(str(v) for v in values))
+
+	def inc(self, amount: float = 1.0, key: Tuple[str, ...] = ()) -> None:
+		"""
+		Increments the counter (of the label values key).
+
+		:param amount: Increment
+		:type amount: float, optional
+		:return: None
+		:rtype: None
+		"""
+		with self._lock:
+			self._values[key] = self._values.get(key, 0.0) + amount
+
+	def reset(self) -> None:
+		with self._lock:
+			self._values.clear()
+
+	def samples(self) -> list:
+		"""
+		:return: {'labels': {...}, 'value': ...} of every label combination
+		:rtype: list
+		"""
+		with self._lock:
+			values = dict(self._values)
+		return [{"labels": dict(zip(self.label_names, key)), "value": value} for key, value in sorted(values.items())]
+
+	def exposition(self) -> list:
+		lines = []
+		for sample in self.samples():
+			lines.append(f"{self.name}{_format_labels(sample['labels'])} {_format_value(sample['value'])}")
+		return lines
+
+
+class Histogram(Counter):
+	"""
+	Distribution of observed values (e.g.: latencies) in fixed buckets, optionally split by labels.
+
+	:param name: Metric name (e.g.: 'openxyz_serial_ok_wait_seconds')
+	:type name: str
+	:param documentation: Help text
+	:type documentation: str
+	:param labels: Label names
+	:type labels: Sequence[str], optional
+	:param buckets: Increasing upper bounds of the buckets
+	:type buckets: Sequence[float], optional
+	"""
+
+	type = 'histogram'
+
+	def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+		super().__init__(name, documentation, labels)
+		self.buckets = tuple(float(b) for b in buckets)
+
+	def inc(self, amount: float = 1.0, key: Tuple[str, ...] = ()) -> None:
+		raise TypeError(f"{self.name} is a histogram, use observe()")
+
+	def observe(self, value: float, key: Tuple[str, ...] = ()) -> None:
+		"""
+		Records a value (of the label values key).
+
+		:param value: Observed value
+		:type value: float
+		:return: None
+		:rtype: None
+		"""
+		index = bisect.bisect_left(self.buckets, value)
+		with self._lock:
+			state = self._values.get(key)
+			if state is None:
+				# count per bucket (last: above all buckets), sum
+				state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+			state[0][index] += 1
+			state[1] += value
+
+	def samples(self) -> list:
+		"""
+		:return: {'labels': {...}, 'count': ..., 'sum': ..., 'buckets': {upper bound: cumulative count}} of every label
+			combination
+		:rtype: list
+		"""
+		with self._lock:
+			values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+		samples = []
+		for key, (counts, total) in sorted(values.items()):
+			cumulative, buckets = 0, {}
+			for bound, count in zip(self.buckets, counts):
+				cumulative += count
+				buckets[bound] = cumulative
+			samples.append({"labels": dict(zip(self.label_names, key)), "count": sum(counts), "sum": total,
+							"buckets": buckets})
+		return samples
+
+	def exposition(self) -> list:
+		lines = []
+		for sample in self.samples():
+			labels = sample['labels']
+			for bound, count in sample['buckets'].items():
+				lines.append(f"{self.name}_bucket{_format_labels(labels, le=_format_value(bound))} {count}")
+			lines.append(f"{self.name}_bucket{_format_labels(labels, le='+Inf')} {sample['count']}")
+			lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(sample['sum'])}")
+			lines.append(f"{self.name}_count{_format_labels(labels)} {sample['count']}")
+		return lines
+
+
+class _Child:
+	"""
+	Counter or histogram of fixed label values.
+	"""
+	__slots__ = ('_metric', '_key')
+
+	def __init__(self, metric: Counter, key: Tuple[str, ...]):
+		if len(key) != len(metric.label_names):
+			raise ValueError(f"{metric.name} has labels {metric.label_names}, got {key}")
+		self._metric = metric
+		self._key = key
+
+	def inc(self, amount: float = 1.0) -> None:
+		self._metric.inc(amount, self._key)
+
+	def observe(self, value: float) -> None:
+		self._metric.observe(value, self._key)
+
+
+class Registry:
+	"""
+	Collection of metrics, exported as Prometheus text or as snapshot.
+	"""
+
+	def __init__(self):
+		self.__lock = threading.Lock()
+		self.__metrics: Dict[str, Counter] = {}
+
+	def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+		"""
+		Returns the counter of a name, created on the first call.
+
+		:return: Counter
+		:rtype: Counter
+		"""
+		return self.__register(Counter, name, documentation, labels)
+
+	def histogram(self, name: str, documentation: str, labels: Sequence[str] = (),
+				  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+		"""
+		Returns the histogram of a name, created on the first call.
+
+		:return: Histogram
+		:rtype: Histogram
+		"""
+		return self.__register(Histogram, name, documentation, labels, buckets)
+
+	def snapshot(self) -> dict:
+		"""
+		:return: Current values of all metrics by name: {'type': ..., 'help': ..., 'samples': [...]}, see
+			:meth:`Counter.samples` and :meth:`Histogram.samples`
+		:rtype: dict
+		"""
+		with self.__lock:
+			metrics = list(self.__metrics.values())
+		return {m.name: {"type": m.type, "help": m.documentation, "samples": m.samples()} for m in metrics}
+
+	def exposition(self) -> str:
+		"""
+		:return: All metrics in the Prometheus text format (version 0.0.4)
+		:rtype: str
+		"""
+		with self.__lock:
+			metrics = list(self.__metrics.values())
+		lines = []
+		for metric in metrics:
+			lines.append(f"# HELP {metric.name} {metric.documentation}")
+			lines.append(f"# TYPE {metric.name} {metric.type}")
+			lines.extend(metric.exposition())
+		return '\n'.join(lines) + '\n'
+
+	def reset(self) -> None:
+		"""
+		Sets all metrics back to zero.
+
+		:return: None
+		:rtype: None
+		"""
+		with self.__lock:
+			metrics = list(self.__metrics.values())
+		for metric in metrics:
+			metric.reset()
+
+	def __register(self, cls, name: str, documentation: str, labels: Sequence[str], *args) -> Counter:
+		with self.__lock:
+			metric = self.__metrics.get(name)
+			if metric is None:
+				metric = self.__metrics[name] = cls(name, documentation, labels, *args)
+			elif type(metric) is not cls or metric.label_names != tuple(labels):
+				raise ValueError(f"Metric {name} is already registered as {metric.type} with labels {metric.label_names}")
+			return metric
+
+
+# metrics of this process (bridge or client)
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+	"""
+	Returns a counter of the process registry, see :meth:`Registry.counter`.
+	"""
+	return REGISTRY.counter(name, documentation, labels)
+
+
+def histogram(name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+	"""
+	Returns a histogram of the process registry, see :meth:`Registry.histogram`.
+	"""
+	return REGISTRY.histogram(name, documentation, labels, buckets)
+
+
+def snapshot() -> dict:
+	"""
+	Returns the current values of all metrics of this process, see :meth:`Registry.snapshot`.
+	"""
+	return REGISTRY.snapshot()
+
+
+def exposition() -> str:
+	"""
+	Returns all metrics of this process in the Prometheus text format, see :meth:`Registry.exposition`.
+	"""
+	return REGISTRY.exposition()
+
+
+def _format_labels(labels: dict, **extra) -> str:
+	labels = dict(labels, **extra)
+	if not labels:
+		return ''
+	escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in labels.values())
+	return '{' + ','.join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + '}'
+
+
+def _format_value(value: float) -> str:
+	return repr(float(value)) if value != int(value) else str(int(value))
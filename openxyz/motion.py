@@ -0,0 +1,257 @@
+from __future__ import annotations
+
+import re
+from typing import TYPE_CHECKING, Sequence
+
+if TYPE_CHECKING:
+	import numpy as np
+
+# defaults of documentation/marlin/Configuration.h and Configuration_adv.h
+DEFAULT_MAX_FEEDRATE = (5.0, 5.0, 5.0)  # mm/s
+DEFAULT_MAX_ACCELERATION = (1.0, 1.0, 1.0)  # mm/s^2
+DEFAULT_TRAVEL_ACCELERATION = 1.0  # mm/s^2
+JUNCTION_DEVIATION_MM = 0.013
+BLOCK_BUFFER_SIZE = 16
+MINIMUM_PLANNER_SPEED = 0.05  # mm/s
+
+_DEFINE_PATTERN = re.compile(r'^\s*#define\s+(\w+)\s+(\{[^}]*\}|[-+\d.]+)', re.MULTILINE)
+_SETTING_PATTERN = re.compile(r'\b(M20[1345])((?:[ \t]+[A-FH-LN-Z]-?\d*\.?\d+)+)')
+
+
+class MotionModel:
+	"""
+	Estimates move durations like the Marlin planner executes them.
+
+	Every move is a trapezoid: accelerate to the nominal speed, cruise, decelerate, or a triangle if the move is too
+	short to reach the nominal speed. The nominal speed of a move is the commanded feed rate limited by the maximum
+	feed rate of every axis (M203), its acceleration is the travel acceleration (M204 T) limited by the maximum
+	acceleration of every axis (M201). Consecutive moves are joined at the speed allowed by the junction deviation
+	(M205 J), including the arc estimation of JD_HANDLE_SMALL_SEGMENTS, and the planner can only look ahead
+	``lookahead`` moves (BLOCK_BUFFER_SIZE), since it always has to be able to stop at the end of its buffer.
+
+	All computations are vectorized over the moves of a path, so estimating 100k moves takes milliseconds.
+
+	:param max_feedrate: Maximum x, y, z feed rates in mm/s (M203)
+	:type max_feedrate: Sequence[float], optional
+	:param max_acceleration: Maximum x, y, z accelerations in mm/s^2 (M201)
+	:type max_acceleration: Sequence[float], optional
+	:param acceleration: Travel acceleration in mm/s^2 (M204 T)
+	:type acceleration: float, optional
+	:param junction_deviation: Junction deviation in mm (M205 J)
+	:type junction_deviation: float, optional
+	:param lookahead: Number of moves the planner buffers (BLOCK_BUFFER_SIZE)
+	:type lookahead: int, optional
+	"""
+
+	def __init__(self, max_feedrate: Sequence[float] = DEFAULT_MAX_FEEDRATE,
+				 max_acceleration: Sequence[float] = DEFAULT_MAX_ACCELERATION,
+				 acceleration: float = DEFAULT_TRAVEL_ACCELERATION, junction_deviation: float = JUNCTION_DEVIATION_MM,
+				 lookahead: int = BLOCK_BUFFER_SIZE):
+		self.max_feedrate = tuple(float(v) for v in max_feedrate)
+		self.max_acceleration = tuple(float(v) for v in max_acceleration)
+		self.acceleration = float(acceleration)
+		self.junction_deviation = float(junction_deviation)
+		self.lookahead = int(lookahead)
+
+	def __repr__(self):
+		return (f"MotionModel(max_feedrate={self.max_feedrate}, max_acceleration={self.max_acceleration}, "
+				f"acceleration={self.acceleration}, junction_deviation={self.junction_deviation}, "
+				f"lookahead={self.lookahead})")
+
+	@classmethod
+	def from_configuration(cls, configuration: str, configuration_adv: str = None) -> 'MotionModel':
+		"""
+		Creates the model from Marlin configuration files (e.g.: documentation/marlin/Configuration.h).
+
+		:param configuration: Path of Configuration.h
+		:type configuration: str
+		:param configuration_adv: Path of Configuration_adv.h, for BLOCK_BUFFER_SIZE
+		:type configuration_adv: str, optional
+		:return: Motion model
+		:rtype: MotionModel
+		"""
+		defines = {}
+		for filename in filter(None, (configuration, configuration_adv)):
+			with open(filename, 'r') as f:
+				# the last definition wins, which is the #else branch of conditional definitions
+				defines.update(_DEFINE_PATTERN.findall(f.read()))
+
+		def values(name: str, default):
+			if name not in defines:
+				return default
+			numbers = [float(v) for v in defines[name].strip('{}').split(',') if v.strip()]
+			return tuple(numbers[:3]) if isinstance(default, tuple) else numbers[0]
+
+		return cls(
+			max_feedrate=values('DEFAULT_MAX_FEEDRATE', DEFAULT_MAX_FEEDRATE),
+			max_acceleration=values('DEFAULT_MAX_ACCELERATION', DEFAULT_MAX_ACCELERATION),
+			acceleration=values('DEFAULT_TRAVEL_ACCELERATION', DEFAULT_TRAVEL_ACCELERATION),
+			junction_deviation=values('JUNCTION_DEVIATION_MM', JUNCTION_DEVIATION_MM),
+			lookahead=int(values('BLOCK_BUFFER_SIZE', BLOCK_BUFFER_SIZE)),
+		)
+
+	@classmethod
+	def from_m503(cls, response: str) -> 'MotionModel':
+		"""
+		Creates the model from the settings reported by M503.
+
+		:param response: Response of Marlin to M503
+		:type response: str
+		:return: Motion model
+		:rtype: MotionModel
+		"""
+		model = cls()
+		model.update(response)
+		return model
+
+	def update(self, gcode: str) -> None:
+		"""
+		Applies the M201, M203, M204 and M205 settings contained in G-code or in a response of Marlin (e.g.: M503).
+
+		:param gcode: G-code commands or response (e.g.: 'M203 X300 Y300 Z300')
+		:type gcode: str
+		:return: None
+		:rtype: None
+		"""
+		for command, arguments in _SETTING_PATTERN.findall(gcode):
+			words = dict((word[0], float(word[1:])) for word in arguments.split())
+			if command == 'M201':
+				self.max_acceleration = tuple(words.get(a, v) for a, v in zip('XYZ', self.max_acceleration))
+			elif command == 'M203':
+				self.max_feedrate = tuple(words.get(a, v) for a, v in zip('XYZ', self.max_feedrate))
+			elif command == 'M204':
+				# S sets printing and travel acceleration
+				self.acceleration = words.get('T', words.get('S', self.acceleration))
+			elif command == 'M205':
+				self.junction_deviation = words.get('J', self.junction_deviation)
+
+	def segment_times(self, coordinates: Sequence, feedrate: float or Sequence = None, start=None,
+					  stop: bool = False) -> np.ndarray:
+		"""
+		Estimates the duration of every move of a path.
+
+		:param coordinates: Coordinates (x, y) or (x, y, z) in path order
+		:type coordinates: Sequence
+		:param feedrate: Commanded feed rate in mm/min (G-code F), None for the maximum feed rates, or the feed rate of
+			every coordinate (e.g.: the 'f' field of :func:`openxyz.utils.read_moves`, NaN for the maximum feed rates)
+		:type feedrate: float or Sequence[float], optional
+		:param start: Position the path starts from, the first move goes to coordinates[0] if given
+		:param stop: Come to a stop at every coordinate (e.g.: for measurements) instead of blending moves
+		:type stop: bool, optional
+		:return: Duration in seconds of every move, len(coordinates) - 1 moves (len(coordinates) if start is given)
+		:rtype: np.ndarray
+		"""
+		# NumPy is only loaded by estimates, so the settings of the model are cheap to import and follow
+		import numpy as np
+
+		points = _as_array(coordinates)
+		if start is not None and len(points):
+			points = np.vstack([_as_array([start]), points])
+		if len(points) < 2:
+			return np.zeros(0)
+
+		delta = np.diff(points, axis=0)
+		length = np.sqrt((delta ** 2).sum(axis=1))
+		moving = length > 0
+		# zero length moves are dropped by the planner
+		delta, length = delta[moving], length[moving]
+		times = np.zeros(len(moving))
+		if not len(length):
+			return times
+		unit = delta / length[:, None]
+		share = np.abs(unit)
+
+		with np.errstate(divide='ignore'):
+			speed = np.min(np.asarray(self.max_feedrate) / share, axis=1)
+			accel = np.min(np.asarray(self.max_acceleration) / share, axis=1)
+		if feedrate is not None and np.ndim(feedrate):
+			# feed rate of every coordinate, the move to a coordinate runs at its feed rate
+			feedrate = np.asarray(feedrate, dtype=np.float64)[len(feedrate) - len(moving):][moving]
+			speed = np.where(feedrate > 0, np.minimum(speed, feedrate / 60.0), speed)
+		elif feedrate:
+			speed = np.minimum(speed, feedrate / 60.0)
+		accel = np.minimum(accel, self.acceleration)
+
+		n = len(length)
+		# squared speed limit at every junction, the first and the last junction are at rest
+		limit = np.zeros(n + 1)
+		if not stop and n > 1:
+			limit[1:-1] = self.__junction_limits(unit, length, speed, accel)
+		gain = 2.0 * accel * length
+		reach = np.concatenate([[0.0], np.cumsum(gain)])
+		if not stop:
+			# the planner has to be able to stop at the end of its buffer
+			horizon = np.minimum(np.arange(n + 1) + self.lookahead, n)
+			limit = np.minimum(limit, reach[horizon] - reach)
+
+		# backward pass: decelerate in time for every junction limit, forward pass: acceleration from the previous one
+		entry = np.minimum.accumulate((limit + reach)[::-1])[::-1] - reach
+		entry = np.minimum.accumulate(entry - reach) + reach
+		entry = np.maximum(entry, 0.0)
+
+		times[moving] = _trapezoid_times(length, speed, accel, entry[:-1], entry[1:])
+		return times
+
+	def estimate(self, coordinates: Sequence, feedrate: float or Sequence = None, start=None, stop: bool = False) -> float:
+		"""
+		Estimates the duration of a path, see :meth:`segment_times`.
+
+		:return: Duration in seconds
+		:rtype: float
+		"""
+		return float(self.segment_times(coordinates, feedrate=feedrate, start=start, stop=stop).sum())
+
+	def __junction_limits(self, unit: np.ndarray, length: np.ndarray, speed: np.ndarray, accel: np.ndarray) -> np.ndarray:
+		import numpy as np
+
+		previous, current = unit[:-1], unit[1:]
+		cos_theta = np.clip(-(previous * current).sum(axis=1), -0.999999, 1.0)
+		# acceleration of the junction, limited by the axes the direction change happens on
+		junction = current - previous
+		norm = np.sqrt((junction ** 2).sum(axis=1))
+		with np.errstate(divide='ignore', invalid='ignore'):
+			junction_share = np.abs(junction) / norm[:, None]
+			junction_accel = np.min(np.asarray(self.max_acceleration) / junction_share, axis=1)
+		junction_accel = np.minimum(np.where(norm > 0, junction_accel, np.inf), accel[1:])
+
+		sin_theta_d2 = np.sqrt(0.5 * (1.0 - cos_theta))
+		with np.errstate(divide='ignore'):
+			limit = junction_accel * self.junction_deviation * sin_theta_d2 / (1.0 - sin_theta_d2)
+		# JD_HANDLE_SMALL_SEGMENTS: short moves with small direction changes approximate an arc
+		theta = np.maximum(np.arccos(np.clip(-cos_theta, -1.0, 1.0)), 0.033)
+		small = (length[1:] < 1.0) & (cos_theta < -0.7071067812)
+		limit = np.where(small, np.minimum(limit, length[1:] * junction_accel / theta), limit)
+		# reversals
+		limit = np.where(cos_theta > 0.999999, MINIMUM_PLANNER_SPEED ** 2, limit)
+		return np.minimum(limit, np.minimum(speed[:-1], speed[1:]) ** 2)
+
+
+def _as_array(coordinates: Sequence) -> np.ndarray:
+	import numpy as np
+
+	if isinstance(coordinates, np.ndarray):
+		points = coordinates.astype(np.float64)
+	else:
+		points = np.array([[float(value) for value in coordinate] for coordinate in coordinates], dtype=np.float64)
+	if not len(points):
+		return np.zeros((0, 3))
+	if points.ndim != 2 or points.shape[1] not in (2, 3):
+		raise ValueError("Coordinates must be (x, y) or (x, y, z) tuples")
+	if points.shape[1] == 2:
+		points = np.column_stack([points, np.zeros(len(points))])
+	return points
+
+
+def _trapezoid_times(length: np.ndarray, speed: np.ndarray, accel: np.ndarray, entry_sqr: np.ndarray,
+					 exit_sqr: np.ndarray) -> np.ndarray:
+	import numpy as np
+
+	v0, v1 = np.sqrt(entry_sqr), np.sqrt(exit_sqr)
+	accelerating = (speed ** 2 - entry_sqr) / (2.0 * accel)
+	decelerating = (speed ** 2 - exit_sqr) / (2.0 * accel)
+	cruising = length - accelerating - decelerating
+	trapezoid = (speed - v0) / accel + (speed - v1) / accel + np.maximum(cruising, 0.0) / speed
+	# too short to reach the nominal speed
+	peak = np.sqrt(np.maximum(accel * length + 0.5 * (entry_sqr + exit_sqr), 0.0))
+	triangle = np.maximum(peak - v0, 0.0) / accel + np.maximum(peak - v1, 0.0) / accel
+	return np.where(cruising >= 0, trapezoid, triangle)
@@ -0,0 +1,258 @@
+import collections
+import re
+import time
+from typing import Sequence
+
+import numpy as np
+
+from openxyz.motion import DEFAULT_MAX_FEEDRATE, _as_array
+from openxyz.spatial import GridIndex
+
+
+def parse_max_feedrates(response: str) -> tuple[float, float, float]:
+	"""
+	Parses the maximum feed rates reported by M203 (or the M203 line of M503).
+
+	:param response: Response of Marlin (e.g.: 'echo:  M203 X5.00 Y5.00 Z5.00')
+	:type response: str
+	:return: Maximum x, y, z feed rates in mm/s
+	:rtype: tuple[float, float, float]
+	:raises ValueError: If the response contains no M203 line
+	"""
+	match = re.search(r'M203((?:\s+[XYZE]-?\d*\.?\d+)+)', response)
+	if not match:
+		raise ValueError(f"No M203 settings found in '{response}'")
+	words = dict((word[0], float(word[1:])) for word in match.group(1).split())
+	return tuple(words.get(axis, default) for axis, default in zip('XYZ', DEFAULT_MAX_FEEDRATE))
+
+
+def _speeds(max_feedrates: Sequence[float], feedrate: float or None) -> tuple[np.ndarray, float]:
+	speeds = np.asarray(max_feedrates, dtype=np.float64)
+	if speeds.shape != (3,) or (speeds <= 0).any():
+		raise ValueError("max_feedrates must hold three positive feed rates (mm/s)")
+	# G-code feed rates are mm/min
+	nominal = feedrate / 60.0 if feedrate else np.inf
+	return speeds, nominal
+
+
+def travel_times(coordinates: Sequence, max_feedrates: Sequence[float] = DEFAULT_MAX_FEEDRATE,
+				 feedrate: float = None) -> np.ndarray:
+	"""
+	Estimates the duration of every move along a path, ignoring acceleration.
+
+	A linear move takes as long as its slowest axis needs at that axis' maximum feed rate (M203), or as long as the
+	whole distance needs at the commanded feed rate, whichever is longer.
+
+	:param coordinates: Coordinates in path order
+	:type coordinates: Sequence
+	:param max_feedrates: Maximum x, y, z feed rates in mm/s
+	:type max_feedrates: Sequence[float], optional
+	:param feedrate: Commanded feed rate in mm/min (G-code F), None for no limit
+	:type feedrate: float, optional
+	:return: Duration of each of the len(coordinates) - 1 moves in seconds
+	:rtype: np.ndarray
+	"""
+	points = _as_array(coordinates)
+	speeds, nominal = _speeds(max_feedrates, feedrate)
+	delta = np.abs(np.diff(points, axis=0))
+	times = (delta / speeds).max(axis=1)
+	if np.isfinite(nominal):
+		times = np.maximum(times, np.sqrt((delta ** 2).sum(axis=1)) / nominal)
+	return times
+
+
+def travel_time(coordinates: Sequence, max_feedrates: Sequence[float] = DEFAULT_MAX_FEEDRATE,
+				feedrate: float = None) -> float:
+	"""
+	Estimates the total travel duration of a path, see :func:`travel_times`.
+
+	:return: Duration in seconds
+	:rtype: float
+	"""
+	return float(travel_times(coordinates, max_feedrates, feedrate).sum())
+
+
+def optimize_order(coordinates: Sequence, max_feedrates: Sequence[float] = DEFAULT_MAX_FEEDRATE,
+				   feedrate: float = None, start: int = 0, neighbours: int = 8, time_limit: float = 10.0) -> np.ndarray:
+	"""
+	Finds a visiting order of the coordinates which minimizes the estimated travel time (see :func:`travel_times`).
+
+	A nearest neighbour path is improved with 2-opt moves, restricted to the nearest neighbours of every point. The
+	nearest neighbours are searched in coordinates scaled by the per-axis feed rates, so a slow axis is treated as
+	a long distance. The original order is kept as starting point if it is already better (e.g.: raster paths).
+
+	:param coordinates: Coordinates (x, y) or (x, y, z)
+	:type coordinates: Sequence
+	:param max_feedrates: Maximum x, y, z feed rates in mm/s (see :func:`parse_max_feedrates`)
+	:type max_feedrates: Sequence[float], optional
+	:param feedrate: Commanded feed rate in mm/min (G-code F), None for no limit
+	:type feedrate: float, optional
+	:param start: Index of the coordinate the path has to start at
+	:type start: int, optional
+	:param neighbours: Number of nearest neighbours considered per point
+	:type neighbours: int, optional
+	:param time_limit: Maximum time spent on 2-opt improvements in seconds
+	:type time_limit: float, optional
+	:return: Permutation of range(len(coordinates)) starting with start
+	:rtype: np.ndarray
+	"""
+	points = _as_array(coordinates)
+	n = len(points)
+	if n < 3:
+		order = np.arange(n)
+		if n == 2 and start == 1:
+			order = order[::-1].copy()
+		return order
+	if not 0 <= start < n:
+		raise ValueError(f"Start index {start} out of range")
+	speeds, nominal = _speeds(max_feedrates, feedrate)
+	deadline = time.monotonic() + time_limit
+
+	# in scaled coordinates, the chebyshev distance is a lower bound of the travel time
+	grid = GridIndex(points[:, :2] / speeds[:2])
+	nearest = grid.neighbours(neighbours)
+
+	order = _nearest_neighbour(points, grid, nearest, speeds, nominal, start)
+	original = np.arange(n)
+	if original[0] == start and travel_time(points[original], speeds, feedrate) <= travel_time(points[order], speeds, feedrate):
+		order = original
+	order = _two_opt(points, order, nearest, speeds, nominal, deadline)
+
+	assert len(order) == n and np.array_equal(np.sort(order), np.arange(n)), "Optimized order is no permutation"
+	return order
+
+
+def optimize_path(coordinates: Sequence, max_feedrates: Sequence[float] = DEFAULT_MAX_FEEDRATE,
+				  feedrate: float = None, start: int = 0, neighbours: int = 8, time_limit: float = 10.0) -> list:
+	"""
+	Reorders coordinates to minimize the estimated travel time, see :func:`optimize_order`.
+	The set of coordinates is not changed, the coordinate objects themselves are returned.
+
+	:return: Reordered coordinates
+	:rtype: list
+	"""
+	coordinates = list(getattr(coordinates, 'coordinates', coordinates))
+	order = optimize_order(coordinates, max_feedrates, feedrate, start, neighbours, time_limit)
+	return [coordinates[i] for i in order]
+
+
+def _times_from(points: np.ndarray, indices: np.ndarray, origin: int, speeds: np.ndarray, nominal: float) -> np.ndarray:
+	delta = np.abs(points[indices] - points[origin])
+	times = (delta / speeds).max(axis=1)
+	if np.isfinite(nominal):
+		times = np.maximum(times, np.sqrt((delta ** 2).sum(axis=1)) / nominal)
+	return times
+
+
+def _nearest_neighbour(points: np.ndarray, grid: GridIndex, nearest: np.ndarray, speeds: np.ndarray,
+					   nominal: float, start: int, max_rings: int = 6) -> np.ndarray:
+	n = len(points)
+	visited = np.zeros(n, dtype=bool)
+	order = np.empty(n, dtype=np.int64)
+	neighbour_lists = nearest.tolist()
+	remaining = np.arange(n)
+	current = start
+	for step in range(n):
+		order[step] = current
+		visited[current] = True
+		if step == n - 1:
+			break
+		# the neighbour list is sorted, the first unvisited entry is the closest remaining point
+		following = -1
+		for candidate in neighbour_lists[current]:
+			if candidate >= 0 and not visited[candidate]:
+				following = candidate
+				break
+		if following >= 0:
+			current = following
+			continue
+
+		# all neighbours visited, search the surrounding cells ring by ring
+		cx, cy = grid.cells_of(grid.points[current])
+		best_time = np.inf
+		for r in range(min(grid.max_ring(cx, cy), max_rings) + 1):
+			found = grid.ring(cx, cy, r)
+			found = found[~visited[found]]
+			if len(found):
+				times = _times_from(points, found, current, speeds, nominal)
+				best = np.argmin(times)
+				if times[best] < best_time:
+					best_time, following = times[best], found[best]
+			# points beyond ring r are at least r cells away
+			if best_time <= r * grid.cell_size:
+				break
+		else:
+			remaining = remaining[~visited[remaining]]
+			following = remaining[np.argmin(_times_from(points, remaining, current, speeds, nominal))]
+		current = following
+	return order
+
+
+def _two_opt(points: np.ndarray, order: np.ndarray, nearest: np.ndarray, speeds: np.ndarray, nominal: float,
+			 deadline: float) -> np.ndarray:
+	n = len(order)
+	tour = order.copy()
+	pos = np.empty(n, dtype=np.int64)
+	pos[tour] = np.arange(n)
+	xs, ys, zs = (points[:, axis].tolist() for axis in range(3))
+	vx, vy, vz = speeds.tolist()
+	neighbour_lists = nearest.tolist()
+	limited = bool(np.isfinite(nominal))
+
+	def cost(a: int, b: int) -> float:
+		dx, dy, dz = abs(xs[a] - xs[b]), abs(ys[a] - ys[b]), abs(zs[a] - zs[b])
+		t = max(dx / vx, dy / vy, dz / vz)
+		if limited:
+			t = max(t, (dx * dx + dy * dy + dz * dz) ** 0.5 / nominal)
+		return t
+
+	def gain(p: int, q: int) -> float:
+		# reversing tour[p + 1:q + 1] replaces the edges (p, p + 1) and (q, q + 1)
+		a, b, c = tour[p], tour[p + 1], tour[q]
+		delta = cost(a, b) - cost(a, c)
+		if q + 1 < n:
+			d = tour[q + 1]
+			delta += cost(c, d) - cost(b, d)
+		return delta
+
+	queue = collections.deque(tour.tolist())
+	queued = np.ones(n, dtype=bool)
+	checks = 0
+	while queue:
+		checks += 1
+		if checks % 256 == 0 and time.monotonic() > deadline:
+			break
+		a = queue.popleft()
+		queued[a] = False
+		i = int(pos[a])
+		succ_cost = cost(a, tour[i + 1]) if i + 1 < n else 0.0
+		pred_cost = cost(tour[i - 1], a) if i > 0 else 0.0
+		for c in neighbour_lists[a]:
+			if c < 0:
+				break
+			ac = cost(a, c)
+			if ac >= succ_cost and ac >= pred_cost:
+				break
+			j = int(pos[c])
+			moves = ((min(i, j), max(i, j)),)
+			if i > 0 and j > 0:
+				moves += ((min(i, j) - 1, max(i, j) - 1),)
+			applied = False
+			for p, q in moves:
+				if q - p < 2 or gain(p, q) <= 1e-12:
+					continue
+				touched = (tour[p], tour[p + 1], tour[q], tour[q + 1] if q + 1 < n else tour[q])
+				tour[p + 1:q + 1] = tour[p + 1:q + 1][::-1].copy()
+				pos[tour[p + 1:q + 1]] = np.arange(p + 1, q + 1)
+				for city in touched:
+					if not queued[city]:
+						queued[city] = True
+						queue.append(int(city))
+				applied = True
+				break
+			if applied:
+				if not queued[a]:
+					queued[a] = True
+					queue.appendleft(a)
+				break
+	return tour
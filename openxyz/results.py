@@ -0,0 +1,368 @@
+import hashlib
+import logging
+import mmap
+import os
+import pickle
+from typing import Any, Iterator, Sequence
+
+import numpy as np
+
+from openxyz.spatial import GridIndex
+from openxyz.store import MAGIC, ScanStore
+
+INDEX_SUFFIX = '.index.npz'
+# records whose first and last bytes are compared to check that an index still matches its pickle stream
+INDEX_SAMPLES = 64
+REDUCERS = ('mean', 'sum', 'max', 'min', 'count', 'first', 'last')
+
+
+class ScanResults:
+	"""
+	Random access to the results of a scan, without loading the whole file.
+
+	Reads pickle streams of (coordinate, data) tuples (written by :class:`openxyz.scan.PickleSink` or the examples)
+	and :class:`openxyz.store.ScanStore` files. For pickle streams, the byte offset and the coordinate of every
+	record are indexed once and kept in a sidecar file (filename + INDEX_SUFFIX); if the stream grew since (e.g.: a
+	running scan), only the new records are indexed. If it was rewritten (the indexed records do not match anymore),
+	the index is rebuilt. A truncated last record is ignored.
+
+	Points are loaded on access only: pickle records are unpickled from a memory map of the file, store columns are
+	memory-mapped arrays.
+
+	:param filename: Path of the result file
+	:type filename: str
+	:param sidecar: Load and save the index of pickle streams as sidecar file
+	:type sidecar: bool, optional
+	"""
+
+	def __init__(self, filename: str, sidecar: bool = True):
+		self._log = logging.getLogger(__name__)
+		self.filename = filename
+		self.__store = None
+		self.__file = None
+		self.__mmap = None
+		self.__grid = None
+		with open(filename, 'rb') as f:
+			is_store = f.read(len(MAGIC)) == MAGIC
+		if is_store:
+			self.__store = ScanStore(filename, 'r')
+			self.__coordinates = np.asarray(self.__store.coordinates, dtype=np.float64)
+			return
+
+		self.__file = open(filename, 'rb')
+		size = os.fstat(self.__file.fileno()).st_size
+		if size:
+			self.__mmap = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+		offsets, coordinates = self.__load_index(size) if sidecar else (np.zeros(1, dtype=np.int64), [])
+		offsets, coordinates = self.__extend_index(offsets, coordinates, size)
+		self.__offsets = offsets
+		self.__coordinates = _coordinate_array(coordinates)
+		if sidecar:
+			self.__save_index(size)
+
+	@property
+	def format(self) -> str:
+		"""
+		:return: 'store' or 'pickle'
+		:rtype: str
+		"""
+		return 'store' if self.__store is not None else 'pickle'
+
+	@property
+	def coordinates(self) -> np.ndarray:
+		"""
+		:return: (n, 2) or (n, 3) coordinates of all points
+		:rtype: np.ndarray
+		"""
+		return self.__coordinates
+
+	def __len__(self) -> int:
+		return len(self.__coordinates)
+
+	def __getitem__(self, index: int) -> tuple:
+		"""
+		:return: (coordinate, data) of a point
+		:rtype: tuple
+		"""
+		if index < 0:
+			index += len(self)
+		if not 0 <= index < len(self):
+			raise IndexError(f"Point {index} out of range")
+		if self.__store is not None:
+			return self.__store[index]
+		return pickle.loads(self.__mmap[self.__offsets[index]:self.__offsets[index + 1]])
+
+	def __iter__(self) -> Iterator[tuple]:
+		for index in range(len(self)):
+			yield self[index]
+
+	def data(self, index: int) -> Any:
+		"""
+		:return: Measurement data of a point
+		:rtype: Any
+		"""
+		return self[index][1]
+
+	def column(self, name: str) -> np.ndarray or list:
+		"""
+		Returns one value of the data of every point: a column of a store (memory-mapped), the value of key name of
+		dict data, or all data of a pickle stream (name 'data').
+
+		:param name: Name of the column
+		:type name: str
+		:return: Array of the values if possible, list otherwise
+		:rtype: np.ndarray or list
+		"""
+		if self.__store is not None:
+			return self.__store.column(name)
+		values = [data if name == 'data' and not isinstance(data, dict) else data[name] for _, data in self]
+		try:
+			array = np.asarray(values)
+		except ValueError:
+			return values
+		return array if values and array.dtype.kind in 'biufc' else values
+
+	def nearest(self, point: Sequence, k: int = 1) -> np.ndarray:
+		"""
+		Finds the points closest to an x, y location (the spatial index is built on the first call).
+
+		:param point: x, y location
+		:type point: Sequence
+		:param k: Number of points
+		:type k: int, optional
+		:return: Indices of the nearest points, closest first
+		:rtype: np.ndarray
+		"""
+		if self.__grid is None:
+			self.__grid = GridIndex(self.__coordinates[:, :2])
+		return self.__grid.nearest([float(v) for v in point[:2]], k)
+
+	def at(self, point: Sequence) -> tuple:
+		"""
+		:return: (coordinate, data) of the point closest to an x, y location
+		:rtype: tuple
+		"""
+		return self[int(self.nearest(point, 1)[0])]
+
+	def close(self) -> None:
+		"""
+		Closes the result file.
+
+		:return: None
+		:rtype: None
+		"""
+		if self.__store is not None:
+			self.__store.close()
+		if self.__mmap is not None:
+			self.__mmap.close()
+			self.__mmap = None
+		if self.__file is not None:
+			self.__file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+	def __load_index(self, size: int) -> tuple[np.ndarray, list]:
+		empty = (np.zeros(1, dtype=np.int64), [])
+		path = self.filename + INDEX_SUFFIX
+		if not os.path.exists(path):
+			return empty
+		try:
+			with np.load(path) as index:
+				offsets, coordinates = index['offsets'], index['coordinates']
+				source_size, digest = int(index['source_size']), str(index['digest'])
+		except (OSError, ValueError, KeyError) as e:
+			self._log.warning(f"Ignoring invalid index {path}: {e}")
+			return empty
+		if size < source_size or offsets[-1] > size or _index_digest(self.__mmap, offsets) != digest:
+			self._log.info(f"{self.filename} was rewritten, indexing it again")
+			return empty
+		return offsets, [tuple(row[~np.isnan(row)]) for row in coordinates]
+
+	def __extend_index(self, offsets: np.ndarray, coordinates: list, size: int) -> tuple[np.ndarray, list]:
+		offsets = offsets.tolist()
+		if offsets[-1] < size:
+			self.__file.seek(offsets[-1])
+			added = 0
+			while True:
+				try:
+					coordinate, _ = pickle.load(self.__file)
+				except EOFError:
+					break
+				except (pickle.UnpicklingError, ValueError, TypeError) as e:
+					self._log.warning(f"Stopped indexing {self.filename} at byte {offsets[-1]}: {e}")
+					break
+				coordinates.append(tuple(float(v) for v in coordinate))
+				offsets.append(self.__file.tell())
+				added += 1
+			if added:
+				self._log.info(f"Indexed {added} points of {self.filename}")
+		return np.asarray(offsets, dtype=np.int64), coordinates
+
+	def __save_index(self, size: int) -> None:
+		path = self.filename + INDEX_SUFFIX
+		try:
+			with open(path, 'wb') as f:
+				np.savez(f, offsets=self.__offsets, coordinates=self.__coordinates, source_size=size,
+						 digest=_index_digest(self.__mmap, self.__offsets))
+		except OSError as e:
+			self._log.warning(f"Could not save index {path}: {e}")
+
+
+def _index_digest(data, offsets: np.ndarray) -> str:
+	# hash of the first and last bytes of records spread over the indexed part of the stream (data: memory map)
+	digest = hashlib.sha1()
+	count = len(offsets) - 1
+	if count > 0:
+		for i in np.unique(np.linspace(0, count - 1, min(count, INDEX_SAMPLES)).astype(np.int64)):
+			start, end = int(offsets[i]), int(offsets[i + 1])
+			digest.update(data[start:min(end, start + 32)])
+			digest.update(data[max(start, end - 32):end])
+	return digest.hexdigest()
+
+
+def _coordinate_array(coordinates: list) -> np.ndarray:
+	# pads coordinates of different length (e.g.: x, y and x, y, z) with NaN
+	width = max((len(c) for c in coordinates), default=2)
+	array = np.full((len(coordinates), width), np.nan)
+	for i, coordinate in enumerate(coordinates):
+		array[i, :len(coordinate)] = coordinate
+	return array
+
+
+class ResultGrid:
+	"""
+	Maps scan points onto a regular x, y grid, e.g. for heatmaps.
+
+	Without a step size, the grid axes are the distinct x and y coordinates (rounded to decimals), which is exact
+	for raster paths (rectangular and polygon paths) and also works for non-uniform steps. If the coordinates do not
+	lie on a lattice (e.g.: spiral paths) or a step size is given, coordinates are quantized to the nearest multiple
+	of the step size from the lower left corner; without step size the mean point spacing is used.
+
+	Points mapping to the same cell (repeated measurements) are combined by a reducer, cells without points are
+	masked (e.g.: outside of a polygon or circle).
+
+	:param coordinates: (n, 2) or (n, 3) coordinates, e.g. :attr:`ScanResults.coordinates` or path.coordinates
+	:type coordinates: Sequence
+	:param step: Cell size in mm, scalar or (x, y)
+	:type step: float or Sequence[float], optional
+	:param decimals: Decimal places the coordinates are rounded to before finding distinct values
+	:type decimals: int, optional
+	"""
+
+	def __init__(self, coordinates, step=None, decimals: int = 6):
+		coordinates = np.asarray(coordinates, dtype=np.float64)
+		if coordinates.ndim != 2 or coordinates.shape[1] < 2:
+			raise ValueError(f"Expected (n, 2) or (n, 3) coordinates, got shape {coordinates.shape}")
+		xy = np.round(coordinates[:, :2], decimals)
+		self.size = len(xy)
+		if step is None:
+			xs, ys = np.unique(xy[:, 0]), np.unique(xy[:, 1])
+			if len(xs) * len(ys) <= max(4 * self.size, 1024):
+				self.xs, self.ys = xs, ys
+				columns, rows = np.searchsorted(xs, xy[:, 0]), np.searchsorted(ys, xy[:, 1])
+			else:
+				# not a lattice, use the mean spacing of the points
+				extent = np.ptp(xy, axis=0)
+				step = float(np.sqrt(extent[0] * extent[1] / self.size)) or float(extent.max() / self.size) or 1.0
+		if step is not None:
+			step = np.broadcast_to(np.asarray(step, dtype=np.float64), (2,))
+			if (step <= 0).any():
+				raise ValueError(f"Step size has to be positive, got {tuple(step)}")
+			low = xy.min(axis=0) if self.size else np.zeros(2)
+			cells = np.rint((xy - low) / step).astype(np.int64)
+			shape = cells.max(axis=0) + 1 if self.size else np.zeros(2, dtype=np.int64)
+			self.xs = low[0] + step[0] * np.arange(shape[0])
+			self.ys = low[1] + step[1] * np.arange(shape[1])
+			columns, rows = cells[:, 0], cells[:, 1]
+		self.step = step
+		self.index = rows * len(self.xs) + columns
+
+		# points sorted by cell (stable, repeated points keep their order), start of every occupied cell
+		self.__order = np.argsort(self.index, kind='stable')
+		keys = self.index[self.__order]
+		self.__starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if self.size else np.zeros(0, np.int64)
+		self.__cells = keys[self.__starts]
+		self.__counts = np.diff(np.r_[self.__starts, self.size])
+
+	@property
+	def shape(self) -> tuple[int, int]:
+		"""
+		:return: Rows (y), columns (x) of the grid
+		:rtype: tuple[int, int]
+		"""
+		return len(self.ys), len(self.xs)
+
+	@property
+	def extent(self) -> list[float]:
+		"""
+		:return: Left, right, bottom, top for matplotlib's imshow(..., origin='lower', extent=extent)
+		:rtype: list[float]
+		"""
+		if not self.size:
+			return [0.0, 0.0, 0.0, 0.0]
+		return [float(self.xs[0]), float(self.xs[-1]), float(self.ys[0]), float(self.ys[-1])]
+
+	@property
+	def mask(self) -> np.ndarray:
+		"""
+		:return: True for cells without points
+		:rtype: np.ndarray
+		"""
+		mask = np.ones(len(self.xs) * len(self.ys), dtype=bool)
+		mask[self.__cells] = False
+		return mask.reshape(self.shape)
+
+	def reduce(self, values, reducer='mean') -> np.ma.MaskedArray:
+		"""
+		Combines the values of the points per cell.
+
+		:param values: (n, ...) value of every point in coordinate order, e.g. :meth:`ScanResults.column`
+		:param reducer: 'mean', 'sum', 'max', 'min', 'count', 'first', 'last' or a NumPy ufunc supporting reduceat
+			(e.g.: np.maximum, np.logical_or)
+		:type reducer: str or np.ufunc, optional
+		:return: (rows, columns, ...) masked grid, row 0 is the smallest y
+		:rtype: np.ma.MaskedArray
+		"""
+		if isinstance(reducer, str) and reducer == 'count':
+			values = np.ones(self.size, dtype=np.int64)
+		values = np.asarray(values)
+		if len(values) != self.size:
+			raise ValueError(f"Got {len(values)} values for {self.size} points")
+		if isinstance(reducer, str) and reducer not in REDUCERS:
+			raise ValueError(f"Unknown reducer {reducer}, expected one of {REDUCERS} or a ufunc")
+
+		ordered = values[self.__order]
+		if not self.size:
+			reduced = ordered
+		elif reducer in ('sum', 'count'):
+			reduced = np.add.reduceat(ordered, self.__starts, axis=0)
+		elif reducer == 'mean':
+			counts = self.__counts.reshape((-1,) + (1,) * (ordered.ndim - 1))
+			reduced = np.add.reduceat(ordered, self.__starts, axis=0, dtype=np.float64) / counts
+		elif reducer == 'max':
+			reduced = np.maximum.reduceat(ordered, self.__starts, axis=0)
+		elif reducer == 'min':
+			reduced = np.minimum.reduceat(ordered, self.__starts, axis=0)
+		elif reducer == 'first':
+			reduced = ordered[self.__starts]
+		elif reducer == 'last':
+			reduced = ordered[self.__starts + self.__counts - 1]
+		else:
+			reduced = reducer.reduceat(ordered, self.__starts, axis=0)
+
+		data = np.zeros((len(self.xs) * len(self.ys),) + reduced.shape[1:], dtype=reduced.dtype)
+		data[self.__cells] = reduced
+		mask = np.broadcast_to(self.mask.reshape(-1, *((1,) * (data.ndim - 1))), data.shape)
+		return np.ma.MaskedArray(data.reshape(self.shape + reduced.shape[1:]),
+								 mask=mask.reshape(self.shape + reduced.shape[1:]))
+
+	def counts(self) -> np.ma.MaskedArray:
+		"""
+		:return: Number of points per cell
+		:rtype: np.ma.MaskedArray
+		"""
+		return self.reduce(None, 'count')
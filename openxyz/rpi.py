@@ -14,57 +14,368 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import serial
+import base64
 import logging
+import os
+import threading
+import time
 
-from openxyz.marlin_serial 	import MarlinSerial
-from openxyz.encoder 		import LS7366R, EncoderAxis
+from openxyz.serial_worker 	import SerialWorker, GCodeBatchError
+from openxyz.marlin_serial 	import BAUDRATE
+from openxyz.stream_server 	import StreamServer
+from openxyz.encoder_sampler 	import EncoderSampler, SAMPLE_FIELDS
+from openxyz.settle 			import wait_settled
+from openxyz 				import metrics
 
 app = Flask(__name__)
 
-enc = LS7366R(bus=0, cs_pins={
-	EncoderAxis.ENCODER_AXIS_X: 23,
-	EncoderAxis.ENCODER_AXIS_Y: 24
-})
+# Marlin serial port, OPENXYZ_SERIAL_PORT selects another one (e.g.: a simulator, python -m openxyz.simulator)
+SERIAL_PORT = os.environ.get('OPENXYZ_SERIAL_PORT', '/dev/ttyACM0')
+# baud rate of the Marlin firmware (BAUDRATE in Configuration.h), e.g. OPENXYZ_BAUDRATE=250000 for
+# documentation/marlin/Configuration.h
+SERIAL_BAUDRATE = int(os.environ.get('OPENXYZ_BAUDRATE', BAUDRATE))
+
+# Serial port is opened once and owned by a single worker thread, request handlers only enqueue commands;
+# serial port and encoders are opened by start(), at the latest on the first request
+marlin_worker = None
+enc = None
+encoder_axes = None
+start_lock = threading.Lock()
+# HTTP and stream server threads share the SPI bus
+enc_lock = threading.Lock()
+
+
+def start() -> None:
+	"""
+	Opens the Marlin serial port and initializes the encoders (SPI, GPIO), if not done yet.
+
+	:return: None
+	:rtype: None
+	"""
+	global marlin_worker, enc, encoder_axes
+	with start_lock:
+		if marlin_worker is not None:
+			return
+		# spidev and RPi.GPIO are only available on the Raspberry Pi
+		from openxyz.encoder import LS7366R, EncoderAxis
+
+		enc = LS7366R(bus=0, cs_pins={
+			EncoderAxis.ENCODER_AXIS_X: 23,
+			EncoderAxis.ENCODER_AXIS_Y: 24
+		}, spi_speed=1_000_000)
+		encoder_axes = [EncoderAxis.ENCODER_AXIS_X, EncoderAxis.ENCODER_AXIS_Y]
+		marlin_worker = SerialWorker(SERIAL_PORT, baudrate=SERIAL_BAUDRATE)
+		logger.info(f"Opened {SERIAL_PORT} ({SERIAL_BAUDRATE} baud) and encoders.")
+
+
+def read_encoders() -> tuple[int, int, int]:
+	x_axis, y_axis = encoder_axes
+	with enc_lock:
+		counters = enc.read_counters(encoder_axes)
+	return counters[x_axis], counters[y_axis], 0
+
+
+# optional high-rate sampling, started and stopped through /encoder_sampling
+encoder_sampler = EncoderSampler(read_encoders)
 
 # Configure logging
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+REQUESTS = metrics.counter('openxyz_bridge_requests_total', 'Requests handled by the bridge', ('endpoint', 'status'))
+REQUEST_SECONDS = metrics.histogram('openxyz_bridge_request_seconds', 'Time to handle a request, including the wait '
+									'for the serial worker', ('endpoint',))
 
-@app.route('/send_gcode', methods=['POST'])
-def send_gcode() -> jsonify:
+
+def decode_response(response: bytes or None) -> str or None:
 	"""
-	Endpoint to send a G-code command to Marlin board.
+	Converts a raw Marlin response into the text returned by the endpoints.
 
-	:return: JSON response with success message or error
-	:rtype: flask.Response
-	:raises KeyError: If no G-code is received in request
-	:raises serial.SerialException: If a serial communication error occurs
-	:raises Exception: If an unexpected error occurs
+	:param response: Raw response of Marlin
+	:type response: bytes or None
+	:return: Response without the trailing 'ok'
+	:rtype: str or None
 	"""
-	gcode = request.json.get('gcode').strip()
+	if response is None:
+		return None
+	return response.decode('utf-8').replace('ok\n', '').strip()
+
+
+def handle_send_gcode(payload: dict) -> tuple[dict, int]:
+	"""
+	Sends a G-code command to Marlin board.
+
+	:param payload: JSON payload with the G-code command ('gcode')
+	:type payload: dict
+	:return: Response body with the response of Marlin or an error, HTTP status code
+	:rtype: tuple[dict, int]
+	"""
+	gcode = str(payload.get('gcode') or '').strip()
 	if not gcode:
 		logger.error("No G-code received in request.")
-		return jsonify({"error": "No G-code received"}), 400
+		return {"error": "No G-code received"}, 400
 
 	try:
-		marlin_serial = MarlinSerial('/dev/ttyACM0')
+		response = decode_response(marlin_worker.send_gcode(gcode))
+
+		logger.debug(f"G-code '{gcode}' executed successfully.")
+		return {"response": response}, 200
+	except serial.SerialException as e:
+		logger.error(f"SerialException: {str(e)}")
+		return {"error": "Serial communication error"}, 500
+	except Exception as e:
+		logger.error(f"Unexpected error: {str(e)}")
+		return {"error": "An unexpected error occurred"}, 500
 
-		response = marlin_serial.send_gcode(gcode)
-		response = response.decode('utf-8').replace('ok\n', '').strip()
 
-		marlin_serial.close()
+def handle_send_gcode_batch(payload: dict) -> tuple[dict, int]:
+	"""
+	Sends an ordered list of G-code commands to Marlin board.
+	The lines are executed back to back without interleaving other requests. Execution stops at the first
+	line that fails, in this case the response body additionally contains the index of the failed line
+	and an error message.
+
+	:param payload: JSON payload with the list of G-code commands ('gcode')
+	:type payload: dict
+	:return: Response body with one response per executed line, HTTP status code
+	:rtype: tuple[dict, int]
+	"""
+	gcodes = payload.get('gcode')
+	if not isinstance(gcodes, list) or not gcodes:
+		logger.error("No G-code batch received in request.")
+		return {"error": "No G-code batch received"}, 400
+	gcodes = [str(gcode).strip() for gcode in gcodes]
+	if not all(gcodes):
+		logger.error("Empty G-code line in batch.")
+		return {"error": "Empty G-code line in batch"}, 400
 
-		logger.info(f"G-code '{gcode}' executed successfully.")
-		return jsonify({"response": response}), 200
+	try:
+		responses = marlin_worker.send_gcode_batch(gcodes)
+		logger.debug(f"G-code batch of {len(gcodes)} lines executed successfully.")
+		return {"responses": [decode_response(response) for response in responses]}, 200
+	except GCodeBatchError as e:
+		logger.error(f"G-code batch failed at line {e.index}: {str(e)}")
+		return {
+			"responses": [decode_response(response) for response in e.responses],
+			"index": e.index,
+			"error": str(e)
+		}, 200
+	except Exception as e:
+		logger.error(f"Unexpected error: {str(e)}")
+		return {"error": "An unexpected error occurred"}, 500
+
+
+def handle_emergency(payload: dict) -> tuple[dict, int]:
+	"""
+	Stops movement immediately (M410). Queued commands are cancelled and the command in progress is not waited for.
+
+	:param payload: Unused
+	:type payload: dict
+	:return: Response body with status message, HTTP status code
+	:rtype: tuple[dict, int]
+	"""
+	try:
+		marlin_worker.emergency()
+		return {"message": "Emergency stop initiated."}, 200
+	except serial.SerialException as e:
+		logger.error(f"SerialException: {str(e)}")
+		return {"error": "Serial communication error"}, 500
+
+
+def handle_status(payload: dict) -> tuple[dict, int]:
+	"""
+	Checks the status of Marlin board.
+
+	:param payload: Unused
+	:type payload: dict
+	:return: Response body with status message, HTTP status code
+	:rtype: tuple[dict, int]
+	"""
+	logger.debug("Status check requested.")
+	return {"message": "Marlin is ready."}, 200
+
+
+def handle_encoder_status(payload: dict) -> tuple[dict, int]:
+	"""
+	Reads the x, y encoder values, both latched at the same instant.
+
+	:param payload: Unused
+	:type payload: dict
+	:return: Response body with encoder values, HTTP status code
+	:rtype: tuple[dict, int]
+	"""
+	x, y, _ = read_encoders()
+	return {"x": x, "y": y}, 200
+
+
+def handle_wait_settled(payload: dict) -> tuple[dict, int]:
+	"""
+	Waits until all moves are completed (M400) and the encoders stay within a window of counts for a number of
+	consecutive samples. No other command is executed in the meantime.
+
+	:param payload: JSON payload with optional 'window' (counts), 'samples', 'timeout' and 'interval' (seconds)
+	:type payload: dict
+	:return: Response body with 'settled', the measured 'settle_time' after M400 in seconds and the encoder values,
+		HTTP status code
+	:rtype: tuple[dict, int]
+	"""
+	try:
+		window = int(payload.get('window', 2))
+		samples = int(payload.get('samples', 5))
+		timeout = float(payload.get('timeout', 5.0))
+		interval = float(payload.get('interval', 0.001))
+	except (TypeError, ValueError):
+		return {"error": "Invalid settle parameters"}, 400
+	if window < 0 or samples < 1 or timeout < 0 or interval < 0:
+		return {"error": "Invalid settle parameters"}, 400
+
+	def job(marlin_serial):
+		marlin_serial.synchronize()
+		return wait_settled(read_encoders, window=window, samples=samples, timeout=timeout, interval=interval)
+
+	try:
+		settled, settle_time, (x, y, _) = marlin_worker.submit(job).result()
 	except serial.SerialException as e:
 		logger.error(f"SerialException: {str(e)}")
-		return jsonify({"error": "Serial communication error"}), 500
+		return {"error": "Serial communication error"}, 500
 	except Exception as e:
 		logger.error(f"Unexpected error: {str(e)}")
-		return jsonify({"error": "An unexpected error occurred"}), 500
+		return {"error": "An unexpected error occurred"}, 500
+	if settled:
+		logger.info(f"Settled after {settle_time:.4f} s.")
+	else:
+		logger.warning(f"Not settled within {timeout} s.")
+	return {"settled": settled, "settle_time": settle_time, "x": x, "y": y}, 200
+
+
+def handle_encoder_sampling(payload: dict) -> tuple[dict, int]:
+	"""
+	Starts or stops the background encoder sampling.
+
+	:param payload: JSON payload with 'enable' (bool) and optionally the sampling 'interval' in seconds
+	:type payload: dict
+	:return: Response body with the sampling state, HTTP status code
+	:rtype: tuple[dict, int]
+	"""
+	try:
+		interval = float(payload['interval']) if payload.get('interval') is not None else None
+	except (TypeError, ValueError):
+		return {"error": "Invalid sampling interval"}, 400
+	if interval is not None and interval <= 0:
+		return {"error": "Invalid sampling interval"}, 400
+	if payload.get('enable', True):
+		encoder_sampler.start(interval)
+		logger.info(f"Encoder sampling started every {encoder_sampler.interval} s.")
+	else:
+		encoder_sampler.stop()
+		logger.info("Encoder sampling stopped.")
+	return {"running": encoder_sampler.running, "interval": encoder_sampler.interval,
+			"sequence": encoder_sampler.sequence}, 200
+
+
+def handle_encoder_samples(payload: dict) -> tuple[dict, int]:
+	"""
+	Returns the sampled encoder values starting at a sequence number.
+	The samples are packed records (see openxyz.encoder_sampler.SAMPLE_FIELDS), base64 encoded.
+
+	:param payload: JSON payload with the first sequence number 'since' and optionally the maximum number 'limit'
+	:type payload: dict
+	:return: Response body with the samples, HTTP status code
+	:rtype: tuple[dict, int]
+	"""
+	try:
+		since = int(payload.get('since') or 0)
+		limit = int(payload['limit']) if payload.get('limit') is not None else None
+	except (TypeError, ValueError):
+		return {"error": "Invalid sequence number or limit"}, 400
+	first, end, data = encoder_sampler.samples_since(since, limit)
+	return {
+		"first": first,
+		"next": end,
+		"running": encoder_sampler.running,
+		"fields": SAMPLE_FIELDS,
+		"data": base64.b64encode(data).decode('ascii')
+	}, 200
+
+
+def instrumented(endpoint: str, handler):
+	"""
+	Wraps a handler to open the hardware on the first request (see :func:`start`), count its requests by status
+	code and record their latency.
+
+	:param endpoint: Endpoint of the handler (e.g.: '/send_gcode')
+	:type endpoint: str
+	:param handler: Request handler
+	:type handler: Callable[[dict], tuple[dict, int]]
+	:return: Wrapped handler
+	:rtype: Callable[[dict], tuple[dict, int]]
+	"""
+	seconds = REQUEST_SECONDS.labels(endpoint)
+
+	def wrapper(payload: dict) -> tuple[dict, int]:
+		started = time.perf_counter()
+		status_code = 500
+		try:
+			if marlin_worker is None:
+				start()
+			body, status_code = handler(payload)
+			return body, status_code
+		finally:
+			seconds.observe(time.perf_counter() - started)
+			REQUESTS.labels(endpoint, status_code).inc()
+
+	return wrapper
+
+
+# handlers by endpoint, shared by the HTTP routes and the stream server
+HANDLERS = {endpoint: instrumented(endpoint, handler) for endpoint, handler in {
+	'/send_gcode': handle_send_gcode,
+	'/send_gcode_batch': handle_send_gcode_batch,
+	'/emergency': handle_emergency,
+	'/status': handle_status,
+	'/encoder_status': handle_encoder_status,
+	'/wait_settled': handle_wait_settled,
+	'/encoder_sampling': handle_encoder_sampling,
+	'/encoder_samples': handle_encoder_samples,
+}.items()}
+
+
+@app.route('/send_gcode', methods=['POST'])
+def send_gcode() -> jsonify:
+	"""
+	Endpoint to send a G-code command to Marlin board.
+
+	:return: JSON response with success message or error
+	:rtype: flask.Response
+	"""
+	body, status_code = HANDLERS['/send_gcode'](request.json or {})
+	return jsonify(body), status_code
+
+
+@app.route('/send_gcode_batch', methods=['POST'])
+def send_gcode_batch() -> jsonify:
+	"""
+	Endpoint to send an ordered list of G-code commands to Marlin board in one request.
+
+	:return: JSON response with one response per executed line
+	:rtype: flask.Response
+	"""
+	body, status_code = HANDLERS['/send_gcode_batch'](request.json or {})
+	return jsonify(body), status_code
+
+
+@app.route('/emergency', methods=['POST'])
+def emergency() -> jsonify:
+	"""
+	Endpoint to stop movement immediately (M410), bypassing queued commands.
+
+	:return: JSON response with status message
+	:rtype: flask.Response
+	"""
+	body, status_code = HANDLERS['/emergency']({})
+	return jsonify(body), status_code
 
 
 @app.route('/status', methods=['GET'])
@@ -75,23 +386,72 @@ def status() -> jsonify:
 	:return: JSON response with status message
 	:rtype: flask.Response
 	"""
-	logger.info("Status check requested.")
-	return jsonify({"message": "Marlin is ready."}), 200
+	body, status_code = HANDLERS['/status']({})
+	return jsonify(body), status_code
 
 
 @app.route('/encoder_status', methods=['GET'])
 def encoder_status() -> jsonify:
-	global enc
 	"""
 	Endpoint to get x, y encoder values.
 
 	:return: JSON response with status message
 	:rtype: flask.Response
 	"""
-	x = enc.read_counter(EncoderAxis.ENCODER_AXIS_X)
-	y = enc.read_counter(EncoderAxis.ENCODER_AXIS_Y)
-	return jsonify({"x": x, "y": y}), 200
-	
+	body, status_code = HANDLERS['/encoder_status']({})
+	return jsonify(body), status_code
+
+
+@app.route('/wait_settled', methods=['POST'])
+def wait_until_settled() -> jsonify:
+	"""
+	Endpoint to wait until all moves are completed and the stage has settled according to the encoders.
+
+	:return: JSON response with the measured settle time
+	:rtype: flask.Response
+	"""
+	body, status_code = HANDLERS['/wait_settled'](request.json or {})
+	return jsonify(body), status_code
+
+
+@app.route('/encoder_sampling', methods=['POST'])
+def encoder_sampling() -> jsonify:
+	"""
+	Endpoint to start or stop the background encoder sampling.
+
+	:return: JSON response with the sampling state
+	:rtype: flask.Response
+	"""
+	body, status_code = HANDLERS['/encoder_sampling'](request.json or {})
+	return jsonify(body), status_code
+
+
+@app.route('/encoder_samples', methods=['POST'])
+def encoder_samples() -> jsonify:
+	"""
+	Endpoint to get the sampled encoder values since a sequence number.
+
+	:return: JSON response with the packed samples
+	:rtype: flask.Response
+	"""
+	body, status_code = HANDLERS['/encoder_samples'](request.json or {})
+	return jsonify(body), status_code
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics() -> Response:
+	"""
+	Endpoint to scrape the counters and latency histograms of the bridge (Prometheus text format).
+
+	:return: Metrics of the bridge
+	:rtype: flask.Response
+	"""
+	return Response(metrics.exposition(), mimetype='text/plain; version=0.0.4')
+
 
 if __name__ == '__main__':
+	start()
+	# persistent low-latency channel next to the HTTP API (Marlin(ip='tcp://<host>:5001'))
+	stream_server = StreamServer(('0.0.0.0', 5001), HANDLERS, worker=marlin_worker, immediate=('/emergency', '/status'))
+	stream_server.start()
 	app.run(host='0.0.0.0', port=5000)
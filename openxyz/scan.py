@@ -0,0 +1,255 @@
+import itertools
+import logging
+import os
+import pickle
+import queue
+import threading
+from typing import Any, Callable, Iterable, Sequence
+
+# marks the end of a queue
+_STOP = object()
+
+
+class PickleSink:
+	"""
+	Appends (coordinate, data) tuples to a pickle stream, the format read by ``examples/read_scan_results.py``.
+	Unlike :meth:`openxyz.utils.FileManager.append_to_file`, the file stays open for the whole scan.
+
+	:param filename: Path of the result file
+	:type filename: str
+	:param append: If True, append to an existing file instead of overwriting it
+	:type append: bool, optional
+	"""
+
+	def __init__(self, filename: str, append: bool = False):
+		self.filename = filename
+		self.__file = open(filename, 'ab' if append else 'wb')
+
+	def append(self, coordinate: Sequence, data: Any) -> None:
+		"""
+		Appends the result of one point.
+
+		:param coordinate: Coordinate of the point
+		:type coordinate: Sequence
+		:param data: Measurement data
+		:type data: Any
+		:return: None
+		:rtype: None
+		"""
+		pickle.dump((coordinate, data), self.__file, protocol=pickle.HIGHEST_PROTOCOL)
+
+	@property
+	def position(self) -> int:
+		"""
+		:return: Offset after the last appended result, the position a :meth:`truncate` can restore
+		:rtype: int
+		"""
+		return self.__file.tell()
+
+	def truncate(self, position: int) -> None:
+		"""
+		Drops all results after an offset (e.g.: a partly written last result or results which are not recorded in the
+		scan journal).
+
+		:param position: Offset to truncate the file to
+		:type position: int
+		:return: None
+		:rtype: None
+		"""
+		self.__file.flush()
+		self.__file.truncate(position)
+		self.__file.seek(0, os.SEEK_END)
+
+	def flush(self) -> None:
+		"""
+		Flushes buffered results to disk.
+
+		:return: None
+		:rtype: None
+		"""
+		self.__file.flush()
+
+	def sync(self) -> None:
+		"""
+		Flushes buffered results and waits until they are written to disk (fsync).
+
+		:return: None
+		:rtype: None
+		"""
+		self.__file.flush()
+		os.fsync(self.__file.fileno())
+
+	def close(self) -> None:
+		"""
+		Closes the result file.
+
+		:return: None
+		:rtype: None
+		"""
+		self.__file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+
+class ScanExecutor:
+	"""
+	Runs a scan as a pipeline of move/measure, post-process and persist stages.
+
+	Moving and measuring happen in the calling thread, because a measurement needs the stage at rest. Completed
+	measurements are handed to post-process workers and a single persist worker through bounded queues, so the next
+	move is already commanded while the previous result is processed and written. If the workers fall behind, the
+	bounded queues block the scan (backpressure). An exception in any stage stops the scan and is re-raised by
+	:meth:`run`. Results measured before are still post-processed and persisted in path order, up to the first result
+	whose post-processing or persisting failed; later results are discarded (and measured again on resume).
+
+	With a journal, the index of every persisted point is recorded together with the ``position`` of the sink after
+	it (0 if the sink has none). When the journal is due for a sync, the sink is synced first (``sync()``, or
+	``flush()`` if the sink has none).
+
+	:param move: Moves the stage to a coordinate
+	:type move: Callable[[Sequence], None]
+	:param callback: Measurement, called without arguments at every point
+	:type callback: Callable[[], Any]
+	:param sink: Receives (coordinate, data) of every point in path order, either an object with an
+		``append(coordinate, data)`` method (and optionally ``flush()``) or a callable
+	:type sink: Any
+	:param post_process: Optional transformation ``post_process(coordinate, data) -> data`` applied before persisting
+	:type post_process: Callable[[Sequence, Any], Any], optional
+	:param queue_size: Maximum number of results waiting in each queue
+	:type queue_size: int, optional
+	:param post_process_workers: Number of post-process threads
+	:type post_process_workers: int, optional
+	:param journal: Records the completed points
+	:type journal: openxyz.journal.ScanJournal, optional
+	"""
+
+	def __init__(self, move: Callable[[Sequence], None], callback: Callable[[], Any], sink: Any,
+				 post_process: Callable[[Sequence, Any], Any] = None, queue_size: int = 16,
+				 post_process_workers: int = 1, journal=None):
+		self._log = logging.getLogger(__name__)
+		self.__move = move
+		self.__callback = callback
+		self.__sink = sink
+		self.__append = sink.append if hasattr(sink, 'append') else sink
+		self.__post_process = post_process
+		self.__queue_size = queue_size
+		self.__post_process_workers = post_process_workers if post_process is not None else 0
+		self.__journal = journal
+		self.__error = None
+		self.__error_lock = threading.Lock()
+		# set if the sink failed, no more results are persisted
+		self.__persist_failed = False
+
+	def run(self, coordinates: Iterable[Sequence], start: int = 0, indices: Iterable[int] = None) -> int:
+		"""
+		Scans all coordinates.
+
+		:param coordinates: Coordinates in scan order
+		:type coordinates: Iterable[Sequence]
+		:param start: Index of the first coordinate, used to number the points
+		:type start: int, optional
+		:param indices: Index of every coordinate in the path (e.g.: the remaining points of a resumed scan), used
+			instead of numbering from start
+		:type indices: Iterable[int], optional
+		:return: Number of measured points
+		:rtype: int
+		:raises Exception: The first exception raised by the move, measurement, post-process or persist stage
+		"""
+		self.__error = None
+		self.__persist_failed = False
+		persist_queue = queue.Queue(self.__queue_size)
+		post_queue = queue.Queue(self.__queue_size) if self.__post_process_workers else persist_queue
+
+		post_workers = [
+			threading.Thread(target=self.__post_process_worker, args=(post_queue, persist_queue),
+							 name=f'scan-post-process-{i}', daemon=True)
+			for i in range(self.__post_process_workers)
+		]
+		persist_worker = threading.Thread(target=self.__persist_worker, args=(persist_queue,),
+										  name='scan-persist', daemon=True)
+		for worker in post_workers + [persist_worker]:
+			worker.start()
+
+		if indices is None:
+			indices = itertools.count(start)
+		count = 0
+		try:
+			# results are ordered by sequence number, the index identifies the point in the path
+			for sequence, (index, coordinate) in enumerate(zip(indices, coordinates)):
+				self.__raise_error()
+				self.__move(coordinate)
+				data = self.__callback()
+				post_queue.put((sequence, index, coordinate, data))
+				count += 1
+		finally:
+			# final flush: let every stage finish the results which were already measured
+			for _ in post_workers:
+				post_queue.put(_STOP)
+			for worker in post_workers:
+				worker.join()
+			persist_queue.put(_STOP)
+			persist_worker.join()
+			self.__sync()
+
+		self.__raise_error()
+		return count
+
+	def __set_error(self, error: BaseException) -> None:
+		with self.__error_lock:
+			if self.__error is None:
+				self._log.error(f"Scan stage failed: {error}")
+				self.__error = error
+
+	def __sync(self) -> None:
+		if hasattr(self.__sink, 'sync') and self.__journal is not None:
+			self.__sink.sync()
+		elif hasattr(self.__sink, 'flush'):
+			self.__sink.flush()
+		if self.__journal is not None:
+			self.__journal.sync()
+
+	def __raise_error(self) -> None:
+		if self.__error is not None:
+			raise self.__error
+
+	def __post_process_worker(self, post_queue: queue.Queue, persist_queue: queue.Queue) -> None:
+		while True:
+			item = post_queue.get()
+			if item is _STOP:
+				return
+			if self.__persist_failed:
+				# keep draining so the scan thread never blocks on a full queue
+				continue
+			sequence, index, coordinate, data = item
+			try:
+				persist_queue.put((sequence, index, coordinate, self.__post_process(coordinate, data)))
+			except BaseException as e:
+				self.__set_error(e)
+
+	def __persist_worker(self, persist_queue: queue.Queue) -> None:
+		# post-process workers may finish out of order, results are persisted in path order
+		pending = {}
+		next_sequence = 0
+		while True:
+			item = persist_queue.get()
+			if item is _STOP:
+				break
+			if self.__persist_failed:
+				continue
+			pending[item[0]] = item
+			try:
+				while next_sequence in pending:
+					_, index, coordinate, data = pending.pop(next_sequence)
+					self.__append(coordinate, data)
+					next_sequence += 1
+					if self.__journal is not None:
+						self.__journal.record(index, getattr(self.__sink, 'position', 0))
+						if self.__journal.due:
+							self.__sync()
+			except BaseException as e:
+				self.__persist_failed = True
+				self.__set_error(e)
@@ -0,0 +1,218 @@
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Callable, Any, List
+
+from openxyz.marlin_serial import MarlinSerial, BAUDRATE, UNKNOWN_CMD_MSG, ERROR_MSG
+
+
+class GCodeBatchError(Exception):
+	"""
+	Raised if a line of a G-code batch fails. Lines after the failed one are not executed.
+
+	:param message: Error message
+	:type message: str
+	:param index: Index of the failed line
+	:type index: int
+	:param responses: Responses of all executed lines including the failed one (None if it raised)
+	:type responses: List[bytes or None]
+	"""
+
+	def __init__(self, message: str, index: int, responses: List[bytes or None]):
+		super().__init__(message)
+		self.index = index
+		self.responses = responses
+
+
+class SerialWorker:
+	"""
+	Owns a single MarlinSerial connection and executes all jobs on it from one dedicated thread.
+
+	The serial port is opened once when the worker is created and stays open until :meth:`stop` is called.
+	Callers only enqueue jobs and wait for their result, so commands of concurrent callers never interleave
+	on the same tty.
+
+	:param tty: Serial port (e.g.: '/dev/ttyACM0')
+	:type tty: str
+	:param mock: If True, talk to a simulated Marlin (see :class:`openxyz.simulator.MarlinSimulator`)
+	:type mock: bool, optional
+	:param max_pending: Maximum number of queued jobs (0 for unbounded)
+	:type max_pending: int, optional
+	:param streaming: If True, moves are streamed into the Marlin planner (see :class:`MarlinSerial`)
+	:type streaming: bool, optional
+	:param baudrate: Baud rate of tty
+	:type baudrate: int, optional
+	:param simulator: Simulated Marlin used in mock mode
+	:type simulator: openxyz.simulator.MarlinSimulator, optional
+	"""
+
+	def __init__(self, tty: str, mock: bool = False, max_pending: int = 0, streaming: bool = False,
+				 baudrate: int = BAUDRATE, simulator=None):
+		self._log = logging.getLogger(__name__)
+		self.__marlin_serial = MarlinSerial(tty, mock=mock, streaming=streaming, baudrate=baudrate,
+											simulator=simulator)
+		self.__busy_listeners = []
+		self.__marlin_serial.on_busy = self.__notify_busy
+		self.__queue = queue.Queue(maxsize=max_pending)
+		# submit() and stop() check and enqueue atomically, no job is queued behind the stop request
+		self.__submit_lock = threading.Lock()
+		self.__stopping = False
+		self.__thread = threading.Thread(target=self.__run, name='marlin-serial-worker', daemon=True)
+		self.__thread.start()
+
+	@property
+	def running(self) -> bool:
+		"""
+		:return: True while the worker thread is alive
+		:rtype: bool
+		"""
+		return self.__thread.is_alive()
+
+	def add_busy_listener(self, callback: Callable[[], None]) -> None:
+		"""
+		Registers a callable which is invoked (from the worker thread) for every busy keepalive message of Marlin.
+
+		:param callback: Callable without arguments
+		:type callback: Callable[[], None]
+		:return: None
+		:rtype: None
+		"""
+		self.__busy_listeners.append(callback)
+
+	def remove_busy_listener(self, callback: Callable[[], None]) -> None:
+		"""
+		Removes a callable registered with :meth:`add_busy_listener`.
+
+		:param callback: Previously registered callable
+		:type callback: Callable[[], None]
+		:return: None
+		:rtype: None
+		"""
+		if callback in self.__busy_listeners:
+			self.__busy_listeners.remove(callback)
+
+	def emergency(self) -> None:
+		"""
+		Cancels all queued jobs and writes M410 immediately, bypassing the job queue (the worker may be blocked by a
+		move). Its 'ok' is discarded by the worker thread, which stays the only reader of the port.
+
+		:return: None
+		:rtype: None
+		"""
+		while True:
+			try:
+				item = self.__queue.get_nowait()
+			except queue.Empty:
+				break
+			if item is None:
+				# keep a pending stop request
+				self.__queue.put(None)
+				break
+			if item[1].set_running_or_notify_cancel():
+				item[1].set_exception(RuntimeError('Cancelled by emergency stop.'))
+		self.__marlin_serial.emergency_nowait()
+
+	def submit(self, job: Callable[[MarlinSerial], Any]) -> Future:
+		"""
+		Enqueues a job which is executed with exclusive access to the serial connection.
+
+		:param job: Callable receiving the MarlinSerial instance
+		:type job: Callable[[MarlinSerial], Any]
+		:return: Future resolving to the return value of the job
+		:rtype: concurrent.futures.Future
+		:raises RuntimeError: If the worker has been stopped
+		"""
+		future = Future()
+		with self.__submit_lock:
+			if self.__stopping or not self.running:
+				raise RuntimeError('Serial worker is not running.')
+			self.__queue.put((job, future))
+		return future
+
+	def send_gcode(self, gcode: str, timeout: float or None = None) -> bytes:
+		"""
+		Sends a G-code command through the worker and waits for its response.
+
+		:param gcode: Command string (e.g.: 'G0 X1')
+		:type gcode: str
+		:param timeout: Maximum time to wait for the command in seconds (None waits forever)
+		:type timeout: float or None, optional
+		:return: Raw response of Marlin
+		:rtype: bytes
+		"""
+		return self.submit(lambda marlin_serial: marlin_serial.send_gcode(gcode)).result(timeout)
+
+	def send_gcode_batch(self, gcodes: List[str], timeout: float or None = None) -> List[bytes]:
+		"""
+		Sends an ordered list of G-code commands as a single job, so no other command can be interleaved.
+		Execution stops at the first line which raises or is rejected by Marlin.
+
+		:param gcodes: Command strings in execution order
+		:type gcodes: List[str]
+		:param timeout: Maximum time to wait for the whole batch in seconds (None waits forever)
+		:type timeout: float or None, optional
+		:return: Raw responses of Marlin, one per line
+		:rtype: List[bytes]
+		:raises GCodeBatchError: If a line fails
+		"""
+		def job(marlin_serial: MarlinSerial) -> List[bytes]:
+			responses = []
+			for index, gcode in enumerate(gcodes):
+				try:
+					response = marlin_serial.send_gcode(gcode)
+				except Exception as e:
+					responses.append(None)
+					raise GCodeBatchError(f"'{gcode}' failed: {e}", index, responses) from e
+				responses.append(response)
+				if UNKNOWN_CMD_MSG in response or ERROR_MSG in response:
+					raise GCodeBatchError(f"'{gcode}' was rejected by Marlin", index, responses)
+			return responses
+
+		return self.submit(job).result(timeout)
+
+	def stop(self, timeout: float or None = None) -> None:
+		"""
+		Finishes all queued jobs, stops the worker thread and closes the serial port.
+
+		:param timeout: Maximum time to wait for the worker thread in seconds
+		:type timeout: float or None, optional
+		:return: None
+		:rtype: None
+		"""
+		with self.__submit_lock:
+			if self.running and not self.__stopping:
+				self.__stopping = True
+				self.__queue.put(None)
+		self.__thread.join(timeout)
+
+	def __notify_busy(self) -> None:
+		for callback in list(self.__busy_listeners):
+			try:
+				callback()
+			except Exception as e:
+				self._log.warning(f"Busy listener failed: {e}")
+
+	def __run(self) -> None:
+		try:
+			while True:
+				item = self.__queue.get()
+				if item is None:
+					break
+				job, future = item
+				if not future.set_running_or_notify_cancel():
+					continue
+				try:
+					future.set_result(job(self.__marlin_serial))
+				except BaseException as e:
+					self._log.error(f"Serial job failed: {e}")
+					future.set_exception(e)
+		finally:
+			with self.__submit_lock:
+				self.__stopping = True
+			self.__marlin_serial.close()
+			# fail jobs which were enqueued while the worker was shutting down
+			while not self.__queue.empty():
+				item = self.__queue.get_nowait()
+				if item is not None and item[1].set_running_or_notify_cancel():
+					item[1].set_exception(RuntimeError('Serial worker stopped.'))
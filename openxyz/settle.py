@@ -0,0 +1,50 @@
+import time
+from typing import Callable, Sequence, Tuple
+
+# LS7366R counters are 32 bit wide and wrap around
+COUNTER_MODULUS = 1 << 32
+
+
+def wait_settled(read: Callable[[], Sequence[int]], window: int = 2, samples: int = 5, timeout: float = 5.0,
+				 interval: float = 0.001) -> Tuple[bool, float, Tuple[int, ...]]:
+	"""
+	Polls encoder counters until the position stays within a window for a number of consecutive samples.
+
+	:param read: Callable returning the encoder counters (e.g.: x, y, z)
+	:type read: Callable[[], Sequence[int]]
+	:param window: Maximum spread of every counter during the stable samples in counts
+	:type window: int, optional
+	:param samples: Number of consecutive samples which have to stay within the window
+	:type samples: int, optional
+	:param timeout: Maximum time to wait in seconds
+	:type timeout: float, optional
+	:param interval: Time between samples in seconds
+	:type interval: float, optional
+	:return: True if settled (False on timeout), time in seconds from the call until the first sample of the stable
+		samples, last counters read
+	:rtype: Tuple[bool, float, Tuple[int, ...]]
+	"""
+	start = time.monotonic()
+	deadline = start + timeout
+	half = COUNTER_MODULUS // 2
+	reference = None
+	while True:
+		now = time.monotonic()
+		counters = tuple(read())
+		if reference is None:
+			reference, since, count = counters, now, 0
+			low = high = [0] * len(counters)
+		# offsets to the first sample of the run, robust against wrap around of the counters
+		offsets = [(c - r + half) % COUNTER_MODULUS - half for c, r in zip(counters, reference)]
+		low = [min(a, b) for a, b in zip(low, offsets)]
+		high = [max(a, b) for a, b in zip(high, offsets)]
+		if any(h - l > window for l, h in zip(low, high)):
+			# moved, start a new run with this sample
+			reference, since, count = counters, now, 0
+			low = high = [0] * len(counters)
+		count += 1
+		if count >= samples:
+			return True, since - start, counters
+		if now >= deadline:
+			return False, now - start, counters
+		time.sleep(max(0.0, min(interval, deadline - time.monotonic())))
@@ -0,0 +1,703 @@
+import collections
+import logging
+import os
+import re
+import threading
+import time
+from typing import Sequence
+
+from openxyz.marlin_serial import BUFSIZE, BUSY_MSG, OK_MSG, checksum
+from openxyz.motion import BLOCK_BUFFER_SIZE, MotionModel
+
+# settings of documentation/marlin/Configuration.h
+KEEPALIVE_INTERVAL = 2.0  # s, DEFAULT_KEEPALIVE_INTERVAL
+HOMING_FEEDRATE = 2.0  # mm/s, HOMING_FEEDRATE_MM_M
+STEPS_PER_UNIT = (6400, 6400, 6400)  # DEFAULT_AXIS_STEPS_PER_UNIT
+# resolution of the simulated encoders
+ENCODER_COUNTS_PER_MM = 1000
+
+_NUMBERED_LINE = re.compile(r'^N(-?\d+)\s*(.*?)\*(\d+)$')
+_WORD = re.compile(r'([A-Z])\s*(-?\d*\.?\d*)')
+
+
+class VirtualClock:
+	"""
+	Time source of the simulator.
+
+	With a speed, virtual time passes ``speed`` times faster than real time. Without speed, virtual time only advances
+	when the simulator waits (:meth:`sleep` returns immediately), so moves complete without any real delay.
+
+	:param speed: Virtual seconds per real second, None to run as fast as possible
+	:type speed: float, optional
+	"""
+
+	def __init__(self, speed: float = None):
+		self.speed = speed
+		self.__lock = threading.Lock()
+		self.__start = time.monotonic()
+		self.__skipped = 0.0
+
+	def time(self) -> float:
+		"""
+		:return: Virtual time in seconds since the clock was created
+		:rtype: float
+		"""
+		with self.__lock:
+			elapsed = (time.monotonic() - self.__start) * self.speed if self.speed else 0.0
+			return elapsed + self.__skipped
+
+	def sleep(self, seconds: float) -> None:
+		"""
+		Waits for a virtual duration.
+
+		:param seconds: Virtual duration in seconds
+		:type seconds: float
+		:return: None
+		:rtype: None
+		"""
+		if seconds <= 0:
+			return
+		if self.speed:
+			time.sleep(seconds / self.speed)
+		else:
+			with self.__lock:
+				self.__skipped += seconds
+
+
+class _Block:
+	"""
+	A move in the planner buffer.
+	"""
+	__slots__ = ('start_time', 'end_time', 'start', 'end')
+
+	def __init__(self, start_time: float, end_time: float, start: Sequence[float], end: Sequence[float]):
+		self.start_time = start_time
+		self.end_time = end_time
+		self.start = start
+		self.end = end
+
+
+class _Command:
+	"""
+	A received line waiting for execution.
+	"""
+	__slots__ = ('line', 'code', 'words', 'ready_at', 'error')
+
+	def __init__(self, line: str, error: str = None):
+		self.line = line
+		# rejected line (line number or checksum error), answered with the error and a resend request
+		self.error = error
+		self.code = line.split(maxsplit=1)[0] if line else ''
+		self.words = {letter: value for letter, value in _WORD.findall(line[len(self.code):])}
+		# virtual time a dwell or homing started by this command ends
+		self.ready_at = None
+
+
+class MarlinSimulator:
+	"""
+	Simulates a Marlin board behind a serial port, as a drop-in replacement of ``serial.Serial``.
+
+	Lines are processed in order like Marlin does: line numbers and checksums are verified (with 'Resend:' on
+	errors), moves are added to a planner buffer of ``planner_size`` blocks and acknowledged with 'ok' as soon as
+	there is room, M400, G4 and G28 wait for the planner to run empty. While a command waits, 'busy' keepalives are
+	sent every ``keepalive_interval``. Every move is executed from rest to rest with the duration of the motion model
+	(feed rate, M220 feed rate percentage, M203 maximum feed rates, M201/M204 accelerations).
+
+	M114, M220, M503, G20/G21, G90/G91, G92, M110, M410 and M112 are answered like Marlin, other supported commands
+	only with 'ok'. Unknown commands are answered with 'echo:Unknown command:'.
+
+	Nothing runs in the background: the simulation advances when the host reads, waiting on the virtual clock.
+
+	:param clock: Virtual clock, runs as fast as possible by default
+	:type clock: VirtualClock, optional
+	:param motion: Planner settings used for the move durations
+	:type motion: MotionModel, optional
+	:param planner_size: Number of moves in the planner buffer (BLOCK_BUFFER_SIZE)
+	:type planner_size: int, optional
+	:param keepalive_interval: Time between busy messages in seconds (DEFAULT_KEEPALIVE_INTERVAL)
+	:type keepalive_interval: float, optional
+	:param advanced_ok: If True, 'ok' reports the line number and free planner and command buffer slots (ADVANCED_OK)
+	:type advanced_ok: bool, optional
+	:param timeout: Read timeout in virtual seconds, like ``serial.Serial(timeout=...)``
+	:type timeout: float, optional
+	"""
+
+	def __init__(self, clock: VirtualClock = None, motion: MotionModel = None, planner_size: int = BLOCK_BUFFER_SIZE,
+				 keepalive_interval: float = KEEPALIVE_INTERVAL, advanced_ok: bool = False, timeout: float = 0.25):
+		self._log = logging.getLogger(__name__)
+		self.clock = clock if clock is not None else VirtualClock()
+		self.motion = motion if motion is not None else MotionModel()
+		self.planner_size = planner_size
+		self.keepalive_interval = keepalive_interval
+		self.advanced_ok = advanced_ok
+		self.timeout = timeout
+		self.is_open = True
+
+		self.position = [0.0, 0.0, 0.0]  # commanded x, y, z in mm
+		self.homed = False
+		self.relative = False
+		self.inches = False
+		self.feedrate = None  # mm/min, None for the maximum feed rates
+		self.feedrate_percent = 100
+		self.halted = False
+		self.moves = 0  # number of executed moves
+
+		self.__lock = threading.RLock()
+		self.__received = bytearray()
+		self.__commands = collections.deque()
+		self.__output = bytearray()
+		self.__blocks = collections.deque()
+		self.__line_number = 0
+		self.__keepalive_at = None
+
+	@property
+	def in_waiting(self) -> int:
+		"""
+		:return: Number of bytes which can be read without waiting
+		:rtype: int
+		"""
+		with self.__lock:
+			self.__run()
+			return len(self.__output)
+
+	@property
+	def planned(self) -> int:
+		"""
+		:return: Number of moves in the planner buffer (including the one in progress)
+		:rtype: int
+		"""
+		with self.__lock:
+			self.__retire(self.clock.time())
+			return len(self.__blocks)
+
+	def write(self, data: bytes) -> int:
+		"""
+		Receives data from the host.
+
+		:param data: Bytes sent to Marlin
+		:type data: bytes
+		:return: Number of bytes written
+		:rtype: int
+		"""
+		with self.__lock:
+			self.__received += data
+			*lines, rest = self.__received.split(b'\n')
+			self.__received = bytearray(rest)
+			for line in lines:
+				line = line.decode('ascii', errors='replace').strip()
+				if line:
+					self.__receive(line)
+		return len(data)
+
+	def read(self, size: int = 1) -> bytes:
+		"""
+		Reads up to size bytes, waits at most ``timeout`` virtual seconds for the first byte.
+
+		:param size: Maximum number of bytes
+		:type size: int, optional
+		:return: Bytes sent by Marlin (empty on timeout)
+		:rtype: bytes
+		"""
+		self.__wait(lambda: len(self.__output) > 0)
+		with self.__lock:
+			data = bytes(self.__output[:size])
+			del self.__output[:size]
+		return data
+
+	def readline(self) -> bytes:
+		"""
+		Reads a line, waits at most ``timeout`` virtual seconds.
+
+		:return: Line sent by Marlin (partial or empty on timeout)
+		:rtype: bytes
+		"""
+		self.__wait(lambda: b'\n' in self.__output)
+		with self.__lock:
+			end = self.__output.find(b'\n') + 1 or len(self.__output)
+			data = bytes(self.__output[:end])
+			del self.__output[:end]
+		return data
+
+	def flush(self) -> None:
+		pass
+
+	def reset_input_buffer(self) -> None:
+		"""
+		Discards everything Marlin sent but the host did not read yet.
+
+		:return: None
+		:rtype: None
+		"""
+		with self.__lock:
+			self.__run()
+			self.__output.clear()
+
+	def close(self) -> None:
+		self.is_open = False
+
+	def actual_position(self) -> tuple[float, float, float]:
+		"""
+		Position of the tool at the current virtual time, interpolated linearly within the move in progress.
+
+		:return: x, y, z in mm
+		:rtype: tuple[float, float, float]
+		"""
+		with self.__lock:
+			now = self.clock.time()
+			self.__retire(now)
+			if not self.__blocks:
+				return tuple(self.position)
+			block = self.__blocks[0]
+			if now <= block.start_time:
+				return tuple(block.start)
+			share = (now - block.start_time) / (block.end_time - block.start_time)
+			return tuple(s + (e - s) * share for s, e in zip(block.start, block.end))
+
+	def __wait(self, ready) -> None:
+		# advances the simulation until ready() or the read timeout, sleeping on the virtual clock until the next event
+		deadline = self.clock.time() + self.timeout
+		while True:
+			with self.__lock:
+				wake = self.__run()
+				if ready():
+					return
+			now = self.clock.time()
+			if now >= deadline:
+				return
+			self.clock.sleep(min(wake if wake is not None else deadline, deadline) - now)
+
+	def __receive(self, line: str) -> None:
+		# line numbers and checksums are verified on reception, like the Marlin command queue does
+		if ';' in line:
+			line = line.split(';', 1)[0].strip()
+		numbered = _NUMBERED_LINE.match(line)
+		if numbered:
+			number, command, cs = int(numbered.group(1)), numbered.group(2).strip(), int(numbered.group(3))
+			text = line[:line.rindex('*')]
+			if checksum(text) != cs:
+				self.__reject(f"checksum mismatch, Last Line: {self.__line_number}")
+				return
+			if command.startswith('M110'):
+				self.__line_number = number
+			elif number != self.__line_number + 1:
+				self.__reject(f"Line Number is not Last Line Number+1, Last Line: {self.__line_number}")
+				return
+			else:
+				self.__line_number = number
+			line = command
+		elif line.startswith('N'):
+			self.__reject(f"No Checksum with line number, Last Line: {self.__line_number}")
+			return
+		if line:
+			self.__commands.append(_Command(line.upper()))
+
+	def __reject(self, error: str) -> None:
+		self.__commands.append(_Command('', error=f"Error:{error}\nResend: {self.__line_number + 1}\n"))
+
+	def __retire(self, now: float) -> None:
+		while self.__blocks and self.__blocks[0].end_time <= now:
+			self.__blocks.popleft()
+
+	def __run(self) -> float or None:
+		"""
+		Executes commands until one has to wait.
+
+		:return: Virtual time of the next event (end of a wait or keepalive), None if idle
+		:rtype: float or None
+		"""
+		now = self.clock.time()
+		self.__retire(now)
+		while self.__commands:
+			command = self.__commands[0]
+			if self.halted:
+				self.__commands.clear()
+				return None
+			wake = self.__execute(command, now)
+			if wake is not None:
+				if self.__keepalive_at is None:
+					self.__keepalive_at = now + self.keepalive_interval
+				while self.__keepalive_at <= now:
+					self.__output += BUSY_MSG
+					self.__keepalive_at += self.keepalive_interval
+				return min(wake, self.__keepalive_at)
+			self.__commands.popleft()
+			self.__keepalive_at = None
+			self.__ok()
+		return None
+
+	def __ok(self) -> None:
+		if self.advanced_ok:
+			free_blocks = self.planner_size - len(self.__blocks)
+			free_commands = BUFSIZE - min(len(self.__commands), BUFSIZE)
+			self.__output += f"ok N{self.__line_number} P{free_blocks} B{free_commands}\n".encode()
+		else:
+			self.__output += OK_MSG
+
+	def __reply(self, text: str) -> None:
+		self.__output += (text + '\n').encode()
+
+	def __execute(self, command: _Command, now: float) -> float or None:
+		"""
+		Executes a command at virtual time now.
+
+		:return: None if the command is completed, otherwise the virtual time it can continue
+		:rtype: float or None
+		"""
+		code, words = command.code, command.words
+		if command.error is not None:
+			self.__output += command.error.encode()
+		elif code in ('G0', 'G1'):
+			return self.__move(words, now)
+		elif code in ('G4', 'G28', 'M400'):
+			# like planner.synchronize(), wait for the last move
+			if self.__blocks:
+				return self.__blocks[-1].end_time
+			if command.ready_at is None:
+				command.ready_at = now + self.__wait_time(code, words)
+			if now < command.ready_at:
+				return command.ready_at
+		elif code in ('G20', 'G21'):
+			self.inches = code == 'G20'
+		elif code in ('G90', 'G91'):
+			self.relative = code == 'G91'
+		elif code == 'G92':
+			for axis, letter in enumerate('XYZ'):
+				if letter in words:
+					self.position[axis] = self.__millimetres(words[letter])
+		elif code == 'M114':
+			x, y, z = (p / 25.4 if self.inches else p for p in self.position)
+			counts = (round(p * s) for p, s in zip(self.position, STEPS_PER_UNIT))
+			self.__reply("X:{:.2f} Y:{:.2f} Z:{:.2f} E:0.00 Count X:{} Y:{} Z:{}".format(x, y, z, *counts))
+		elif code == 'M220':
+			if 'S' in words:
+				self.feedrate_percent = int(float(words['S']))
+			else:
+				self.__reply(f"FR:{self.feedrate_percent}%")
+		elif code in ('M201', 'M203', 'M204', 'M205'):
+			self.motion.update(command.line)
+		elif code == 'M503':
+			self.__reply_settings()
+		elif code == 'M410':
+			# quick stop: moves are discarded, the position is where the tool stopped
+			self.position = list(self.actual_position())
+			self.__blocks.clear()
+		elif code == 'M112':
+			self.__blocks.clear()
+			self.halted = True
+			self.__reply("Error:Printer halted. kill() called!")
+		elif code not in ('M17', 'M18', 'M73', 'M84', 'M110', 'M113', 'M117', 'M510', 'M511', 'M512'):
+			self.__reply(f'echo:Unknown command: "{command.line}"')
+		return None
+
+	def __wait_time(self, code: str, words: dict) -> float:
+		# duration of a dwell or homing, after the planner ran empty
+		if code == 'G4':
+			return float(words['S'] or 0) if 'S' in words else float(words.get('P') or 0) / 1000.0
+		if code == 'G28':
+			axes = [i for i, letter in enumerate('XYZ') if letter in words] or [0, 1, 2]
+			if 'O' in words and self.homed:
+				return 0.0
+			duration = max(abs(self.position[axis]) for axis in axes) / HOMING_FEEDRATE
+			for axis in axes:
+				self.position[axis] = 0.0
+			self.homed = self.homed or len(axes) == 3
+			return duration
+		return 0.0
+
+	def __move(self, words: dict, now: float) -> float or None:
+		if len(self.__blocks) >= self.planner_size:
+			# planner buffer full, wait for the move in progress
+			return self.__blocks[0].end_time
+		if words.get('F'):
+			self.feedrate = self.__millimetres(words['F'])
+		target = list(self.position)
+		for axis, letter in enumerate('XYZ'):
+			if words.get(letter):
+				value = self.__millimetres(words[letter])
+				target[axis] = target[axis] + value if self.relative else value
+		if target == self.position:
+			return None
+		feedrate = self.feedrate * self.feedrate_percent / 100.0 if self.feedrate else None
+		duration = self.motion.estimate([target], feedrate=feedrate, start=self.position, stop=True)
+		start_time = max(now, self.__blocks[-1].end_time) if self.__blocks else now
+		self.__blocks.append(_Block(start_time, start_time + duration, tuple(self.position), tuple(target)))
+		self.position = target
+		self.moves += 1
+		return None
+
+	def __millimetres(self, value: str) -> float:
+		value = float(value or 0)
+		return value * 25.4 if self.inches else value
+
+	def __reply_settings(self) -> None:
+		m = self.motion
+		self.__reply("echo:; Maximum feedrates (units/s):")
+		self.__reply("echo:  M203 X{:.2f} Y{:.2f} Z{:.2f}".format(*m.max_feedrate))
+		self.__reply("echo:; Maximum Acceleration (units/s2):")
+		self.__reply("echo:  M201 X{:.2f} Y{:.2f} Z{:.2f}".format(*m.max_acceleration))
+		self.__reply("echo:; Acceleration (units/s2) (P<print-accel> R<retract-accel> T<travel-accel>):")
+		self.__reply("echo:  M204 P{0:.2f} R{0:.2f} T{0:.2f}".format(m.acceleration))
+		self.__reply("echo:; Advanced (J<junc_dev>):")
+		self.__reply("echo:  M205 J{:.3f}".format(m.junction_deviation))
+
+
+class PtySimulator:
+	"""
+	Serves a :class:`MarlinSimulator` on a pseudo-terminal, so programs can open it like a real serial port
+	(e.g.: ``MarlinSerial(PtySimulator().start())``). POSIX only.
+
+	:param simulator: Simulated Marlin, a new one by default
+	:type simulator: MarlinSimulator, optional
+	"""
+
+	def __init__(self, simulator: MarlinSimulator = None):
+		self._log = logging.getLogger(__name__)
+		self.simulator = simulator if simulator is not None else MarlinSimulator()
+		self.port = None
+		self.__master = None
+		self.__slave = None
+		self.__stop = threading.Event()
+		self.__threads = []
+
+	def start(self) -> str:
+		"""
+		Opens the pseudo-terminal and starts serving.
+
+		:return: Path of the serial port (e.g.: '/dev/pts/3')
+		:rtype: str
+		"""
+		import pty
+		import tty
+
+		self.__master, self.__slave = pty.openpty()
+		tty.setraw(self.__slave)
+		self.port = os.ttyname(self.__slave)
+		self.__stop.clear()
+		self.__threads = [
+			threading.Thread(target=self.__receive, name='marlin-simulator-rx', daemon=True),
+			threading.Thread(target=self.__send, name='marlin-simulator-tx', daemon=True),
+		]
+		for thread in self.__threads:
+			thread.start()
+		self._log.info(f"Simulated Marlin on {self.port}")
+		return self.port
+
+	def stop(self) -> None:
+		"""
+		Stops serving and closes the pseudo-terminal.
+
+		:return: None
+		:rtype: None
+		"""
+		self.__stop.set()
+		for fd in (self.__slave, self.__master):
+			if fd is not None:
+				os.close(fd)
+		self.__master = self.__slave = None
+
+	def __receive(self) -> None:
+		while not self.__stop.is_set():
+			try:
+				data = os.read(self.__master, 4096)
+			except OSError:
+				return
+			if not data:
+				return
+			self.simulator.write(data)
+
+	def __send(self) -> None:
+		while not self.__stop.is_set():
+			line = self.simulator.readline()
+			if not line:
+				# idle, do not spin on a clock without speed
+				time.sleep(0.001)
+				continue
+			try:
+				os.write(self.__master, line)
+			except OSError:
+				return
+
+
+class FakeEncoderBoard:
+	"""
+	Emulates LS7366R encoder counters on the SPI bus and the GPIO chip select pins of the bridge, counting the
+	position of a :class:`MarlinSimulator`. :meth:`install` registers it as the ``spidev`` and ``RPi.GPIO`` modules,
+	so :class:`openxyz.encoder.LS7366R` runs unchanged without a Raspberry Pi.
+
+	:param simulator: Simulated Marlin whose tool position is counted
+	:type simulator: MarlinSimulator
+	:param cs_pins: Chip select pin of every axis index (0: x, 1: y, 2: z)
+	:type cs_pins: dict, optional
+	:param counts_per_mm: Encoder resolution in counts per mm
+	:type counts_per_mm: float, optional
+	"""
+
+	BCM = 11
+	BOARD = 10
+	OUT = 0
+	IN = 1
+
+	def __init__(self, simulator: MarlinSimulator, cs_pins: dict = None, counts_per_mm: float = ENCODER_COUNTS_PER_MM):
+		self.simulator = simulator
+		self.counts_per_mm = counts_per_mm
+		self.__chips = {pin: _FakeLS7366R(self, axis) for pin, axis in (cs_pins or {23: 0, 24: 1}).items()}
+		self.__levels = {pin: True for pin in self.__chips}
+
+	def count(self, axis: int) -> int:
+		"""
+		:return: Position of an axis in counts
+		:rtype: int
+		"""
+		return round(self.simulator.actual_position()[axis] * self.counts_per_mm)
+
+	def install(self) -> None:
+		"""
+		Registers the board as ``spidev`` and ``RPi.GPIO`` modules (sys.modules), has to be called before
+		:mod:`openxyz.encoder` is imported.
+
+		:return: None
+		:rtype: None
+		"""
+		import sys
+		import types
+
+		spidev = types.ModuleType('spidev')
+		spidev.SpiDev = lambda: _FakeSpiDev(self)
+		gpio = types.ModuleType('RPi.GPIO')
+		for name in ('BCM', 'BOARD', 'OUT', 'IN', 'setmode', 'setup', 'output', 'cleanup', 'setwarnings'):
+			setattr(gpio, name, getattr(self, name))
+		rpi = types.ModuleType('RPi')
+		rpi.GPIO = gpio
+		sys.modules.update({'spidev': spidev, 'RPi': rpi, 'RPi.GPIO': gpio})
+
+	# RPi.GPIO functions
+	def setmode(self, mode: int) -> None:
+		pass
+
+	def setwarnings(self, enabled: bool) -> None:
+		pass
+
+	def setup(self, pin, direction: int) -> None:
+		pass
+
+	def output(self, pins, level) -> None:
+		for pin in (pins if isinstance(pins, (list, tuple)) else [pins]):
+			self.__levels[pin] = bool(level)
+
+	def cleanup(self) -> None:
+		pass
+
+	def transfer(self, data: list) -> list:
+		# chip select is active low, every selected chip receives the bytes, the first one drives MISO
+		selected = [chip for pin, chip in self.__chips.items() if not self.__levels[pin]]
+		response = [0] * len(data)
+		for i, chip in enumerate(selected):
+			answer = chip.transfer(data)
+			if i == 0:
+				response = answer
+		return response
+
+	def read(self, length: int) -> list:
+		selected = [chip for pin, chip in self.__chips.items() if not self.__levels[pin]]
+		return selected[0].read(length) if selected else [0] * length
+
+
+class _FakeSpiDev:
+	"""
+	spidev.SpiDev of a :class:`FakeEncoderBoard`.
+	"""
+
+	def __init__(self, board: FakeEncoderBoard):
+		self.__board = board
+		self.no_cs = False
+		self.max_speed_hz = 0
+		self.mode = 0
+
+	def open(self, bus: int, device: int) -> None:
+		pass
+
+	def close(self) -> None:
+		pass
+
+	def xfer2(self, data: list) -> list:
+		return self.__board.transfer(list(data))
+
+	def writebytes(self, data: list) -> None:
+		self.__board.transfer(list(data))
+
+	def readbytes(self, length: int) -> list:
+		return self.__board.read(length)
+
+
+class _FakeLS7366R:
+	"""
+	Registers and opcodes of one LS7366R (see :class:`openxyz.encoder.Opcode`).
+	"""
+
+	def __init__(self, board: FakeEncoderBoard, axis: int):
+		self.__board = board
+		self.__axis = axis
+		self.__mdr0 = 0
+		self.__mdr1 = 0
+		self.__dtr = 0
+		self.__otr = 0
+		self.__str = 0
+		# count of the board at which the counter was zero
+		self.__zero = 0
+		self.__pending = []
+
+	def __width(self) -> int:
+		# MDR1 bits 0-1: 0 for 4 bytes, 1 for 3 bytes, 2 for 2 bytes, 3 for 1 byte
+		return 4 - (self.__mdr1 & 0x03)
+
+	def __counter(self) -> int:
+		return (self.__board.count(self.__axis) - self.__zero) % (1 << (8 * self.__width()))
+
+	def transfer(self, data: list) -> list:
+		opcode, payload = data[0], data[1:]
+		self.__pending = []
+		if opcode == 0x08:
+			self.__mdr0 = 0
+		elif opcode == 0x10:
+			self.__mdr1 = 0
+		elif opcode == 0x20:
+			self.__zero = self.__board.count(self.__axis)
+		elif opcode == 0x30:
+			self.__str = 0
+		elif opcode == 0x88 and payload:
+			self.__mdr0 = payload[0]
+		elif opcode == 0x90 and payload:
+			self.__mdr1 = payload[0]
+		elif opcode == 0x98:
+			self.__dtr = int.from_bytes(bytes(payload), 'big')
+		elif opcode == 0xE0:
+			self.__zero = self.__board.count(self.__axis) - self.__dtr
+		elif opcode == 0xE4:
+			self.__otr = self.__counter()
+		else:
+			# read opcodes answer during the transfer (xfer2) or with the next readbytes
+			registers = {0x48: [self.__mdr0], 0x50: [self.__mdr1], 0x70: [self.__str]}
+			if opcode == 0x60:
+				self.__pending = list(self.__counter().to_bytes(self.__width(), 'big'))
+			elif opcode == 0x68:
+				self.__pending = list(self.__otr.to_bytes(self.__width(), 'big'))
+			else:
+				self.__pending = registers.get(opcode, [])
+			response = [0] + self.__pending[:len(payload)]
+			return response + [0] * (len(data) - len(response))
+		return [0] * len(data)
+
+	def read(self, length: int) -> list:
+		data, self.__pending = self.__pending[:length], self.__pending[length:]
+		return data + [0] * (length - len(data))
+
+
+if __name__ == "__main__":
+	# serves a simulated Marlin in real time, e.g. for rpi.py
+	logging.basicConfig(level=logging.INFO)
+	server = PtySimulator(MarlinSimulator(clock=VirtualClock(speed=1.0)))
+	print(server.start())
+	try:
+		threading.Event().wait()
+	except KeyboardInterrupt:
+		server.stop()
@@ -0,0 +1,210 @@
+import math
+import numpy as np
+
+
+class GridIndex:
+	"""
+	Uniform grid over 2-D points for nearest neighbour queries.
+
+	Points are bucketed into square cells, sorted by cell, so the points of a cell are a contiguous slice of
+	:attr:`order`. The default cell size holds about two points per cell.
+
+	:param points: (n, 2) array of x, y coordinates
+	:type points: np.ndarray
+	:param cell_size: Edge length of a cell, derived from the point density if None
+	:type cell_size: float, optional
+	"""
+
+	def __init__(self, points: np.ndarray, cell_size: float = None):
+		self.points = np.ascontiguousarray(points, dtype=np.float64)[:, :2]
+		n = len(self.points)
+		self.origin = self.points.min(axis=0) if n else np.zeros(2)
+		extent = (self.points.max(axis=0) - self.origin) if n else np.zeros(2)
+		if cell_size is None:
+			area = max(extent[0], 1e-9) * max(extent[1], 1e-9)
+			cell_size = math.sqrt(2.0 * area / max(n, 1))
+			if extent.min() <= 1e-9:
+				# points on a line
+				cell_size = 2.0 * max(extent.max(), 1e-9) / max(n, 1)
+		self.cell_size = max(float(cell_size), 1e-9)
+		self.shape = (np.floor(extent / self.cell_size).astype(np.int64) + 1)
+
+		cells = self.cells_of(self.points)
+		keys = cells[:, 0] * self.shape[1] + cells[:, 1]
+		self.order = np.argsort(keys, kind='stable')
+		sorted_keys = keys[self.order]
+		all_keys = np.arange(self.shape[0] * self.shape[1] + 1)
+		self.__starts = np.searchsorted(sorted_keys, all_keys)
+
+	def cells_of(self, points: np.ndarray) -> np.ndarray:
+		"""
+		:param points: (n, 2) array of x, y coordinates
+		:type points: np.ndarray
+		:return: (n, 2) array of cell indices, clipped to the grid
+		:rtype: np.ndarray
+		"""
+		cells = np.floor((np.asarray(points, dtype=np.float64)[..., :2] - self.origin) / self.cell_size).astype(np.int64)
+		return np.clip(cells, 0, self.shape - 1)
+
+	def cell(self, cx: int, cy: int) -> np.ndarray:
+		"""
+		:return: Indices of the points in a cell (empty if the cell is outside of the grid)
+		:rtype: np.ndarray
+		"""
+		if not (0 <= cx < self.shape[0] and 0 <= cy < self.shape[1]):
+			return self.order[:0]
+		key = cx * self.shape[1] + cy
+		return self.order[self.__starts[key]:self.__starts[key + 1]]
+
+	def ring(self, cx: int, cy: int, r: int) -> np.ndarray:
+		"""
+		:return: Indices of the points in all cells at Chebyshev cell distance r from (cx, cy)
+		:rtype: np.ndarray
+		"""
+		if r == 0:
+			return self.cell(cx, cy)
+		parts = []
+		x0, x1 = max(cx - r, 0), min(cx + r, self.shape[0] - 1)
+		for x in range(x0, x1 + 1):
+			if x == cx - r or x == cx + r:
+				ys = range(max(cy - r, 0), min(cy + r, self.shape[1] - 1) + 1)
+			else:
+				ys = [y for y in (cy - r, cy + r) if 0 <= y < self.shape[1]]
+			for y in ys:
+				key = x * self.shape[1] + y
+				start, stop = self.__starts[key], self.__starts[key + 1]
+				if stop > start:
+					parts.append(self.order[start:stop])
+		if not parts:
+			return self.order[:0]
+		return np.concatenate(parts)
+
+	def max_ring(self, cx: int, cy: int) -> int:
+		"""
+		:return: Largest ring around (cx, cy) which still intersects the grid
+		:rtype: int
+		"""
+		return int(max(cx, cy, self.shape[0] - 1 - cx, self.shape[1] - 1 - cy))
+
+	def nearest(self, point, k: int = 1) -> np.ndarray:
+		"""
+		Finds the k points closest (euclidean) to a location.
+
+		:param point: x, y location
+		:param k: Number of neighbours
+		:type k: int, optional
+		:return: Indices of the nearest points, closest first
+		:rtype: np.ndarray
+		"""
+		point = np.asarray(point, dtype=np.float64)[:2]
+		k = min(k, len(self.points))
+		if k <= 0:
+			return self.order[:0]
+		cx, cy = self.cells_of(point)
+		candidates = []
+		count = 0
+		for r in range(self.max_ring(cx, cy) + 1):
+			found = self.ring(cx, cy, r)
+			if len(found):
+				candidates.append(found)
+				count += len(found)
+			if count >= k:
+				indices = np.concatenate(candidates)
+				distances = np.hypot(*(self.points[indices] - point).T)
+				kth = np.partition(distances, k - 1)[k - 1]
+				# any point outside of the searched rings is at least r * cell_size away
+				if kth <= r * self.cell_size:
+					break
+		indices = np.concatenate(candidates)
+		distances = np.hypot(*(self.points[indices] - point).T)
+		best = np.argsort(distances, kind='stable')[:k]
+		return indices[best]
+
+	def neighbours(self, k: int, reach: int = 2, capacity: int = 16) -> np.ndarray:
+		"""
+		Finds the k nearest other points of every point.
+
+		Most points are processed at once: cells are padded to the same capacity, so the candidates of every point
+		(all points within ``reach`` cells) form one rectangular array. Points in crowded cells, or whose k-th
+		neighbour may lie outside of that window, are resolved cell by cell.
+
+		:param k: Number of neighbours
+		:type k: int
+		:param reach: Number of cell rings searched in the vectorized pass
+		:type reach: int, optional
+		:param capacity: Maximum number of points per cell in the vectorized pass
+		:type capacity: int, optional
+		:return: (n, k) array of neighbour indices, closest first (-1 if there are fewer than k other points)
+		:rtype: np.ndarray
+		"""
+		n = len(self.points)
+		result = np.full((n, k), -1, dtype=np.int64)
+		m = min(k, n - 1)
+		if m <= 0:
+			return result
+
+		counts = np.diff(self.__starts)
+		n_cells = len(counts)
+		capacity = int(min(capacity, counts.max()))
+		crowded = counts > capacity
+
+		# (cells + 1, capacity) table of point indices, the extra last row is an empty cell for lookups outside the grid
+		table = np.full((n_cells + 1, capacity), -1, dtype=np.int64)
+		cell_of_sorted = np.repeat(np.arange(n_cells), counts)
+		slot = np.arange(n) - self.__starts[cell_of_sorted]
+		fits = ~crowded[cell_of_sorted]
+		table[cell_of_sorted[fits], slot[fits]] = self.order[fits]
+
+		cells = self.cells_of(self.points)
+		offsets = np.arange(-reach, reach + 1)
+		nx = cells[:, 0:1] + np.repeat(offsets, len(offsets))[None, :]
+		ny = cells[:, 1:2] + np.tile(offsets, len(offsets))[None, :]
+		inside = (nx >= 0) & (nx < self.shape[0]) & (ny >= 0) & (ny < self.shape[1])
+		keys = np.where(inside, nx * self.shape[1] + ny, n_cells)
+		touches_crowded = np.append(crowded, False)[keys].any(axis=1)
+		candidates = table[keys].reshape(n, -1)
+
+		valid = candidates >= 0
+		safe = np.where(valid, candidates, 0)
+		x, y = self.points[:, 0], self.points[:, 1]
+		# squared distances, the order is the same
+		distances = np.square(x[safe] - x[:, None]) + np.square(y[safe] - y[:, None])
+		distances[~valid | (candidates == np.arange(n)[:, None])] = np.inf
+		if m < distances.shape[1]:
+			best = np.argpartition(distances, m - 1, axis=1)[:, :m]
+		else:
+			best = np.argsort(distances, axis=1)[:, :m]
+		best_distances = np.take_along_axis(distances, best, axis=1)
+		order = np.argsort(best_distances, axis=1, kind='stable')
+		best = np.take_along_axis(best, order, axis=1)
+		best_distances = np.take_along_axis(best_distances, order, axis=1)
+		result[:, :m] = np.take_along_axis(candidates, best, axis=1)
+
+		# the window provably contains every point closer than reach cells
+		unresolved = ~(best_distances[:, -1] <= (reach * self.cell_size) ** 2) | touches_crowded
+		unresolved_keys = np.unique(cells[unresolved, 0] * self.shape[1] + cells[unresolved, 1])
+		for key in unresolved_keys:
+			cx, cy = divmod(int(key), int(self.shape[1]))
+			members = self.cell(cx, cy)
+			members = members[unresolved[members]]
+			self.__cell_neighbours(cx, cy, members, m, result)
+		return result
+
+	def __cell_neighbours(self, cx: int, cy: int, members: np.ndarray, m: int, result: np.ndarray) -> None:
+		parts = [self.cell(cx, cy)]
+		r = 0
+		# grow the searched neighbourhood until the m-th neighbour of every member is provably inside
+		while True:
+			r += 1
+			parts.append(self.ring(cx, cy, r))
+			candidates = np.concatenate(parts)
+			if len(candidates) <= m and r <= self.max_ring(cx, cy):
+				continue
+			delta = self.points[members][:, None, :] - self.points[candidates][None, :, :]
+			distances = np.hypot(delta[..., 0], delta[..., 1])
+			distances[members[:, None] == candidates[None, :]] = np.inf
+			order = np.argsort(distances, axis=1, kind='stable')[:, :m]
+			kth = np.take_along_axis(distances, order[:, -1:], axis=1).max()
+			if kth <= r * self.cell_size or r > self.max_ring(cx, cy):
+				break
+		result[members, :m] = candidates[order]
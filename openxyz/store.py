@@ -0,0 +1,493 @@
+import bisect
+import json
+import logging
+import mmap
+import os
+import pickle
+import struct
+import zlib
+from typing import Any, Iterator, Sequence
+
+import numpy as np
+
+STORE_EXTENSION = '.oxyz'
+VERSION = 1
+MAGIC = b'OXYZSTOR'
+CHUNK_MAGIC = b'OXYZCHNK'
+FOOTER_MAGIC = b'OXYZINDX'
+# payloads start at multiples of ALIGNMENT, so memory-mapped arrays are aligned
+ALIGNMENT = 64
+_LENGTH = struct.Struct('<Q')
+
+
+class ScanStore:
+	"""
+	Chunked, columnar store of scan results.
+
+	Rows are (coordinate, data) pairs as produced by a scan. Coordinates are stored as fixed-width float64 arrays, all
+	rows have the (x, y) or (x, y, z) axes of the first one. If
+	data is a dict, every key becomes a column, otherwise the data forms the single column 'data'. Per chunk, a
+	column of numbers or equally shaped numeric arrays (e.g.: scope traces) is stored as one contiguous array,
+	anything else as pickled objects.
+
+	File layout::
+
+		MAGIC
+		chunk record: CHUNK_MAGIC, header length (uint64), JSON header, aligned column blocks (optionally zlib)
+		...
+		footer: JSON index of all chunks, footer length (uint64), FOOTER_MAGIC
+
+	The footer is rewritten after every chunk. A file without valid footer (e.g.: the scan was killed) is recovered
+	from the chunk headers, an incomplete trailing chunk is dropped.
+
+	Rows are buffered and written every ``chunk_size`` rows and on :meth:`flush`, only written rows can be read.
+	The store can be used as sink of :class:`openxyz.scan.ScanExecutor` and :meth:`openxyz.xyz_stage.Stage.scan`.
+
+	:param filename: Path of the store (conventionally ending with STORE_EXTENSION)
+	:type filename: str
+	:param mode: 'r' to read, 'w' to create (overwrites), 'a' to append (creates the store if it does not exist)
+	:type mode: str, optional
+	:param chunk_size: Number of rows per chunk
+	:type chunk_size: int, optional
+	:param compression: None or 'zlib'
+	:type compression: str, optional
+	:param compression_level: zlib compression level
+	:type compression_level: int, optional
+	"""
+
+	def __init__(self, filename: str, mode: str = 'r', chunk_size: int = 1024, compression: str = None,
+				 compression_level: int = 1):
+		if mode not in ('r', 'w', 'a'):
+			raise ValueError(f"Invalid mode '{mode}'")
+		if compression not in (None, 'zlib'):
+			raise ValueError(f"Unsupported compression '{compression}'")
+		self._log = logging.getLogger(__name__)
+		self.filename = filename
+		self.mode = mode
+		self.chunk_size = chunk_size
+		self.compression = compression
+		self.compression_level = compression_level
+		self.layout = None  # 'dict' or 'value', fixed by the first row
+		self.names = []  # data columns in order of appearance
+		self.dimension = None  # number of coordinate axes, fixed by the first row
+		self.__chunks = []
+		self.__starts = []
+		self.__rows = 0
+		self.__pending = []
+		self.__mmap = None
+		self.__decoded = {}
+
+		if mode == 'w' or (mode == 'a' and not os.path.exists(filename)):
+			self.__file = open(filename, 'w+b')
+			self.__file.write(MAGIC)
+			self.__end = len(MAGIC)
+			self.__write_footer()
+		else:
+			self.__file = open(filename, 'rb' if mode == 'r' else 'r+b')
+			self.__load_index()
+			if mode == 'a':
+				# new chunks replace the footer
+				self.__file.truncate(self.__end)
+				self.__write_footer()
+
+	def __len__(self) -> int:
+		return self.__rows
+
+	@property
+	def pending(self) -> int:
+		"""
+		:return: Number of appended rows which are not written yet
+		:rtype: int
+		"""
+		return len(self.__pending)
+
+	@property
+	def position(self) -> int:
+		"""
+		:return: Number of appended rows including the pending ones, the position a :meth:`truncate` can restore
+		:rtype: int
+		"""
+		return self.__rows + len(self.__pending)
+
+	def truncate(self, rows: int) -> None:
+		"""
+		Drops all rows after the first ``rows`` (e.g.: results which are not recorded in the scan journal).
+
+		:param rows: Number of rows to keep
+		:type rows: int
+		:return: None
+		:rtype: None
+		"""
+		if self.mode == 'r':
+			raise IOError(f"{self.filename} is opened read-only")
+		if rows >= self.__rows:
+			del self.__pending[rows - self.__rows:]
+			return
+		self.__pending = []
+		first = bisect.bisect_right(self.__starts, rows) - 1
+		# rows of the cut chunk are written again as a new chunk, copied before the mapping is dropped
+		kept = [(coordinate, _detach(data)) for coordinate, data in
+				(self[index] for index in range(self.__starts[first], rows))]
+		self.__end = self.__chunks[first]["record"]
+		self.__rows = self.__starts[first]
+		del self.__chunks[first:]
+		del self.__starts[first:]
+		if self.__mmap is not None:
+			try:
+				self.__mmap.close()
+			except BufferError:
+				pass
+		self.__drop_mapping()
+		self.__file.truncate(self.__end)
+		self.__pending = kept
+		if self.__pending:
+			self.__write_chunk()
+		self.__write_footer()
+
+	def append(self, coordinate: Sequence, data: Any) -> None:
+		"""
+		Appends the result of one point.
+
+		:param coordinate: Coordinate of the point
+		:type coordinate: Sequence
+		:param data: Measurement data
+		:type data: Any
+		:return: None
+		:rtype: None
+		:raises ValueError: If the coordinate is not numeric or has another number of axes than the stored rows
+		"""
+		if self.mode == 'r':
+			raise IOError(f"{self.filename} is opened read-only")
+		coordinate = tuple(float(v) for v in coordinate)
+		if self.dimension is None:
+			self.dimension = len(coordinate)
+		elif len(coordinate) != self.dimension:
+			raise ValueError(f"Coordinate {coordinate} has {len(coordinate)} axes, the rows of {self.filename} have "
+							 f"{self.dimension}")
+		if self.layout is None:
+			self.layout = 'dict' if isinstance(data, dict) else 'value'
+		self.__pending.append((coordinate, data))
+		if len(self.__pending) >= self.chunk_size:
+			self.__write_chunk()
+			self.__write_footer()
+
+	def flush(self) -> None:
+		"""
+		Writes buffered rows and the index to disk.
+
+		:return: None
+		:rtype: None
+		"""
+		if self.mode == 'r':
+			return
+		if self.__pending:
+			self.__write_chunk()
+			self.__write_footer()
+		self.__file.flush()
+
+	def sync(self) -> None:
+		"""
+		Writes buffered rows and the index and waits until they are on disk (fsync).
+
+		:return: None
+		:rtype: None
+		"""
+		self.flush()
+		if self.mode != 'r':
+			os.fsync(self.__file.fileno())
+
+	def close(self) -> None:
+		"""
+		Writes buffered rows and closes the store.
+
+		:return: None
+		:rtype: None
+		"""
+		if self.__file.closed:
+			return
+		self.flush()
+		self.__decoded.clear()
+		if self.__mmap is not None:
+			try:
+				self.__mmap.close()
+			except BufferError:
+				# arrays returned by column() still reference the mapping, it is closed once they are released
+				pass
+			self.__mmap = None
+		self.__file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+	@property
+	def coordinates(self) -> np.ndarray:
+		"""
+		:return: (n, 2) or (n, 3) coordinates of all written rows
+		:rtype: np.ndarray
+		"""
+		return self.column('coordinate')
+
+	def column(self, name: str, start: int = 0, stop: int = None) -> np.ndarray or list:
+		"""
+		Reads a column of the written rows. Uncompressed array blocks are memory-mapped; if the rows lie within a
+		single chunk, the result is a view of the file and no data is copied.
+
+		:param name: Name of the column ('coordinate' for the coordinates)
+		:type name: str
+		:param start: First row
+		:type start: int, optional
+		:param stop: End row (exclusive), defaults to the number of rows
+		:type stop: int, optional
+		:return: Array of the rows, or a list if the column holds objects
+		:rtype: np.ndarray or list
+		"""
+		start, stop, _ = slice(start, stop).indices(self.__rows)
+		parts = []
+		first = max(bisect.bisect_right(self.__starts, start) - 1, 0)
+		for index in range(first, len(self.__chunks)):
+			chunk_start = self.__starts[index]
+			if chunk_start >= stop:
+				break
+			values = self.__block(index, name)
+			parts.append(values[max(start - chunk_start, 0):stop - chunk_start])
+		if not parts:
+			return np.zeros((0,))
+		if all(isinstance(part, np.ndarray) for part in parts):
+			if len(parts) == 1:
+				return parts[0]
+			if len(set(part.shape[1:] for part in parts)) == 1:
+				return np.concatenate(parts)
+		return [value for part in parts for value in part]
+
+	def chunks(self, name: str) -> Iterator[np.ndarray or list]:
+		"""
+		Iterates over a column chunk by chunk, without concatenating (and copying) memory-mapped blocks.
+
+		:param name: Name of the column ('coordinate' for the coordinates)
+		:type name: str
+		:return: Iterator of the column values of every chunk
+		:rtype: Iterator[np.ndarray or list]
+		"""
+		for index in range(len(self.__chunks)):
+			yield self.__block(index, name)
+
+	def __getitem__(self, index: int) -> tuple:
+		"""
+		:return: (coordinate, data) of a written row, as it was appended (arrays may be memory-mapped views)
+		:rtype: tuple
+		"""
+		if index < 0:
+			index += self.__rows
+		if not 0 <= index < self.__rows:
+			raise IndexError(f"Row {index} out of range")
+		chunk = bisect.bisect_right(self.__starts, index) - 1
+		offset = index - self.__starts[chunk]
+		coordinate = tuple(self.__block(chunk, 'coordinate')[offset].tolist())
+		values = {name: self.__value(self.__block(chunk, name)[offset])
+				  for name in self.__chunks[chunk]["columns"]}
+		if self.layout == 'dict':
+			return coordinate, values
+		return coordinate, values.get('data')
+
+	def __iter__(self):
+		for index in range(self.__rows):
+			yield self[index]
+
+	@staticmethod
+	def __value(value):
+		# numbers of array blocks are read back as Python numbers
+		if isinstance(value, np.generic) or (isinstance(value, np.ndarray) and value.ndim == 0):
+			return value.item()
+		return value
+
+	def __write_chunk(self) -> None:
+		rows, self.__pending = self.__pending, []
+		coordinates = np.array([coordinate for coordinate, _ in rows], dtype=np.float64).reshape(len(rows), self.dimension)
+		if self.layout == 'dict':
+			columns = {}
+			for _, data in rows:
+				if isinstance(data, dict):
+					for name in data:
+						columns.setdefault(name, None)
+			for name in columns:
+				columns[name] = [data.get(name) if isinstance(data, dict) else None for _, data in rows]
+		else:
+			columns = {'data': [data for _, data in rows]}
+		for name in columns:
+			if name not in self.names:
+				self.names.append(name)
+
+		payloads = []
+		position = 0
+
+		def add(raw: bytes, block: dict) -> dict:
+			nonlocal position
+			data = zlib.compress(raw, self.compression_level) if self.compression else raw
+			position = _align(position)
+			block.update(offset=position, length=len(data), raw_length=len(raw), compression=self.compression)
+			payloads.append((position, data))
+			position += len(data)
+			return block
+
+		header = {
+			"rows": len(rows),
+			"coordinate": add(coordinates.tobytes(), {"kind": "array", "dtype": coordinates.dtype.str,
+													  "shape": list(coordinates.shape[1:])}),
+			"columns": {name: add(*_encode(values)) for name, values in columns.items()},
+		}
+		encoded = json.dumps(header, separators=(',', ':')).encode()
+
+		record = self.__end
+		self.__file.seek(record)
+		self.__file.write(CHUNK_MAGIC + _LENGTH.pack(len(encoded)) + encoded)
+		base = _align(record + len(CHUNK_MAGIC) + _LENGTH.size + len(encoded))
+		for offset, data in payloads:
+			self.__file.seek(base + offset)
+			self.__file.write(data)
+		self.__end = base + position
+		self.__file.truncate(self.__end)
+		self.__add_chunk(dict(header, record=record, base=base))
+
+	def __add_chunk(self, chunk: dict) -> None:
+		if self.dimension is None:
+			self.dimension = chunk["coordinate"]["shape"][0]
+		self.__starts.append(self.__rows)
+		self.__chunks.append(chunk)
+		self.__rows += chunk["rows"]
+		self.__drop_mapping()
+
+	def __drop_mapping(self) -> None:
+		# the file grew, map it again on the next read
+		self.__decoded.clear()
+		self.__mmap = None
+
+	def __write_footer(self) -> None:
+		footer = json.dumps({
+			"version": VERSION,
+			"layout": self.layout,
+			"names": self.names,
+			"rows": self.__rows,
+			"chunks": [{"record": c["record"], "base": c["base"], "rows": c["rows"],
+						"coordinate": c["coordinate"], "columns": c["columns"]} for c in self.__chunks],
+		}, separators=(',', ':')).encode()
+		self.__file.seek(self.__end)
+		self.__file.write(footer + _LENGTH.pack(len(footer)) + FOOTER_MAGIC)
+		self.__file.truncate()
+		self.__file.flush()
+
+	def __load_index(self) -> None:
+		if self.__file.read(len(MAGIC)) != MAGIC:
+			raise ValueError(f"{self.filename} is no scan store")
+		size = os.fstat(self.__file.fileno()).st_size
+		tail = len(FOOTER_MAGIC) + _LENGTH.size
+		if size >= len(MAGIC) + tail:
+			self.__file.seek(size - tail)
+			length, magic = _LENGTH.unpack(self.__file.read(_LENGTH.size)), self.__file.read(len(FOOTER_MAGIC))
+			if magic == FOOTER_MAGIC and length[0] <= size - len(MAGIC) - tail:
+				self.__file.seek(size - tail - length[0])
+				try:
+					footer = json.loads(self.__file.read(length[0]))
+				except ValueError:
+					footer = None
+				if footer is not None:
+					self.layout = footer["layout"]
+					self.names = footer["names"]
+					for chunk in footer["chunks"]:
+						self.__add_chunk(chunk)
+					self.__end = size - tail - length[0]
+					return
+		self._log.warning(f"{self.filename} has no valid index, recovering from the chunk headers.")
+		self.__recover(size)
+
+	def __recover(self, size: int) -> None:
+		position = len(MAGIC)
+		while position + len(CHUNK_MAGIC) + _LENGTH.size <= size:
+			self.__file.seek(position)
+			if self.__file.read(len(CHUNK_MAGIC)) != CHUNK_MAGIC:
+				break
+			length = _LENGTH.unpack(self.__file.read(_LENGTH.size))[0]
+			try:
+				header = json.loads(self.__file.read(length))
+			except ValueError:
+				break
+			base = _align(position + len(CHUNK_MAGIC) + _LENGTH.size + length)
+			blocks = [header["coordinate"]] + list(header["columns"].values())
+			end = max(base + block["offset"] + block["length"] for block in blocks)
+			if end > size:
+				break
+			for name in header["columns"]:
+				if name not in self.names:
+					self.names.append(name)
+			if self.layout is None:
+				self.layout = 'value' if list(header["columns"]) == ['data'] else 'dict'
+			self.__add_chunk(dict(header, record=position, base=base))
+			position = end
+		self.__end = position
+
+	def __block(self, index: int, name: str) -> np.ndarray or list:
+		key = (index, name)
+		if key in self.__decoded:
+			return self.__decoded[key]
+		chunk = self.__chunks[index]
+		block = chunk["coordinate"] if name == 'coordinate' else chunk["columns"].get(name)
+		if block is None:
+			if name not in self.names:
+				raise KeyError(f"Unknown column '{name}'")
+			return [None] * chunk["rows"]
+		if self.__mmap is None:
+			self.__file.flush()
+			self.__mmap = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+		start = chunk["base"] + block["offset"]
+		if block["compression"] is None and block["kind"] == "array":
+			values = np.frombuffer(self.__mmap, dtype=np.dtype(block["dtype"]),
+								   count=block["raw_length"] // np.dtype(block["dtype"]).itemsize, offset=start)
+			values = values.reshape([chunk["rows"]] + block["shape"])
+		else:
+			raw = self.__mmap[start:start + block["length"]]
+			if block["compression"] == 'zlib':
+				raw = zlib.decompress(raw)
+			values = _decode(raw, block, chunk["rows"])
+			# keep the last decoded blocks, so reading a chunk row by row decompresses it once
+			if len(self.__decoded) > 16:
+				self.__decoded.clear()
+			self.__decoded[key] = values
+		return values
+
+
+def _detach(data: Any) -> Any:
+	# copies memory-mapped arrays of a row
+	if isinstance(data, dict):
+		return {name: _detach(value) for name, value in data.items()}
+	if isinstance(data, np.ndarray):
+		return np.array(data)
+	return data
+
+
+def _align(position: int) -> int:
+	return -(-position // ALIGNMENT) * ALIGNMENT
+
+
+def _encode(values: list) -> tuple[bytes, dict]:
+	# numbers or equally shaped numeric arrays form one array, anything else is pickled
+	arrays = None
+	if all(isinstance(v, (np.ndarray, np.generic, int, float, complex)) for v in values):
+		candidates = [np.asarray(v) for v in values]
+		if all(c.dtype.kind in 'biufc' for c in candidates) and len(set(c.shape for c in candidates)) == 1:
+			arrays = np.stack(candidates)
+	if arrays is not None:
+		arrays = np.ascontiguousarray(arrays)
+		return arrays.tobytes(), {"kind": "array", "dtype": arrays.dtype.str, "shape": list(arrays.shape[1:])}
+	blobs = [pickle.dumps(v, protocol=pickle.HIGHEST_PROTOCOL) for v in values]
+	offsets = np.concatenate([[0], np.cumsum([len(b) for b in blobs])]).astype('<i8')
+	return offsets.tobytes() + b''.join(blobs), {"kind": "object"}
+
+
+def _decode(raw: bytes, block: dict, rows: int) -> np.ndarray or list:
+	if block["kind"] == "array":
+		return np.frombuffer(raw, dtype=np.dtype(block["dtype"])).reshape([rows] + block["shape"])
+	offsets = np.frombuffer(raw, dtype='<i8', count=rows + 1)
+	base = offsets.nbytes
+	return [pickle.loads(raw[base + offsets[i]:base + offsets[i + 1]]) for i in range(rows)]
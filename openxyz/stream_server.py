@@ -0,0 +1,187 @@
+import json
+import logging
+import socket
+import socketserver
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Tuple
+
+# handlers map an endpoint (e.g.: '/send_gcode') to a callable taking the JSON payload and returning (body, status)
+Handler = Callable[[dict], Tuple[dict, int]]
+
+
+class StreamServer(socketserver.ThreadingTCPServer):
+	"""
+	Persistent, bidirectional TCP channel to the bridge.
+
+	Every connection carries newline delimited JSON messages. Requests mirror the HTTP endpoints of the bridge::
+
+		{"id": 1, "endpoint": "/send_gcode", "payload": {"gcode": "G0 X1"}}
+
+	and are answered with the same body and status code as the HTTP endpoint::
+
+		{"id": 1, "status": 200, "body": {"response": ""}}
+
+	A client may pipeline any number of requests without waiting for the responses. Requests of one connection are
+	executed in the order they were received, except for immediate endpoints (e.g.: '/emergency'), which are executed
+	as soon as they are read. Asynchronous events are pushed as they happen::
+
+		{"event": "busy"}
+		{"event": "encoder", "x": 0, "y": 0}
+		{"event": "error", "id": 1, "message": "..."}
+
+	Encoder events are sent periodically after a client subscribed with
+	``{"id": 2, "endpoint": "subscribe", "payload": {"topic": "encoder", "interval": 0.1}}``.
+
+	:param address: (host, port) to listen on, port 0 picks a free port
+	:type address: Tuple[str, int]
+	:param handlers: Request handlers by endpoint
+	:type handlers: Dict[str, Handler]
+	:param worker: Serial worker whose busy messages are forwarded as events
+	:type worker: openxyz.serial_worker.SerialWorker, optional
+	:param immediate: Endpoints which bypass the ordered request queue of a connection
+	:type immediate: Iterable[str], optional
+	"""
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, address: Tuple[str, int], handlers: Dict[str, Handler], worker=None,
+				 immediate: Iterable[str] = ()):
+		self._log = logging.getLogger(__name__)
+		self.handlers = handlers
+		self.worker = worker
+		self.immediate = set(immediate)
+		self.__thread = None
+		super().__init__(address, _StreamHandler)
+
+	@property
+	def port(self) -> int:
+		"""
+		:return: Port the server is listening on
+		:rtype: int
+		"""
+		return self.server_address[1]
+
+	def start(self) -> None:
+		"""
+		Serves connections from a background thread.
+
+		:return: None
+		:rtype: None
+		"""
+		self.__thread = threading.Thread(target=self.serve_forever, name='stream-server', daemon=True)
+		self.__thread.start()
+		self._log.info(f"Stream server listening on {self.server_address[0]}:{self.port}")
+
+	def stop(self) -> None:
+		"""
+		Stops serving and closes the listening socket.
+
+		:return: None
+		:rtype: None
+		"""
+		self.shutdown()
+		self.server_close()
+
+
+class _StreamHandler(socketserver.StreamRequestHandler):
+	"""
+	Handles a single client connection of the :class:`StreamServer`.
+	"""
+
+	def setup(self):
+		super().setup()
+		self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.__write_lock = threading.Lock()
+		self.__closed = threading.Event()
+		# executes the requests of this connection one after another in the order they were received
+		self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='stream-requests')
+		if self.server.worker is not None:
+			self.server.worker.add_busy_listener(self.__on_busy)
+
+	def finish(self):
+		# requests which were already received are still executed
+		self.__executor.shutdown(wait=True)
+		self.__closed.set()
+		if self.server.worker is not None:
+			self.server.worker.remove_busy_listener(self.__on_busy)
+		try:
+			super().finish()
+		except OSError:
+			pass
+
+	def handle(self):
+		for line in self.rfile:
+			if not line.strip():
+				continue
+			try:
+				message = json.loads(line)
+			except ValueError:
+				self.__send({"event": "error", "message": "Invalid JSON message"})
+				continue
+			endpoint = message.get("endpoint")
+			if endpoint == "subscribe" or endpoint in self.server.immediate:
+				self.__dispatch(message)
+			else:
+				self.__executor.submit(self.__dispatch, message)
+
+	def __dispatch(self, message: dict) -> bool:
+		request_id = message.get("id")
+		endpoint = message.get("endpoint")
+		payload = message.get("payload") or {}
+
+		if endpoint == "subscribe":
+			return self.__send(self.__subscribe(request_id, payload))
+
+		handler = self.server.handlers.get(endpoint)
+		if handler is None:
+			return self.__send({"id": request_id, "status": 404, "body": {"error": f"Unknown endpoint {endpoint}"}})
+
+		try:
+			body, status = handler(payload)
+		except Exception as e:
+			self.server._log.error(f"Unexpected error: {str(e)}")
+			body, status = {"error": "An unexpected error occurred"}, 500
+		if status != 200 or "error" in body:
+			self.__send({"event": "error", "id": request_id, "message": body.get("error")})
+		return self.__send({"id": request_id, "status": status, "body": body})
+
+	def __subscribe(self, request_id, payload: dict) -> dict:
+		topic = payload.get("topic")
+		handler = self.server.handlers.get(f"/{topic}_status")
+		if handler is None:
+			return {"id": request_id, "status": 404, "body": {"error": f"Unknown topic {topic}"}}
+		interval = float(payload.get("interval", 0.1))
+
+		def publish():
+			while not self.__closed.wait(interval):
+				try:
+					body, status = handler({})
+				except Exception as e:
+					body, status = {"error": str(e)}, 500
+				if status == 200:
+					event = {"event": topic}
+					event.update(body)
+				else:
+					event = {"event": "error", "message": body.get("error")}
+				if not self.__send(event):
+					break
+
+		threading.Thread(target=publish, name=f'stream-{topic}-events', daemon=True).start()
+		return {"id": request_id, "status": 200, "body": {"topic": topic, "interval": interval}}
+
+	def __on_busy(self) -> None:
+		self.__send({"event": "busy"})
+
+	def __send(self, message: dict) -> bool:
+		data = (json.dumps(message, separators=(',', ':')) + '\n').encode()
+		with self.__write_lock:
+			if self.__closed.is_set():
+				return False
+			try:
+				self.wfile.write(data)
+				self.wfile.flush()
+			except OSError:
+				self.__closed.set()
+				return False
+		return True
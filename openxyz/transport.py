@@ -0,0 +1,348 @@
+import itertools
+import json
+import logging
+import random
+import socket
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+
+from openxyz import metrics
+
+# status codes which indicate a transient problem of the bridge
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# status codes of requests which did not reach the bridge, the only ones retried for POST (e.g.: a 500 of
+# /send_gcode may come after the command was executed, repeating it would repeat a relative move)
+UNSENT_STATUS_CODES = (502, 503, 504)
+
+RETRIES = metrics.counter('openxyz_client_retries_total', 'Retried requests to the bridge', ('endpoint',))
+
+
+class HttpTransport:
+	"""
+	Keep-alive HTTP transport to the rpi.py bridge.
+
+	All requests share one pooled session, so consecutive commands reuse the same TCP connection.
+	Failed requests are retried with exponential backoff and full jitter up to a fixed number of retries. POST
+	requests (commands) are only retried if they cannot have reached the bridge: connection errors and
+	UNSENT_STATUS_CODES. GET requests (queries) are also retried on read timeouts and RETRY_STATUS_CODES.
+
+	:param url: Base URL of the bridge (e.g.: 'http://openxyz:5000')
+	:type url: str
+	:param connect_timeout: Timeout for establishing a connection in seconds
+	:type connect_timeout: float, optional
+	:param read_timeout: Timeout for receiving a response in seconds (has to cover the longest move)
+	:type read_timeout: float, optional
+	:param max_retries: Maximum number of retries before giving up
+	:type max_retries: int, optional
+	:param backoff_base: Backoff before the first retry in seconds, doubled with every retry
+	:type backoff_base: float, optional
+	:param backoff_max: Upper bound of the backoff in seconds
+	:type backoff_max: float, optional
+	:param pool_size: Maximum number of pooled connections
+	:type pool_size: int, optional
+	"""
+
+	def __init__(self, url: str, connect_timeout: float = 3.05, read_timeout: float = 120.0, max_retries: int = 5,
+				 backoff_base: float = 0.5, backoff_max: float = 30.0, pool_size: int = 4):
+		self._log = logging.getLogger(__name__)
+		self.url = url.rstrip('/')
+		self.timeout = (connect_timeout, read_timeout)
+		self.max_retries = max_retries
+		self.backoff_base = backoff_base
+		self.backoff_max = backoff_max
+
+		self.__session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+		self.__session.mount('http://', adapter)
+		self.__session.mount('https://', adapter)
+
+	def get(self, endpoint: str) -> dict:
+		"""
+		Sends a GET request to the bridge.
+
+		:param endpoint: Endpoint path (e.g.: '/status')
+		:type endpoint: str
+		:return: Decoded JSON response
+		:rtype: dict
+		:raises Exception: If the request fails after all retries
+		"""
+		return self.__request('GET', endpoint)
+
+	def post(self, endpoint: str, payload: dict) -> dict:
+		"""
+		Sends a POST request with a JSON payload to the bridge.
+
+		:param endpoint: Endpoint path (e.g.: '/send_gcode')
+		:type endpoint: str
+		:param payload: JSON payload
+		:type payload: dict
+		:return: Decoded JSON response
+		:rtype: dict
+		:raises Exception: If the request fails after all retries
+		"""
+		return self.__request('POST', endpoint, json=payload)
+
+	def close(self) -> None:
+		"""
+		Closes all pooled connections.
+
+		:return: None
+		:rtype: None
+		"""
+		self.__session.close()
+
+	def backoff(self, retry: int) -> float:
+		"""
+		Returns the time to wait before the given retry (exponential backoff with full jitter).
+
+		:param retry: Number of the retry, starting at 0
+		:type retry: int
+		:return: Backoff in seconds
+		:rtype: float
+		"""
+		return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** retry))
+
+	def __request(self, method: str, endpoint: str, **kwargs) -> dict:
+		idempotent = method == 'GET'
+		error = None
+		for retry in range(self.max_retries + 1):
+			if retry:
+				delay = self.backoff(retry - 1)
+				self._log.warning(f"({retry}/{self.max_retries})\t{error}, retrying in {delay:.2f} s...")
+				RETRIES.labels(endpoint).inc()
+				time.sleep(delay)
+			try:
+				response = self.__session.request(method, f'{self.url}{endpoint}', timeout=self.timeout, **kwargs)
+			except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+				if not idempotent and not _not_connected(e):
+					raise Exception(f"{method} {endpoint} failed, it may have been executed: {e}") from e
+				error = e
+				continue
+			if response.status_code == 200:
+				return response.json()
+			error = Exception(f"{method} {endpoint} failed with status {response.status_code}: {response.text}")
+			if response.status_code not in (RETRY_STATUS_CODES if idempotent else UNSENT_STATUS_CODES):
+				raise error
+		raise Exception(f"{method} {endpoint} failed after {self.max_retries} retries: {error}") from error
+
+
+class TcpTransport:
+	"""
+	Persistent, bidirectional socket to the stream server of the rpi.py bridge (see :class:`openxyz.stream_server.StreamServer`).
+
+	Requests are pipelined: they are written immediately and matched to their responses by correlation ID, so
+	many commands can be in flight on the same connection. Asynchronous events (busy, encoder, error) are passed
+	to the registered listeners from the reader thread.
+
+	:param url: URL of the stream server (e.g.: 'tcp://openxyz:5001')
+	:type url: str
+	:param connect_timeout: Timeout for establishing the connection in seconds
+	:type connect_timeout: float, optional
+	:param read_timeout: Timeout for receiving a response in seconds (has to cover the longest move)
+	:type read_timeout: float, optional
+	:raises ConnectionError: If unable to connect
+	"""
+
+	def __init__(self, url: str, connect_timeout: float = 3.05, read_timeout: float = 120.0):
+		self._log = logging.getLogger(__name__)
+		parsed = urlparse(url)
+		self.url = url
+		self.address = (parsed.hostname, parsed.port or 5001)
+		self.read_timeout = read_timeout
+
+		self.__ids = itertools.count(1)
+		self.__pending = {}
+		self.__listeners = []
+		self.__lock = threading.Lock()
+		self.__send_lock = threading.Lock()
+		self.__closed = False
+
+		try:
+			self.__socket = socket.create_connection(self.address, timeout=connect_timeout)
+		except OSError as e:
+			raise ConnectionError(f"Could not connect to {url}: {e}")
+		self.__socket.settimeout(None)
+		self.__socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.__reader = threading.Thread(target=self.__read, name='tcp-transport-reader', daemon=True)
+		self.__reader.start()
+
+	def submit(self, endpoint: str, payload: dict or None = None) -> Future:
+		"""
+		Sends a request without waiting for its response.
+
+		:param endpoint: Endpoint path (e.g.: '/send_gcode')
+		:type endpoint: str
+		:param payload: JSON payload
+		:type payload: dict or None, optional
+		:return: Future resolving to (body, status)
+		:rtype: concurrent.futures.Future
+		:raises ConnectionError: If the connection is closed
+		"""
+		future = Future()
+		with self.__send_lock:
+			with self.__lock:
+				if self.__closed:
+					raise ConnectionError(f"Connection to {self.url} is closed")
+				request_id = next(self.__ids)
+				self.__pending[request_id] = future
+			message = {"id": request_id, "endpoint": endpoint, "payload": payload or {}}
+			try:
+				self.__socket.sendall((json.dumps(message, separators=(',', ':')) + '\n').encode())
+			except OSError as e:
+				with self.__lock:
+					self.__pending.pop(request_id, None)
+				raise ConnectionError(f"Could not send to {self.url}: {e}")
+		return future
+
+	def result(self, future: Future, endpoint: str) -> dict:
+		"""
+		Waits for the response of a submitted request.
+
+		:param future: Future returned by :meth:`submit`
+		:type future: concurrent.futures.Future
+		:param endpoint: Endpoint of the request (for error messages)
+		:type endpoint: str
+		:return: Decoded JSON response body
+		:rtype: dict
+		:raises Exception: If the request failed or timed out
+		"""
+		body, status = future.result(self.read_timeout)
+		if status != 200:
+			raise Exception(f"{endpoint} failed with status {status}: {body}")
+		return body
+
+	def get(self, endpoint: str) -> dict:
+		"""
+		Sends a request without payload and waits for its response.
+
+		:param endpoint: Endpoint path (e.g.: '/status')
+		:type endpoint: str
+		:return: Decoded JSON response body
+		:rtype: dict
+		"""
+		return self.result(self.submit(endpoint), endpoint)
+
+	def post(self, endpoint: str, payload: dict) -> dict:
+		"""
+		Sends a request with a JSON payload and waits for its response.
+
+		:param endpoint: Endpoint path (e.g.: '/send_gcode')
+		:type endpoint: str
+		:param payload: JSON payload
+		:type payload: dict
+		:return: Decoded JSON response body
+		:rtype: dict
+		"""
+		return self.result(self.submit(endpoint, payload), endpoint)
+
+	def subscribe(self, topic: str, interval: float) -> dict:
+		"""
+		Requests periodic events of a topic (e.g.: 'encoder').
+
+		:param topic: Event topic
+		:type topic: str
+		:param interval: Interval between events in seconds
+		:type interval: float
+		:return: Decoded JSON response body
+		:rtype: dict
+		"""
+		return self.post('subscribe', {"topic": topic, "interval": interval})
+
+	def add_listener(self, callback: Callable[[dict], None]) -> None:
+		"""
+		Registers a callable which is invoked with every asynchronous event (e.g.: {"event": "busy"}).
+
+		:param callback: Callable receiving the event
+		:type callback: Callable[[dict], None]
+		:return: None
+		:rtype: None
+		"""
+		self.__listeners.append(callback)
+
+	def close(self) -> None:
+		"""
+		Closes the connection, pending requests fail with a ConnectionError.
+
+		:return: None
+		:rtype: None
+		"""
+		with self.__lock:
+			self.__closed = True
+		try:
+			self.__socket.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+		self.__socket.close()
+
+	def __read(self) -> None:
+		try:
+			for line in self.__socket.makefile('rb'):
+				message = json.loads(line)
+				if "event" in message:
+					for callback in list(self.__listeners):
+						try:
+							callback(message)
+						except Exception as e:
+							self._log.warning(f"Event listener failed: {e}")
+					continue
+				with self.__lock:
+					future = self.__pending.pop(message.get("id"), None)
+				if future is not None:
+					future.set_result((message.get("body") or {}, message.get("status")))
+		except (OSError, ValueError) as e:
+			self._log.debug(f"Reader of {self.url} stopped: {e}")
+		finally:
+			with self.__lock:
+				self.__closed = True
+				pending, self.__pending = self.__pending, {}
+			for future in pending.values():
+				future.set_exception(ConnectionError(f"Connection to {self.url} closed"))
+
+
+def open_transport(url: str, connect_timeout: float = 3.05, read_timeout: float = 120.0, max_retries: int = 5,
+				   backoff_base: float = 0.5, backoff_max: float = 30.0) -> HttpTransport or TcpTransport:
+	"""
+	Creates the transport matching the scheme of the URL ('http://', 'https://' or 'tcp://').
+
+	:param url: URL of the bridge
+	:type url: str
+	:param connect_timeout: Timeout for establishing a connection in seconds
+	:type connect_timeout: float, optional
+	:param read_timeout: Timeout for receiving a response in seconds
+	:type read_timeout: float, optional
+	:param max_retries: Maximum number of retries (HTTP only)
+	:type max_retries: int, optional
+	:param backoff_base: Backoff before the first retry in seconds (HTTP only)
+	:type backoff_base: float, optional
+	:param backoff_max: Upper bound of the backoff in seconds (HTTP only)
+	:type backoff_max: float, optional
+	:return: Transport
+	:rtype: HttpTransport or TcpTransport
+	:raises ValueError: If the scheme is not supported
+	"""
+	scheme = urlparse(url).scheme
+	if scheme in ('http', 'https'):
+		return HttpTransport(url, connect_timeout=connect_timeout, read_timeout=read_timeout, max_retries=max_retries,
+							 backoff_base=backoff_base, backoff_max=backoff_max)
+	if scheme == 'tcp':
+		return TcpTransport(url, connect_timeout=connect_timeout, read_timeout=read_timeout)
+	raise ValueError(f"Unsupported transport scheme '{scheme}' in {url}")
+
+
+def _not_connected(error: requests.exceptions.RequestException) -> bool:
+	"""
+	:return: True if no connection to the bridge could be established, so the request has not been sent
+	:rtype: bool
+	"""
+	if isinstance(error, requests.exceptions.ConnectTimeout):
+		return True
+	# requests wraps the error of urllib3 (MaxRetryError), whose reason is NewConnectionError if connecting failed
+	reason = getattr(error.args[0], 'reason', error.args[0]) if error.args else None
+	return isinstance(reason, ConnectTimeoutError)
@@ -1,33 +1,491 @@
 from enum import Enum
 import logging
+import math
 import os
 import pickle
 import re
+from typing import Iterator, Sequence
+
+# commands whose argument is a string (e.g.: 'M117 Hello'), not parameter words
+TEXT_COMMANDS = frozenset(('M23', 'M28', 'M30', 'M32', 'M33', 'M117', 'M118', 'M928'))
+# fields of the move arrays of read_moves(): 1-based line in the program, G-code (0, 1, 2 or 3), target x, y, z in mm
+# and feed rate in mm/min (NaN until known)
+MOVE_FIELDS = [('line', '<i8'), ('g', 'u1'), ('x', '<f8'), ('y', '<f8'), ('z', '<f8'), ('f', '<f8')]
+
+_LINE_NUMBER_PATTERN = re.compile(r'[Nn]\s*(\d+)\s*')
+_COMMAND_PATTERN = re.compile(r'([GMTgmt])\s*0*(\d+)(?:\.(\d+))?')
+_WORD_PATTERN = re.compile(r'\s*([A-Za-z])\s*([-+]?(?:\d+\.?\d*|\.\d+))?')
+_PAREN_COMMENT_PATTERN = re.compile(r'\(([^)]*)\)')
+# byte lookup tables of _parse_moves(), built on first use
+_BYTE_TABLES = None
+# longest number parsed vectorized, including the decimal point
+_MAX_NUMBER_LENGTH = 24
+
+
+def checksum(line: str) -> int:
+	"""
+	Calculates the Marlin/RepRap checksum of a line (XOR of all bytes).
+
+	:param line: Line including the line number (e.g.: 'N12 G0 X1')
+	:type line: str
+	:return: Checksum
+	:rtype: int
+	"""
+	cs = 0
+	for b in line.encode():
+		cs ^= b
+	return cs
+
+
+class GCodeCommand:
+	"""
+	Tokenized G-code line, see :func:`parse_gcode_line`. ``str(command)`` formats the command without line number,
+	checksum and comment, e.g. to send it with :meth:`openxyz.marlin_serial.MarlinSerial.send_gcode`.
+
+	:param code: Command (e.g.: 'G1', 'M203', 'T0')
+	:type code: str
+	:param words: Parameters by upper-case letter (e.g.: {'X': 1.0, 'F': 600.0}), None for flags (e.g.: 'G28 X')
+	:type words: dict, optional
+	:param text: String argument of TEXT_COMMANDS (e.g.: the message of M117)
+	:type text: str, optional
+	:param line_number: Line number (N word)
+	:type line_number: int, optional
+	:param checksum: Checksum (* word)
+	:type checksum: int, optional
+	:param comment: Comment (after ';' or in parentheses)
+	:type comment: str, optional
+	"""
+	__slots__ = ('code', 'words', 'text', 'line_number', 'checksum', 'comment')
+
+	def __init__(self, code: str, words: dict = None, text: str = None, line_number: int = None,
+				 checksum: int = None, comment: str = None):
+		self.code = code
+		self.words = words if words is not None else {}
+		self.text = text
+		self.line_number = line_number
+		self.checksum = checksum
+		self.comment = comment
+
+	def __str__(self):
+		parts = [self.code]
+		if self.text:
+			parts.append(self.text)
+		for letter, value in self.words.items():
+			parts.append(letter if value is None else letter + _format_number(value))
+		return ' '.join(parts)
+
+	def __repr__(self):
+		return f"GCodeCommand('{self}')"
+
+	def __eq__(self, other):
+		if not isinstance(other, GCodeCommand):
+			return NotImplemented
+		return (self.code, self.words, self.text) == (other.code, other.words, other.text)
+
+
+def parse_gcode_line(line: str) -> GCodeCommand or None:
+	"""
+	Tokenizes a G-code line: optional line number, command, parameter words with typed values, checksum and comments.
+
+	:param line: G-code line (e.g.: 'N12 G1 X10 Y-2.5 F600*93 ; move')
+	:type line: str
+	:return: Command, None for empty and comment-only lines
+	:rtype: GCodeCommand or None
+	:raises ValueError: If the line is invalid or its checksum does not match
+	"""
+	code, separator, comment = line.strip().partition(';')
+	comment = comment.strip() if separator else None
+
+	cs = None
+	if '*' in code:
+		code, _, cs = code.rpartition('*')
+		if not cs.strip().isdigit():
+			raise ValueError(f"Invalid checksum: '{line}'")
+		cs = int(cs)
+		if checksum(code) != cs:
+			raise ValueError(f"Checksum mismatch ({checksum(code)} != {cs}): '{line}'")
+	code = code.strip()
+	if not code:
+		return None
+
+	line_number = None
+	match = _LINE_NUMBER_PATTERN.match(code)
+	if match:
+		line_number = int(match.group(1))
+		code = code[match.end():]
+	match = _COMMAND_PATTERN.match(code)
+	if not match:
+		raise ValueError(f"Invalid G-code: '{line}'")
+	command = match.group(1).upper() + match.group(2) + (f'.{match.group(3)}' if match.group(3) else '')
+	rest = code[match.end():]
+	if command in TEXT_COMMANDS:
+		return GCodeCommand(command, text=rest.strip(), line_number=line_number, checksum=cs, comment=comment)
+
+	paren_comments = _PAREN_COMMENT_PATTERN.findall(rest)
+	if paren_comments:
+		rest = _PAREN_COMMENT_PATTERN.sub(' ', rest)
+		comment = ' '.join(c.strip() for c in paren_comments + ([comment] if comment else []))
+	words = {}
+	position, end = 0, len(rest.rstrip())
+	while position < end:
+		match = _WORD_PATTERN.match(rest, position)
+		if not match:
+			raise ValueError(f"Invalid G-code: '{line}'")
+		letter = match.group(1).upper()
+		if letter in words:
+			raise ValueError(f"Duplicate {letter} word: '{line}'")
+		words[letter] = float(match.group(2)) if match.group(2) is not None else None
+		position = match.end()
+	return GCodeCommand(command, words, line_number=line_number, checksum=cs, comment=comment)
+
+
+def iter_gcode(program) -> Iterator[GCodeCommand]:
+	"""
+	Tokenizes a G-code program line by line, see :func:`parse_gcode_line`. Empty and comment-only lines are skipped.
+
+	:param program: Path of a G-code file or iterable of lines
+	:type program: str or Iterable[str]
+	:return: Commands in program order
+	:rtype: Iterator[GCodeCommand]
+	:raises ValueError: If a line is invalid, with its line number
+	"""
+	if isinstance(program, (str, os.PathLike)):
+		with open(program, 'r') as f:
+			yield from iter_gcode(f)
+		return
+	for number, line in enumerate(program, 1):
+		try:
+			command = parse_gcode_line(line)
+		except ValueError as e:
+			raise ValueError(f"Line {number}: {e}") from None
+		if command is not None:
+			yield command
+
 
 def parse_gcode(gcode: str) -> tuple[float, float, float]:
 	"""
-	Parses the G-code action using regex.
+	Parses the target of a linear move.
 
-	:param gcode: G-code action in the format "G1 X{float} Y{float} Z{float} F{float}" (e.g., "G1 X10.0 Y20.0 Z30.0 F100.0")
+	:param gcode: G-code move (e.g., "G1 X10.0 Y20.0 Z30.0 F100.0"), axes which are not given are 0
 	:type gcode: str
 	:return: Parsed x, y, and z values
 	:rtype: tuple[float, float, float]
 	:raises ValueError: If the G-code action is invalid
 	"""
+	command = parse_gcode_line(gcode)
+	if command is None or command.code not in ('G0', 'G1'):
+		raise ValueError(f"Detected invalid G-code action, aborting! ('{gcode}')")
+	return tuple(command.words.get(axis) or 0.0 for axis in 'XYZ')
 
-	# TODO: improve trash code
-	# Using regex to parse the G-code action (e.g., "G1 X10.0")
-	pattern = re.compile(r"G1 (X(?P<x>-?\d*\.?\d+)|Y(?P<y>-?\d*\.?\d+)|Z(?P<z>-?\d*\.?\d+))")
-	match = pattern.match(gcode)
-	if match:
-		x = match.group("x") or 0.0
-		y = match.group("y") or 0.0
-		z = match.group("z") or 0.0
 
-		# Returning the parsed values
-		return x, y, z
-	else:
-		raise ValueError(f"Detected invalid G-code action, aborting! ('{gcode}')")
+def iter_moves(program, start: Sequence[float] = None, chunk_size: int = 1 << 20) -> Iterator['np.ndarray']:
+	"""
+	Parses the moves (G0, G1 and the end points of arcs) of a G-code program into arrays of MOVE_FIELDS, chunk by chunk.
+
+	Targets are absolute positions in mm: axes which are not given keep their position, relative moves (G91), inches
+	(G20), G92 and G28 are applied. Move lines of the form 'G1 X.. Y.. Z.. F..' (in any order, optionally with a
+	';' comment) are parsed vectorized with NumPy; all other lines affecting the position go through
+	:func:`parse_gcode_line`. M and T commands and dwells (G4) are skipped without validation, use
+	:func:`iter_gcode` to validate a program.
+
+	:param program: Path of a G-code file or binary file object
+	:type program: str or BinaryIO
+	:param start: Position before the program, NaN for unknown axes (default)
+	:type start: Sequence[float], optional
+	:param chunk_size: Number of bytes parsed at once
+	:type chunk_size: int, optional
+	:return: Structured arrays of moves
+	:rtype: Iterator[np.ndarray]
+	:raises ValueError: If a line is invalid, with its line number
+	"""
+	if isinstance(program, (str, os.PathLike)):
+		with open(program, 'rb') as f:
+			yield from iter_moves(f, start, chunk_size)
+		return
+
+	state = _MoveState(start)
+	first_line, rest = 0, b''
+	while True:
+		data = program.read(chunk_size)
+		if not data:
+			break
+		data = rest + data
+		end = data.rfind(b'\n') + 1
+		chunk, rest = data[:end], data[end:]
+		if chunk:
+			moves = _parse_moves(chunk, first_line, state)
+			first_line += chunk.count(b'\n')
+			if len(moves):
+				yield moves
+	if rest:
+		moves = _parse_moves(rest + b'\n', first_line, state)
+		if len(moves):
+			yield moves
+
+
+def read_moves(program, start: Sequence[float] = None) -> 'np.ndarray':
+	"""
+	Parses all moves of a G-code program, see :func:`iter_moves`.
+
+	Programs starting from a known position (start or G28) can be time-estimated with
+	:meth:`openxyz.motion.MotionModel.segment_times`, e.g.:
+	``model.estimate(np.column_stack([moves['x'], moves['y'], moves['z']]), feedrate=moves['f'])``.
+
+	:param program: Path of a G-code file or binary file object
+	:type program: str or BinaryIO
+	:param start: Position before the program, NaN for unknown axes (default)
+	:type start: Sequence[float], optional
+	:return: Structured array of MOVE_FIELDS
+	:rtype: np.ndarray
+	:raises ValueError: If a line is invalid, with its line number
+	"""
+	import numpy as np
+
+	chunks = list(iter_moves(program, start))
+	return np.concatenate(chunks) if chunks else np.zeros(0, dtype=MOVE_FIELDS)
+
+
+def _format_number(value: float) -> str:
+	if value == int(value) and abs(value) < 1e15:
+		return str(int(value))
+	text = repr(value)
+	# G-code has no exponent notation
+	return text if 'e' not in text else f'{value:.15f}'.rstrip('0').rstrip('.')
+
+
+class _MoveState:
+	"""
+	Modal state of a G-code program while its moves are parsed: position, feed rate, relative mode and units.
+	"""
+	__slots__ = ('position', 'feedrate', 'relative', 'scale')
+
+	def __init__(self, start: Sequence[float] = None):
+		self.position = [float(v) for v in start] + [0.0] * (3 - len(start)) if start is not None else [math.nan] * 3
+		self.feedrate = math.nan
+		self.relative = False
+		self.scale = 1.0
+
+	def apply(self, command: GCodeCommand) -> tuple or None:
+		# updates the state with a command, returns (g, x, y, z, f) if it is a move
+		code, words = command.code, command.words
+		if code in ('G0', 'G1', 'G2', 'G3'):
+			for axis, letter in enumerate('XYZ'):
+				value = words.get(letter)
+				if value is not None:
+					value *= self.scale
+					self.position[axis] = self.position[axis] + value if self.relative else value
+			if words.get('F') is not None:
+				self.feedrate = words['F'] * self.scale
+			return (int(code[1]), *self.position, self.feedrate)
+		if code in ('G90', 'G91'):
+			self.relative = code == 'G91'
+		elif code in ('G20', 'G21'):
+			self.scale = 25.4 if code == 'G20' else 1.0
+		elif code in ('G28', 'G92'):
+			# G28 homes the given axes (all without axis words), G92 sets the given axes (all to 0 without words)
+			axes = [axis for axis, letter in enumerate('XYZ') if letter in words] or range(3)
+			for axis in axes:
+				value = words.get('XYZ'[axis]) if code == 'G92' else None
+				self.position[axis] = value * self.scale if value is not None else 0.0
+		return None
+
+	def advance(self, table: 'np.ndarray') -> 'np.ndarray':
+		# applies consecutive G0/G1 moves, table holds the x, y, z, f words (NaN if not given), returns the targets
+		import numpy as np
+
+		out = np.empty_like(table)
+		for column in range(4):
+			values = table[:, column] * self.scale
+			if column < 3 and self.relative:
+				out[:, column] = self.position[column] + np.cumsum(np.nan_to_num(values))
+			else:
+				# modal: the last given value or the value before the moves
+				index = np.where(np.isnan(values), -1, np.arange(len(values)))
+				np.maximum.accumulate(index, out=index)
+				initial = self.position[column] if column < 3 else self.feedrate
+				out[:, column] = np.where(index >= 0, values[index], initial)
+		if len(out):
+			self.position = [float(v) for v in out[-1, :3]]
+			self.feedrate = float(out[-1, 3])
+		return out
+
+
+def _byte_tables():
+	import numpy as np
+
+	# class of every byte in move lines, 1: word parsed vectorized, 2: part of a number, 3: anything the tokenizer has
+	# to look at, 0: separator
+	classes = np.full(256, 3, dtype=np.uint8)
+	classes[[ord(c) for c in ' \t\r\n']] = 0
+	classes[[ord(c) for c in '0123456789.+-']] = 2
+	classes[[ord(c) for c in 'XYZFxyzf']] = 1
+	# column of the words in the table of moves
+	columns = np.zeros(256, dtype=np.intp)
+	for column, letters in enumerate(('Xx', 'Yy', 'Zz', 'Ff')):
+		columns[[ord(c) for c in letters]] = column
+	return classes, columns
+
+
+def _content_rows(content_starts: 'np.ndarray', content_ends: 'np.ndarray', positions: 'np.ndarray') -> 'np.ndarray':
+	# index of the content range containing every position, -1 outside of all ranges
+	import numpy as np
+
+	if not len(content_starts):
+		return np.full(len(positions), -1)
+	rows = np.searchsorted(content_starts, positions, side='right') - 1
+	return np.where((rows >= 0) & (positions < content_ends[rows]), rows, -1)
+
+
+def _parse_numbers(padded: 'np.ndarray', positions: 'np.ndarray') -> tuple:
+	"""
+	Parses the decimal numbers (e.g.: '-12.5', '.5', '3') starting at positions, vectorized character by character.
+	Numbers of up to 15 digits are exact: the digits are accumulated as integer and divided by a power of ten once.
+
+	:param padded: Characters, followed by at least _MAX_NUMBER_LENGTH + 2 newlines
+	:type padded: np.ndarray
+	:param positions: Positions of the first characters
+	:type positions: np.ndarray
+	:return: Values, mask of the valid numbers
+	:rtype: tuple[np.ndarray, np.ndarray]
+	"""
+	import numpy as np
+
+	first = padded[positions]
+	negative = first == 45
+	start = positions + (negative | (first == 43))
+	position = start.copy()
+	mantissa = np.zeros(len(positions), dtype=np.int64)
+	digits = np.zeros(len(positions), dtype=np.int8)
+	dots = np.zeros(len(positions), dtype=np.int8)
+	# digits before the decimal point
+	integer_digits = np.zeros(len(positions), dtype=np.int8)
+	active = np.ones(len(positions), dtype=bool)
+	for _ in range(_MAX_NUMBER_LENGTH + 1):
+		c = padded[position]
+		d = c - np.uint8(48)
+		digit = d < 10
+		digit &= active
+		dot = c == 46
+		dot &= active
+		np.multiply(mantissa, 10, out=mantissa, where=digit)
+		np.add(mantissa, d, out=mantissa, where=digit)
+		digits += digit
+		dots += dot
+		np.copyto(integer_digits, digits, where=dot)
+		np.logical_or(digit, dot, out=active)
+		if not active.any():
+			break
+		position += 1
+	# a sign after the number (e.g.: '1-2'), a second dot or a number too long
+	end = padded[start + digits + dots]
+	valid = ~active & (digits > 0) & (digits <= 15) & (dots <= 1) & (end != 43) & (end != 45)
+	values = mantissa / np.power(10.0, np.where(dots > 0, digits - integer_digits, 0))
+	return np.where(negative, -values, values), valid
+
+
+def _parse_moves(chunk: bytes, first_line: int, state: _MoveState) -> 'np.ndarray':
+	"""
+	Parses the moves of complete lines (chunk ends with a newline) and updates the state.
+
+	:param chunk: Complete lines of a G-code program
+	:type chunk: bytes
+	:param first_line: Number of lines before the chunk
+	:type first_line: int
+	:param state: Modal state before the chunk
+	:type state: _MoveState
+	:return: Structured array of MOVE_FIELDS
+	:rtype: np.ndarray
+	"""
+	import numpy as np
+
+	global _BYTE_TABLES
+	if _BYTE_TABLES is None:
+		_BYTE_TABLES = _byte_tables()
+	byte_classes, word_columns = _BYTE_TABLES
+
+	b = np.frombuffer(chunk, dtype=np.uint8)
+	ends = np.flatnonzero(b == 10)
+	starts = np.concatenate([[0], ends[:-1] + 1])
+	padded = np.concatenate([b, np.full(_MAX_NUMBER_LENGTH + 2, 10, dtype=np.uint8)])
+
+	# content ends at the first ';'
+	cut = ends.copy()
+	semicolons = np.flatnonzero(b == 59)
+	if len(semicolons):
+		owner = np.searchsorted(ends, semicolons)
+		first = np.concatenate([[True], owner[1:] != owner[:-1]])
+		cut[owner[first]] = semicolons[first]
+
+	# lines are classified by their first characters: 'G0'/'G1' moves, G4, M and T commands without effect on the
+	# position, empty lines; everything else (line numbers, indentation, other G-codes) goes to the tokenizer
+	letter = padded[starts] | 0x20
+	digit = padded[starts + 1]
+	after = padded[starts + 2]
+	single = ((after - 48) >= 10) & (after != 46)
+	is_g = letter == ord('g')
+	move = is_g & ((digit == 48) | (digit == 49)) & single
+	passive = (is_g & (digit == 52) & single) | (letter == ord('m')) | (letter == ord('t'))
+	empty = (cut == starts) | ((cut - starts == 1) & (padded[starts] == 13))
+	special = ~(move | passive | empty)
+
+	# words of move lines lie between the command and the comment
+	content_lines = np.flatnonzero(move)
+	content_starts, content_ends = starts[content_lines] + 2, cut[content_lines]
+	classes = byte_classes[padded]
+	classes[starts] = 0
+	classes[starts + 1] = 0
+	letters = np.flatnonzero(classes == 1)
+	rows = _content_rows(content_starts, content_ends, letters)
+	letters, rows = letters[rows >= 0], rows[rows >= 0]
+	values, valid = _parse_numbers(padded, letters + 1)
+	# other words, checksums, parentheses, numbers without word letter and malformed numbers go to the tokenizer
+	previous, current = classes[:-1], classes[1:]
+	stray_numbers = np.flatnonzero((current == 2) & (previous != 2) & (previous != 1)) + 1
+	irregular = np.concatenate([np.flatnonzero(classes == 3), stray_numbers])
+	irregular_rows = _content_rows(content_starts, content_ends, irregular)
+	regular = np.ones(len(content_lines), dtype=bool)
+	regular[irregular_rows[irregular_rows >= 0]] = False
+	regular[rows[~valid]] = False
+	# a repeated word (e.g.: 'G1 X1 X2') is rejected by the tokenizer
+	columns = word_columns[padded[letters]]
+	words = np.sort(rows * 4 + columns)
+	regular[words[1:][words[1:] == words[:-1]] // 4] = False
+	special[content_lines[~regular]] = True
+
+	table = np.full((len(content_lines), 4), np.nan)
+	table[rows, columns] = values
+	move_lines, table = content_lines[regular], table[regular]
+	codes = digit[move_lines] - 48
+
+	special_lines = np.flatnonzero(special)
+	boundaries = np.searchsorted(move_lines, special_lines)
+	pieces, previous = [], 0
+	for line, boundary in zip(special_lines.tolist(), boundaries.tolist()):
+		if boundary > previous:
+			pieces.append((move_lines[previous:boundary], codes[previous:boundary],
+						   state.advance(table[previous:boundary])))
+		previous = boundary
+		text = chunk[starts[line]:ends[line]].decode('utf-8', 'replace')
+		try:
+			command = parse_gcode_line(text)
+		except ValueError as e:
+			raise ValueError(f"Line {first_line + line + 1}: {e}") from None
+		row = state.apply(command) if command is not None else None
+		if row is not None:
+			pieces.append((np.array([line]), np.array([row[0]]), np.array([row[1:]])))
+	if len(move_lines) > previous:
+		pieces.append((move_lines[previous:], codes[previous:], state.advance(table[previous:])))
+
+	moves = np.zeros(sum(len(p[0]) for p in pieces), dtype=MOVE_FIELDS)
+	offset = 0
+	for lines, g, targets in pieces:
+		rows = slice(offset, offset + len(lines))
+		moves['line'][rows] = lines + first_line + 1
+		moves['g'][rows] = g
+		for column, name in enumerate('xyzf'):
+			moves[name][rows] = targets[:, column]
+		offset += len(lines)
+	return moves
 
 
 class GCode(Enum):
@@ -134,6 +592,21 @@ class FileManager:
 			self._log.info(f"File {file_path} does not exist. Creating a new file.")
 			self.save_new_file(filename, data)
 
+	def open_store(self, filename: str, mode: str = 'a', **kwargs):
+		"""
+		Opens a chunked scan result store, which stays open for all appends (unlike :meth:`append_to_file`).
+
+		:param filename: The name of the file
+		:type filename: str
+		:param mode: 'r', 'w' or 'a', see :class:`openxyz.store.ScanStore`
+		:type mode: str, optional
+		:param kwargs: Further arguments of :class:`openxyz.store.ScanStore` (e.g.: compression)
+		:return: The opened store
+		:rtype: openxyz.store.ScanStore
+		"""
+		from openxyz.store import ScanStore
+		return ScanStore(self._get_file_path(filename), mode, **kwargs)
+
 	def load_file(self, filename: str) -> any:
 		"""
 		Loads and returns data from a file.
@@ -1,13 +1,14 @@
 from openxyz.marlin import Marlin
+from openxyz.motion import MotionModel
 from openxyz.utils import GCode, parse_gcode
 
 import enum
 import decimal
-from matplotlib import pyplot as plt
-import numpy as np
-import tqdm
+import logging
 import time
 
+# path optimization, scans and result files (NumPy) are imported on first use, see optimize_path() and scan()
+
 class GCode(enum.Enum):
 	G0 		= "G0"  	# G0 for move without extrusion, G1 for move with extrusion.
 	G1 		= "G1"  	# Linear move
@@ -39,32 +40,70 @@ class PositioningMode(enum.Enum):
 	POSITIONING_MODE_ABSOLUTE 	= 0x00
 	POSITIONING_MODE_RELATIVE 	= 0x01
 
+def format_move(x=None, y=None, z=None, feed=None) -> list[str]:
+	# axis and feed rate words of a linear move, omitted axes are left out
+	words = ["{}{}".format(axis, value) for axis, value in zip("XYZ", (x, y, z)) if value is not None]
+	if words and feed is not None:
+		words.append("F{}".format(feed))
+	return words
+
+def parse_position(response: str) -> tuple[decimal.Decimal, decimal.Decimal, decimal.Decimal]:
+	# position reported by M114 (e.g.: 'X:1.00 Y:2.00 Z:3.00 E:0.00 Count X:0 Y:0 Z:0')
+	s = response.split(':')
+	x = decimal.Decimal(s[1].split(' ', 1)[0])
+	y = decimal.Decimal(s[2].split(' ', 1)[0])
+	z = decimal.Decimal(s[3].split(' ', 1)[0])
+	return x, y, z
+
 class Stage(object):
-	def __init__(self, marlin: Marlin):
+	def __init__(self, marlin: Marlin, feedrate: int = 100, cache_position: bool = True):
+		self._log 				= logging.getLogger(__name__)
 		self.__marlin 			= marlin
+		self.feedrate 			= feedrate  # mm/min, used by moves without explicit feed rate
+		self.cache_position 	= cache_position  # serve position getters from the commanded position
+		self.__position 		= [None, None, None]  # commanded x, y, z, None if unknown
+		self.__relative 		= False
+		self.motion 			= MotionModel()  # planner settings for estimates, follows the settings sent by the stage
+		self.calibration 		= None  # openxyz.calibration.Calibration applied to the coordinates of scan()
 		self.__context 			= decimal.getcontext()
 		self.__context.prec 	= 4
 		self.__initialize_stage()
 
-	def __send_gcode(self, gcode: GCode, *args) -> str or None:
+	@staticmethod
+	def __format_gcode(gcode: GCode, *args) -> str:
 		gcode = gcode.value
 		if args:
 			gcode += ' ' + ' '.join(args)
-		return self.__marlin.send_gcode(gcode)
+		return gcode
+
+	def __send_gcode(self, gcode: GCode, *args) -> str or None:
+		return self.__marlin.send_gcode(self.__format_gcode(gcode, *args))
+
+	def __send_gcode_batch(self, *gcodes: tuple) -> list[str or None]:
+		return self.__marlin.send_gcode_batch([self.__format_gcode(*gcode) for gcode in gcodes])
 
 	def __initialize_stage(self):
-		self.set_positioning_unit(mode=PositioningUnit.POSITIONING_UNIT_MILLIMETER)
-		self.set_positioning_mode(mode=PositioningMode.POSITIONING_MODE_ABSOLUTE)
-		self.auto_home(only_untrusted=True)
-		self.set_max_feedrates(max_feedrates=(300, 300, 300))
-		self.feedrate_percent = 100
-		self.set_lcd_message(message='Open-FML')
+		# single round trip: mm units, absolute mode, home untrusted axes, max feed rates, 100 % feed rate, lcd message
+		self.__send_gcode_batch(
+			(GCode.G21,),
+			(GCode.G90,),
+			(GCode.G28, "O"),
+			(GCode.M203, "X300", "Y300", "Z300"),
+			(GCode.M220, "S100"),
+			(GCode.M117, "Open-FML"),
+		)
+		self.__relative = False
+		self.motion.update("M203 X300 Y300 Z300")
+		self.invalidate_position()
 
 	def set_positioning_unit(self, mode: PositioningUnit):
 		self.__send_gcode(GCode.G20 if mode == PositioningUnit.POSITIONING_UNIT_INCH else GCode.G21)
+		self.invalidate_position()
 
 	def set_positioning_mode(self, mode: PositioningMode):
 		self.__send_gcode(GCode.G90 if mode == PositioningMode.POSITIONING_MODE_ABSOLUTE else GCode.G91)
+		self.__relative = mode == PositioningMode.POSITIONING_MODE_RELATIVE
+		self.invalidate_position()
 
 	def set_lcd_message(self, message: str):
 		self.__send_gcode(GCode.M117, message)
@@ -74,9 +113,22 @@ class Stage(object):
 			self.__send_gcode(GCode.G28, "O")
 		else:
 			self.__send_gcode(GCode.G28, 'X', 'Y', 'Z')
+		self.invalidate_position()
+
+	@property
+	def max_feedrates(self) -> tuple[float, float, float]:
+		# mm/s, as last set by the stage (see load_motion_settings)
+		return self.motion.max_feedrate
 
 	def set_max_feedrates(self, max_feedrates: tuple[int, int, int]):
-		self.__send_gcode(GCode.M203, "X{}", "Y{}", "Z{}".format(max_feedrates[0], max_feedrates[1], max_feedrates[2]))
+		gcode = self.__format_gcode(GCode.M203, *("{}{}".format(axis, feedrate) for axis, feedrate in zip("XYZ", max_feedrates)))
+		self.__marlin.send_gcode(gcode)
+		self.motion.update(gcode)
+
+	def load_motion_settings(self) -> MotionModel:
+		# reads feed rates, accelerations and junction deviation from Marlin (M503) into the motion model
+		self.motion.update(self.__send_gcode(GCode.M503) or "")
+		return self.motion
 
 	@property
 	def feedrate_percent(self) -> int:
@@ -93,13 +145,24 @@ class Stage(object):
 
 	@property
 	def xyz(self) -> tuple[decimal.Decimal, decimal.Decimal, decimal.Decimal]:
-		pos_str = self.__send_gcode(GCode.M114)
-		s = pos_str.split(':')
-		x = decimal.Decimal(s[1].split(' ', 1)[0])
-		y = decimal.Decimal(s[2].split(' ', 1)[0])
-		z = decimal.Decimal(s[3].split(' ', 1)[0])
+		# commanded position if known, otherwise (or if caching is disabled) query Marlin
+		if self.cache_position and None not in self.__position:
+			return tuple(self.__position)
+		return self.query_position()
+
+	def query_position(self) -> tuple[decimal.Decimal, decimal.Decimal, decimal.Decimal]:
+		# always queries Marlin (M114) and re-synchronizes the commanded position
+		x, y, z = parse_position(self.__send_gcode(GCode.M114))
+		self.__position = [x, y, z]
 		return x, y, z
 
+	def refresh(self) -> tuple[decimal.Decimal, decimal.Decimal, decimal.Decimal]:
+		return self.query_position()
+
+	def invalidate_position(self):
+		# the next position read queries Marlin
+		self.__position = [None, None, None]
+
 	@property
 	def acceleration(self):
 		response = self.__send_gcode(GCode.M204)
@@ -107,7 +170,10 @@ class Stage(object):
 
 	@acceleration.setter
 	def acceleration(self, acceleration):
-		pass
+		# printing and travel acceleration in mm/s^2
+		gcode = self.__format_gcode(GCode.M204, "S{}".format(acceleration))
+		self.__marlin.send_gcode(gcode)
+		self.motion.update(gcode)
 
 	@property
 	def x(self) -> decimal.Decimal:
@@ -115,7 +181,7 @@ class Stage(object):
 
 	@x.setter
 	def x(self, value: decimal.Decimal):
-		self.__send_gcode(GCode.G0, "X{} F100".format(value))
+		self.move_to(x=value)
 
 	@property
 	def y(self) -> decimal.Decimal:
@@ -123,7 +189,7 @@ class Stage(object):
 
 	@y.setter
 	def y(self, value: decimal.Decimal):
-		self.__send_gcode(GCode.G0, "Y{} F100".format(value))
+		self.move_to(y=value)
 
 	@property
 	def z(self) -> decimal.Decimal:
@@ -131,7 +197,7 @@ class Stage(object):
 
 	@z.setter
 	def z(self, value: decimal.Decimal):
-		self.__send_gcode(GCode.G0, "Z{} F100".format(value))
+		self.move_to(z=value)
 
 	@property
 	def xy(self) -> tuple[decimal.Decimal, decimal.Decimal]:
@@ -140,10 +206,108 @@ class Stage(object):
 
 	@xy.setter
 	def xy(self, xy: tuple[decimal.Decimal, decimal.Decimal]):
-		self.x = xy[0]
-		self.y = xy[1]
+		self.move_to(x=xy[0], y=xy[1])
+
+	def move_to(self, x: decimal.Decimal = None, y: decimal.Decimal = None, z: decimal.Decimal = None, feed: int = None):
+		# all given axes are moved with a single linear move, omitted axes keep their position
+		words = format_move(x, y, z, self.feedrate if feed is None else feed)
+		if not words:
+			return
+		self.__send_gcode(GCode.G0, *words)
+
+		for axis, value in enumerate((x, y, z)):
+			if value is None:
+				continue
+			value = decimal.Decimal(str(value))
+			if not self.__relative:
+				self.__position[axis] = value
+			elif self.__position[axis] is not None:
+				self.__position[axis] += value
 
 	def apply_delta(self, delta: tuple[decimal.Decimal, decimal.Decimal, decimal.Decimal]):
-		self.x = self.x + delta[0]
-		self.y = self.y + delta[1]
-		self.z = self.z + delta[2]
\ No newline at end of file
+		if self.__relative:
+			self.move_to(x=delta[0], y=delta[1], z=delta[2])
+			return
+		x, y, z = self.xyz
+		self.move_to(x=x + delta[0], y=y + delta[1], z=z + delta[2])
+
+	def optimize_path(self, path, start: int = 0, time_limit: float = 10.0) -> list:
+		# reorders the coordinates of path (or iterable of coordinates) to minimize the travel time at the current
+		# max feed rates and feed rate, the set of coordinates is unchanged, see openxyz.path_optimizer
+		from openxyz.path_optimizer import optimize_path
+		return optimize_path(getattr(path, 'coordinates', path), max_feedrates=self.max_feedrates,
+							 feedrate=self.feedrate, start=start, time_limit=time_limit)
+
+	def wait_settled(self, window: int = 2, samples: int = 5, timeout: float = 5.0) -> float:
+		# waits until all moves are completed and the encoders stay within window counts for samples consecutive
+		# readings, use instead of fixed dwells before measuring; returns the measured settle time in seconds
+		result = self.__marlin.wait_settled(window=window, samples=samples, timeout=timeout)
+		if not result["settled"]:
+			raise Exception(f"Stage did not settle within {timeout} s")
+		return result["settle_time"]
+
+	def get_encoder_status(self) -> dict:
+		# raw x, y encoder counters
+		return self.__marlin.get_encoder_status()
+
+	def estimate(self, path, stop: bool = True) -> float:
+		# estimated travel time in seconds of path (or iterable of coordinates) from the current position, at the
+		# feed rate of the stage; stop for a standstill at every coordinate (as in scan()), see openxyz.motion
+		start = self.__position if None not in self.__position else None
+		return self.motion.estimate(getattr(path, 'coordinates', path), feedrate=self.feedrate, start=start, stop=stop)
+
+	def scan(self, path, callback, sink, post_process=None, queue_size: int = 16, journal=None) -> int:
+		# moves to every coordinate of the path (or iterable of coordinates) and measures with callback(), results
+		# are post-processed and handed to sink (object with append(coordinate, data), callable or file name: a
+		# ScanStore for names ending with STORE_EXTENSION, a pickle stream otherwise)
+		# in the background while the next move is commanded, see ScanExecutor; with a calibration, the corrected
+		# coordinates of the whole path are commanded while results keep the nominal coordinates
+		# with a journal (file name or ScanJournal), completed points are recorded; a scan of the same path with the
+		# same journal skips them, homes untrusted axes (e.g.: after a reboot) and appends to the result file
+		from openxyz.journal import ScanJournal, path_fingerprint
+		from openxyz.scan import ScanExecutor, PickleSink
+		from openxyz.store import ScanStore, STORE_EXTENSION
+
+		coordinates = getattr(path, 'coordinates', path)
+		if isinstance(journal, str):
+			coordinates = list(coordinates)
+			with ScanJournal(journal, path_fingerprint(coordinates), len(coordinates)) as scan_journal:
+				return self.scan(coordinates, callback, sink, post_process, queue_size, scan_journal)
+		if isinstance(sink, str):
+			append = journal is not None and len(journal) > 0
+			if sink.endswith(STORE_EXTENSION):
+				file_sink = ScanStore(sink, 'a' if append else 'w')
+			else:
+				file_sink = PickleSink(sink, append=append)
+			with file_sink:
+				if append:
+					# drop results which are not journaled (written after the last journal sync or partly written on
+					# a crash), their points are scanned again
+					file_sink.truncate(journal.restore(file_sink.position))
+				return self.scan(coordinates, callback, file_sink, post_process, queue_size, journal)
+
+		indices = None
+		if journal is not None and len(journal) > 0:
+			if journal.finished:
+				self._log.info(f"All {journal.points} points already completed")
+				return 0
+			coordinates = list(coordinates)
+			indices = journal.remaining()
+			coordinates = [coordinates[i] for i in indices]
+			self._log.info(f"Resuming scan at point {indices[0]}, {len(indices)} of {journal.points} points remaining")
+			# position is lost if Marlin restarted: home untrusted axes, the cached position is re-read when needed
+			self.auto_home(only_untrusted=True)
+
+		targets = None
+		if self.calibration is not None:
+			coordinates = list(coordinates)
+			targets = iter(self.calibration.correct_path(coordinates))
+
+		def move(coordinate):
+			if targets is not None:
+				coordinate = next(targets)
+			self.move_to(x=coordinate[0], y=coordinate[1], z=coordinate[2] if len(coordinate) > 2 else None)
+
+		executor = ScanExecutor(move, callback, sink, post_process=post_process, queue_size=queue_size,
+								journal=journal)
+		return executor.run(coordinates, indices=indices)
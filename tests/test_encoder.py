@@ -0,0 +1,210 @@
+import importlib
+import json
+import logging
+import sys
+
+import numpy as np
+import pytest
+
+from openxyz.encoder_sampler import EncoderSampler, SAMPLE_FIELDS
+from openxyz.marlin import Marlin
+from openxyz.simulator import FakeEncoderBoard, MarlinSimulator
+
+COUNTS_PER_MM = 1000
+
+
+class HandlerTransport:
+	"""
+	Answers requests with the handlers of the bridge, including the JSON encoding, without a server.
+	"""
+
+	def __init__(self, handlers: dict):
+		self.handlers = handlers
+
+	def post(self, endpoint: str, payload: dict) -> dict:
+		body, status_code = self.handlers[endpoint](json.loads(json.dumps(payload)))
+		assert status_code == 200, body
+		return json.loads(json.dumps(body))
+
+
+@pytest.fixture
+def board(monkeypatch):
+	# the fake board replaces spidev and RPi.GPIO, openxyz.encoder is bound to the board of the test
+	for name in ('spidev', 'RPi', 'RPi.GPIO'):
+		monkeypatch.delitem(sys.modules, name, raising=False)
+	board = FakeEncoderBoard(MarlinSimulator(), counts_per_mm=COUNTS_PER_MM)
+	board.install()
+	encoder = importlib.import_module('openxyz.encoder')
+	monkeypatch.setattr(encoder, 'spidev', sys.modules['spidev'])
+	monkeypatch.setattr(encoder, 'GPIO', sys.modules['RPi.GPIO'])
+	return board
+
+
+@pytest.fixture
+def ls7366r(board):
+	from openxyz.encoder import LS7366R, EncoderAxis
+
+	return LS7366R(bus=0, cs_pins={EncoderAxis.ENCODER_AXIS_X: 23, EncoderAxis.ENCODER_AXIS_Y: 24})
+
+
+def move(board: FakeEncoderBoard, x: float, y: float) -> None:
+	board.simulator.position = [x, y, 0.0]
+
+
+def test_latch_counters_snapshots_all_axes(board, ls7366r):
+	from openxyz.encoder import EncoderAxis
+
+	x_axis, y_axis = EncoderAxis.ENCODER_AXIS_X, EncoderAxis.ENCODER_AXIS_Y
+	move(board, 1.5, 2.25)
+	ls7366r.latch_counters()
+	move(board, 3.0, 4.0)
+	# the output registers keep the latched counters, the counters follow the position
+	assert ls7366r.read_output_register(x_axis) == 1500
+	assert ls7366r.read_output_register(y_axis) == 2250
+	assert ls7366r.read_counter(x_axis) == 3000
+	assert ls7366r.read_counter(y_axis) == 4000
+
+
+def test_latch_counters_only_latches_given_axes(board, ls7366r):
+	from openxyz.encoder import EncoderAxis
+
+	x_axis, y_axis = EncoderAxis.ENCODER_AXIS_X, EncoderAxis.ENCODER_AXIS_Y
+	move(board, 1.0, 1.0)
+	ls7366r.latch_counters()
+	move(board, 2.0, 2.0)
+	ls7366r.latch_counters([y_axis])
+	assert ls7366r.read_output_register(x_axis) == 1000
+	assert ls7366r.read_output_register(y_axis) == 2000
+
+
+def test_read_counters(board, ls7366r):
+	from openxyz.encoder import EncoderAxis
+
+	x_axis, y_axis = EncoderAxis.ENCODER_AXIS_X, EncoderAxis.ENCODER_AXIS_Y
+	move(board, 12.345, 0.5)
+	assert ls7366r.read_counters() == {x_axis: 12345, y_axis: 500}
+	move(board, 7.0, 8.0)
+	assert ls7366r.read_counters([y_axis]) == {y_axis: 8000}
+
+
+def test_read_counters_after_clear_counter(board, ls7366r):
+	from openxyz.encoder import EncoderAxis
+
+	x_axis = EncoderAxis.ENCODER_AXIS_X
+	move(board, 5.0, 0.0)
+	ls7366r.clear_counter(x_axis)
+	move(board, 6.0, 0.0)
+	assert ls7366r.read_counters([x_axis]) == {x_axis: 1000}
+
+
+def counting(start: int = 0):
+	# read callable of an EncoderSampler returning (n, 2n, 3n) for the n-th sample
+	state = {'n': start}
+
+	def read():
+		n = state['n']
+		state['n'] += 1
+		return n, 2 * n, 3 * n
+
+	return read
+
+
+def decode(data: bytes) -> np.ndarray:
+	return np.frombuffer(data, dtype=np.dtype([tuple(field) for field in SAMPLE_FIELDS]))
+
+
+def test_sampler_samples_since():
+	sampler = EncoderSampler(counting(), capacity=8)
+	for _ in range(5):
+		sampler.sample()
+	assert sampler.sequence == 5
+	first, end, data = sampler.samples_since(2)
+	samples = decode(data)
+	assert (first, end) == (2, 5)
+	assert samples['x'].tolist() == [2, 3, 4]
+	assert samples['y'].tolist() == [4, 6, 8]
+	assert samples['z'].tolist() == [6, 9, 12]
+	assert (np.diff(samples['t']) >= 0).all()
+
+
+def test_sampler_limit_and_end():
+	sampler = EncoderSampler(counting(), capacity=8)
+	for _ in range(5):
+		sampler.sample()
+	first, end, data = sampler.samples_since(1, limit=2)
+	assert (first, end) == (1, 3)
+	assert decode(data)['x'].tolist() == [1, 2]
+	assert sampler.samples_since(5) == (5, 5, b'')
+	assert sampler.samples_since(9) == (5, 5, b'')
+
+
+def test_sampler_wraps_around():
+	sampler = EncoderSampler(counting(), capacity=4)
+	for _ in range(6):
+		sampler.sample()
+	# only the newest capacity samples are retained
+	first, end, data = sampler.samples_since(0)
+	assert (first, end) == (2, 6)
+	assert decode(data)['x'].tolist() == [2, 3, 4, 5]
+	# requests crossing the end of the buffer
+	first, end, data = sampler.samples_since(3)
+	assert (first, end) == (3, 6)
+	assert decode(data)['x'].tolist() == [3, 4, 5]
+	first, end, data = sampler.samples_since(3, limit=2)
+	assert (first, end) == (3, 5)
+	assert decode(data)['x'].tolist() == [3, 4]
+
+
+def test_sampler_wraps_around_several_times():
+	sampler = EncoderSampler(counting(), capacity=3)
+	for _ in range(10):
+		sampler.sample()
+	first, end, data = sampler.samples_since(8)
+	assert (first, end) == (8, 10)
+	assert decode(data)['x'].tolist() == [8, 9]
+	first, end, data = sampler.samples_since(0)
+	assert (first, end) == (7, 10)
+	assert decode(data)['x'].tolist() == [7, 8, 9]
+
+
+@pytest.fixture
+def bridge(monkeypatch, board, ls7366r):
+	# bridge handlers reading the fake board, without opening the serial port
+	from openxyz import rpi
+	from openxyz.encoder import EncoderAxis
+
+	monkeypatch.setattr(rpi, 'enc', ls7366r)
+	monkeypatch.setattr(rpi, 'encoder_axes', [EncoderAxis.ENCODER_AXIS_X, EncoderAxis.ENCODER_AXIS_Y])
+	monkeypatch.setattr(rpi, 'encoder_sampler', EncoderSampler(rpi.read_encoders, capacity=4))
+	marlin = Marlin(None, mock=True)
+	monkeypatch.setattr(marlin, '_transport', HandlerTransport({'/encoder_samples': rpi.handle_encoder_samples}))
+	return marlin, rpi.encoder_sampler
+
+
+def test_get_encoder_samples(board, bridge):
+	marlin, sampler = bridge
+	for x, y in ((1.0, 2.0), (1.5, 2.5), (2.0, 3.0)):
+		move(board, x, y)
+		sampler.sample()
+	samples, next_sequence = marlin.get_encoder_samples()
+	assert next_sequence == 3
+	assert samples.dtype.names == ('t', 'x', 'y', 'z')
+	assert samples['x'].tolist() == [1000, 1500, 2000]
+	assert samples['y'].tolist() == [2000, 2500, 3000]
+	assert samples['z'].tolist() == [0, 0, 0]
+	assert (samples['t'] > 0).all()
+
+	samples, next_sequence = marlin.get_encoder_samples(next_sequence)
+	assert len(samples) == 0 and next_sequence == 3
+
+
+def test_get_encoder_samples_overwritten(board, bridge, caplog):
+	marlin, sampler = bridge
+	for x in range(6):
+		move(board, float(x), 0.0)
+		sampler.sample()
+	with caplog.at_level(logging.WARNING):
+		samples, next_sequence = marlin.get_encoder_samples(0, limit=3)
+	assert samples['x'].tolist() == [2000, 3000, 4000]
+	assert next_sequence == 5
+	assert '2 encoder samples were overwritten' in caplog.text
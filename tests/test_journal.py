@@ -0,0 +1,172 @@
+import os
+import pickle
+
+import pytest
+
+from openxyz.journal import ScanJournal, path_fingerprint, HEADER, RECORD
+from openxyz.marlin import Marlin
+from openxyz.results import ScanResults
+from openxyz.store import ScanStore
+from openxyz.xyz_stage import Stage
+
+PATH = [(float(i % 5), float(i // 5)) for i in range(20)]
+
+
+class Failure(Exception):
+	pass
+
+
+def measure(fail_at: int = None):
+	# measurement returning the number of the point, raises at point fail_at
+	state = {'n': 0}
+
+	def callback():
+		n = state['n']
+		state['n'] += 1
+		if n == fail_at:
+			raise Failure(f"Measurement {n} failed")
+		return {'n': n}
+
+	return callback
+
+
+def number(coordinate, data):
+	# replaces the measurement count with the index of the point, which stays the same on resume
+	return {'n': PATH.index(tuple(coordinate))}
+
+
+@pytest.fixture
+def stage():
+	return Stage(Marlin(None, mock=True))
+
+
+def read(filename: str) -> list:
+	if filename.endswith('.oxyz'):
+		with ScanStore(filename) as store:
+			return list(store)
+	with ScanResults(filename, sidecar=False) as results:
+		return list(results)
+
+
+def assert_complete(filename: str) -> None:
+	rows = read(filename)
+	assert [tuple(coordinate) for coordinate, _ in rows] == PATH
+	assert [data['n'] for _, data in rows] == list(range(len(PATH)))
+
+
+@pytest.mark.parametrize('name', ['results.pckl', 'results.oxyz'])
+def test_resume_after_failure(stage, tmp_path, name):
+	results, journal = str(tmp_path / name), str(tmp_path / 'scan.journal')
+	with pytest.raises(Failure):
+		stage.scan(PATH, measure(fail_at=7), results, post_process=number, journal=journal)
+	assert len(read(results)) == 7
+
+	assert stage.scan(PATH, measure(), results, post_process=number, journal=journal) == 13
+	assert_complete(results)
+	# a finished scan is not repeated
+	assert stage.scan(PATH, measure(), results, post_process=number, journal=journal) == 0
+	assert_complete(results)
+
+
+def test_resume_truncates_partly_written_record(stage, tmp_path):
+	results, journal = str(tmp_path / 'results.pckl'), str(tmp_path / 'scan.journal')
+	with pytest.raises(Failure):
+		stage.scan(PATH, measure(fail_at=7), results, post_process=number, journal=journal)
+	# killed while writing the result of point 7
+	with open(results, 'ab') as f:
+		f.write(pickle.dumps((PATH[7], {'n': 7}), protocol=pickle.HIGHEST_PROTOCOL)[:10])
+
+	assert stage.scan(PATH, measure(), results, post_process=number, journal=journal) == 13
+	assert_complete(results)
+
+
+@pytest.mark.parametrize('name', ['results.pckl', 'results.oxyz'])
+def test_resume_drops_results_missing_in_journal(stage, tmp_path, name):
+	results, journal = str(tmp_path / name), str(tmp_path / 'scan.journal')
+	with pytest.raises(Failure):
+		stage.scan(PATH, measure(fail_at=7), results, post_process=number, journal=journal)
+	# results of points 7 and 8 were written, the journal was not synced any more
+	if name.endswith('.oxyz'):
+		with ScanStore(results, 'a') as store:
+			for index in (7, 8):
+				store.append(PATH[index], {'n': index})
+	else:
+		with open(results, 'ab') as f:
+			for index in (7, 8):
+				pickle.dump((PATH[index], {'n': index}), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+	assert stage.scan(PATH, measure(), results, post_process=number, journal=journal) == 13
+	assert_complete(results)
+
+
+def test_journal_records_and_remaining(tmp_path):
+	filename = str(tmp_path / 'scan.journal')
+	fingerprint = path_fingerprint(PATH)
+	with ScanJournal(filename, fingerprint, len(PATH)) as journal:
+		for index in (0, 1, 3):
+			journal.record(index, 10 * (index + 1))
+		assert len(journal) == 3
+		assert journal.completed(3) and not journal.completed(2)
+		assert journal.position == 40
+
+	with ScanJournal(filename, fingerprint, len(PATH)) as journal:
+		assert len(journal) == 3
+		assert journal.position == 40
+		assert journal.remaining().tolist() == [2] + list(range(4, 20))
+		assert not journal.finished
+
+
+def test_journal_restore_drops_records_beyond_sink(tmp_path):
+	filename = str(tmp_path / 'scan.journal')
+	fingerprint = path_fingerprint(PATH)
+	with ScanJournal(filename, fingerprint, len(PATH)) as journal:
+		for index in range(5):
+			journal.record(index, 10 * (index + 1))
+
+	with ScanJournal(filename, fingerprint, len(PATH)) as journal:
+		# the sink holds the results of the first three points and part of the fourth
+		assert journal.restore(35) == 30
+		assert len(journal) == 3
+		assert journal.remaining().tolist() == list(range(3, 20))
+	assert os.path.getsize(filename) == HEADER.size + 3 * RECORD.size
+
+	with ScanJournal(filename, fingerprint, len(PATH)) as journal:
+		assert journal.restore(30) == 30
+		assert len(journal) == 3
+		assert journal.restore(0) == 0
+		assert len(journal) == 0
+
+
+def test_journal_ignores_truncated_record(tmp_path):
+	filename = str(tmp_path / 'scan.journal')
+	fingerprint = path_fingerprint(PATH)
+	with ScanJournal(filename, fingerprint, len(PATH)) as journal:
+		journal.record(0, 10)
+		journal.record(1, 20)
+	with open(filename, 'r+b') as f:
+		f.truncate(HEADER.size + RECORD.size + 3)
+
+	with ScanJournal(filename, fingerprint, len(PATH)) as journal:
+		assert len(journal) == 1
+		assert journal.position == 10
+	assert os.path.getsize(filename) == HEADER.size + RECORD.size
+
+
+def test_journal_of_another_path_is_rejected(stage, tmp_path):
+	filename = str(tmp_path / 'scan.journal')
+	ScanJournal(filename, path_fingerprint(PATH), len(PATH)).close()
+	other = list(reversed(PATH))
+	with pytest.raises(ValueError, match='belongs to a different path'):
+		ScanJournal(filename, path_fingerprint(other), len(other))
+	with pytest.raises(ValueError, match='belongs to a different path'):
+		ScanJournal(filename, path_fingerprint(PATH), len(PATH) + 1)
+	with pytest.raises(ValueError, match='belongs to a different path'):
+		stage.scan(other, measure(), str(tmp_path / 'results.pckl'), journal=filename)
+
+
+def test_file_which_is_no_journal_is_rejected(tmp_path):
+	filename = str(tmp_path / 'scan.journal')
+	with open(filename, 'wb') as f:
+		f.write(b'\0' * HEADER.size)
+	with pytest.raises(ValueError, match='is not a scan journal'):
+		ScanJournal(filename, path_fingerprint(PATH), len(PATH))
@@ -0,0 +1,215 @@
+import re
+
+import pytest
+
+from openxyz.marlin_serial import MarlinSerial
+from openxyz.simulator import MarlinSimulator
+from openxyz.utils import checksum
+
+NUMBERED_LINE = re.compile(r'^N(\d+) (.*)\*(\d+)$')
+
+
+class InterruptingPort:
+	"""
+	Serial port of a simulated Marlin which calls a function on the first read after a command was written, while
+	MarlinSerial waits for its reply.
+	"""
+
+	def __init__(self, simulator: MarlinSimulator):
+		self.simulator = simulator
+		self.trigger = None
+		self.armed = False
+
+	def __getattr__(self, name):
+		return getattr(self.simulator, name)
+
+	def write(self, data: bytes) -> int:
+		return self.simulator.write(data)
+
+	def read(self, size: int = 1) -> bytes:
+		if self.armed and self.trigger is not None:
+			self.armed = False
+			self.trigger()
+		return self.simulator.read(size)
+
+
+@pytest.fixture(params=[False, True], ids=['plain', 'streaming'])
+def port(request):
+	port = InterruptingPort(MarlinSimulator())
+	serial = MarlinSerial(None, mock=True, streaming=request.param, simulator=port)
+	return port, serial
+
+
+def test_emergency_nowait_during_command_keeps_reply(port):
+	port, serial = port
+	serial.send_gcode('G92 X5')
+	port.trigger = serial.emergency_nowait
+	port.armed = True
+	# M410 is written while M114 waits for its reply, Marlin answers M114 first
+	assert serial.send_gcode('M114').startswith(b'X:5.00 Y:0.00')
+	assert serial.send_gcode('G92 X7') == b'ok\n'
+	assert serial.send_gcode('M114').startswith(b'X:7.00 Y:0.00')
+
+
+def test_emergency_nowait_between_commands(port):
+	port, serial = port
+	serial.send_gcode('G92 Y3')
+	serial.emergency_nowait()
+	assert serial.send_gcode('M114').startswith(b'X:0.00 Y:3.00')
+	assert serial.send_gcode('M114').startswith(b'X:0.00 Y:3.00')
+
+
+def test_emergency_nowait_twice_during_command(port):
+	port, serial = port
+	port.trigger = lambda: (serial.emergency_nowait(), serial.emergency_nowait())
+	port.armed = True
+	assert serial.send_gcode('M114').startswith(b'X:0.00')
+	serial.emergency_nowait()
+	serial.send_gcode('G92 Z2')
+	assert serial.send_gcode('M114').startswith(b'X:0.00 Y:0.00 Z:2.00')
+
+
+class RecordingPort:
+	"""
+	Serial port of a simulated Marlin which records the written lines and the number of unacknowledged numbered
+	lines, and can alter lines before Marlin receives them.
+	"""
+
+	def __init__(self, simulator: MarlinSimulator):
+		self.simulator = simulator
+		self.lines = []
+		self.outstanding = 0
+		self.max_outstanding = 0
+		# maps a written line to the line Marlin receives (None drops it), applied once per line
+		self.alter = {}
+		self.__received = b''
+
+	def __getattr__(self, name):
+		return getattr(self.simulator, name)
+
+	def write(self, data: bytes) -> int:
+		for line in data.decode().splitlines():
+			self.lines.append(line)
+			if NUMBERED_LINE.match(line):
+				self.outstanding += 1
+				self.max_outstanding = max(self.max_outstanding, self.outstanding)
+			if line in self.alter:
+				line = self.alter.pop(line)
+				if line is None:
+					continue
+			self.simulator.write((line + '\n').encode())
+		return len(data)
+
+	def read(self, size: int = 1) -> bytes:
+		data = self.simulator.read(size)
+		*lines, self.__received = (self.__received + data).split(b'\n')
+		for line in lines:
+			# 'ok' of a numbered line, or of a line rejected with a resend request
+			if line.startswith(b'ok') or line.startswith(b'Resend:'):
+				self.outstanding = max(self.outstanding - 1, 0)
+		return data
+
+
+def numbered(line_number: int, cmd: str) -> str:
+	line = f'N{line_number} {cmd}'
+	return f'{line}*{checksum(line)}'
+
+
+def test_moves_wait_for_completion_without_streaming():
+	port = RecordingPort(MarlinSimulator())
+	serial = MarlinSerial(None, mock=True, simulator=port)
+	for cmd in ('G0 X1', 'G1 X2', 'G17', 'G10', 'G92 X0'):
+		serial.send_gcode(cmd)
+	assert port.lines == ['G0 X1', 'M400', 'G1 X2', 'M400', 'G17', 'G10', 'G92 X0']
+
+
+@pytest.fixture
+def streaming():
+	port = RecordingPort(MarlinSimulator())
+	return port, MarlinSerial(None, mock=True, streaming=True, simulator=port)
+
+
+def test_streamed_lines_are_numbered_with_checksums(streaming):
+	port, serial = streaming
+	for x in range(1, 4):
+		serial.send_gcode(f'G0 X{x}')
+	serial.send_gcode('M114')
+	assert port.lines == ['M110 N0', numbered(1, 'G0 X1'), numbered(2, 'G0 X2'), numbered(3, 'G0 X3'),
+						  numbered(4, 'M114')]
+
+
+def test_streamed_replies_in_order(streaming):
+	port, serial = streaming
+	assert serial.send_gcode('G92 X1') == b'ok\n'
+	# moves return before they are acknowledged, the next command waits for them
+	assert serial.send_gcode('G0 X2') == b''
+	assert serial.send_gcode('G1 Y3 F6000') == b''
+	assert serial.send_gcode('M114').startswith(b'X:2.00 Y:3.00')
+	assert serial.send_gcode('M220') == b'FR:100%\nok\n'
+	assert serial.send_gcode('M999').startswith(b'echo:Unknown command: "M999"')
+	serial.synchronize()
+	assert serial.in_flight == 0
+	assert port.simulator.moves == 2
+
+
+def test_checksum_error_triggers_resend(streaming):
+	port, serial = streaming
+	serial.send_gcode('G0 X1')
+	port.alter[numbered(2, 'G0 X2')] = numbered(2, 'G0 X2')[:-1] + '0'
+	for x in range(2, 6):
+		serial.send_gcode(f'G0 X{x}')
+	assert serial.send_gcode('M114').startswith(b'X:5.00')
+	# line 2 and the lines written behind it are sent again
+	assert port.lines.count(numbered(2, 'G0 X2')) == 2
+	assert port.simulator.moves == 5
+	serial.synchronize()
+
+
+def test_line_number_error_triggers_resend(streaming):
+	port, serial = streaming
+	# Marlin never receives line 2, line 3 is rejected with a line number error
+	port.alter[numbered(2, 'G0 X2')] = None
+	for x in range(1, 5):
+		serial.send_gcode(f'G0 X{x}')
+	assert serial.send_gcode('M114').startswith(b'X:4.00')
+	assert port.lines.count(numbered(2, 'G0 X2')) == 2
+	assert port.lines.count(numbered(3, 'G0 X3')) >= 2
+	assert port.simulator.moves == 4
+
+
+@pytest.mark.parametrize('advanced_ok', [False, True], ids=['ok', 'advanced_ok'])
+@pytest.mark.parametrize('buffer_size', [1, 4])
+def test_window_never_exceeds_buffer_size(advanced_ok, buffer_size):
+	port = RecordingPort(MarlinSimulator(advanced_ok=advanced_ok))
+	serial = MarlinSerial(None, mock=True, streaming=True, buffer_size=buffer_size, simulator=port)
+	for i in range(40):
+		serial.send_gcode(f'G0 X{i % 7} Y{i % 5}')
+		assert serial.in_flight <= buffer_size
+	serial.synchronize()
+	assert port.max_outstanding == buffer_size
+	assert port.outstanding == 0
+
+
+def test_rejected_streamed_move_raised_by_synchronize(streaming):
+	port, serial = streaming
+	serial.send_gcode('G0 X1')
+	# Marlin does not know the command it received for line 2
+	port.alter[numbered(2, 'G1 X2')] = numbered(2, 'G999 X2')
+	serial.send_gcode('G1 X2')
+	serial.send_gcode('G0 X3')
+	with pytest.raises(IOError, match=r'rejected 1 streamed moves: N2 G1 X2: echo:Unknown command'):
+		serial.synchronize()
+	# reported once
+	serial.synchronize()
+	assert serial.send_gcode('M114').startswith(b'X:3.00')
+
+
+def test_emergency_while_streaming(streaming):
+	port, serial = streaming
+	for x in range(1, 4):
+		serial.send_gcode(f'G1 X{10 * x} F600')
+	serial.emergency()
+	assert port.lines[-1] == numbered(4, 'M410')
+	assert serial.in_flight == 0
+	serial.send_gcode('G92 X0')
+	assert serial.send_gcode('M114').startswith(b'X:0.00')
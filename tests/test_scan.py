@@ -0,0 +1,80 @@
+import threading
+
+import pytest
+
+from openxyz.scan import ScanExecutor
+
+COORDINATES = [(float(i), 0.0) for i in range(10)]
+
+
+class Failure(Exception):
+	pass
+
+
+def measure(fail_at: int = None, failed: threading.Event = None):
+	# measurement returning the number of the point, raises at point fail_at
+	state = {'n': 0}
+
+	def callback():
+		n = state['n']
+		state['n'] += 1
+		if n == fail_at:
+			if failed is not None:
+				failed.set()
+			raise Failure(f"Measurement {n} failed")
+		return n
+
+	return callback
+
+
+def test_results_in_path_order():
+	rows = []
+	executor = ScanExecutor(lambda coordinate: None, measure(), lambda c, d: rows.append((c, d)),
+							post_process=lambda coordinate, data: data * 10, post_process_workers=3)
+	assert executor.run(COORDINATES) == 10
+	assert rows == [(coordinate, 10 * i) for i, coordinate in enumerate(COORDINATES)]
+
+
+def test_measurement_failure_persists_measured_results():
+	rows = []
+	failed = threading.Event()
+
+	def post_process(coordinate, data):
+		# results queue up until the measurement failed
+		assert failed.wait(5.0)
+		return data
+
+	executor = ScanExecutor(lambda coordinate: None, measure(fail_at=7, failed=failed),
+							lambda c, d: rows.append((c, d)), post_process=post_process)
+	with pytest.raises(Failure):
+		executor.run(COORDINATES)
+	assert rows == [(coordinate, i) for i, coordinate in enumerate(COORDINATES[:7])]
+
+
+def test_post_process_failure_persists_results_before():
+	rows = []
+
+	def post_process(coordinate, data):
+		if data == 3:
+			raise Failure("Post-process failed")
+		return data
+
+	executor = ScanExecutor(lambda coordinate: None, measure(), lambda c, d: rows.append((c, d)),
+							post_process=post_process, post_process_workers=2)
+	with pytest.raises(Failure):
+		executor.run(COORDINATES)
+	assert rows == [(coordinate, i) for i, coordinate in enumerate(COORDINATES[:3])]
+
+
+def test_sink_failure_stops_persisting():
+	rows = []
+
+	def append(coordinate, data):
+		if data == 4:
+			raise Failure("Sink failed")
+		rows.append((coordinate, data))
+
+	executor = ScanExecutor(lambda coordinate: None, measure(), append)
+	with pytest.raises(Failure):
+		executor.run(COORDINATES)
+	assert rows == [(coordinate, i) for i, coordinate in enumerate(COORDINATES[:4])]
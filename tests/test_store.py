@@ -0,0 +1,165 @@
+import os
+import struct
+
+import numpy as np
+import pytest
+
+from openxyz.store import ScanStore, FOOTER_MAGIC
+
+
+def rows(count: int, start: int = 0) -> list:
+	# rows with a number, a trace and an object column
+	return [((float(i), float(2 * i)), {'n': i, 'trace': np.arange(4, dtype=np.float32) + i, 'label': f'p{i}'})
+			for i in range(start, start + count)]
+
+
+def write(filename: str, data: list, **kwargs) -> None:
+	with ScanStore(filename, 'w', **kwargs) as store:
+		for coordinate, value in data:
+			store.append(coordinate, value)
+
+
+def assert_rows(store: ScanStore, expected: list) -> None:
+	assert len(store) == len(expected)
+	for (coordinate, data), (expected_coordinate, expected_data) in zip(store, expected):
+		assert coordinate == expected_coordinate
+		assert data['n'] == expected_data['n'] and data['label'] == expected_data['label']
+		np.testing.assert_array_equal(data['trace'], expected_data['trace'])
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_round_trip(tmp_path, compression):
+	filename = str(tmp_path / 'scan.oxyz')
+	expected = rows(10)
+	write(filename, expected, chunk_size=4, compression=compression)
+
+	with ScanStore(filename) as store:
+		assert store.layout == 'dict'
+		assert store.names == ['n', 'trace', 'label']
+		assert store.dimension == 2
+		assert_rows(store, expected)
+		assert store.column('coordinate').tolist() == [list(c) for c, _ in expected]
+		assert store.column('n').tolist() == list(range(10))
+		assert store.column('trace', 3, 6).shape == (3, 4)
+		assert store.column('label') == [f'p{i}' for i in range(10)]
+		assert [len(chunk) for chunk in store.chunks('n')] == [4, 4, 2]
+
+
+def test_numbers_are_read_as_python_types(tmp_path):
+	filename = str(tmp_path / 'scan.oxyz')
+	write(filename, [((0, 0), {'i': 1, 'f': 0.5}), ((1, 0), {'i': 2, 'f': 1.5})])
+	with ScanStore(filename) as store:
+		coordinate, data = store[1]
+		assert coordinate == (1.0, 0.0) and type(coordinate[0]) is float
+		assert data == {'i': 2, 'f': 1.5}
+		assert type(data['i']) is int and type(data['f']) is float
+
+
+def test_value_layout(tmp_path):
+	filename = str(tmp_path / 'scan.oxyz')
+	write(filename, [((i, 0, 1), i * 0.5) for i in range(3)])
+	with ScanStore(filename) as store:
+		assert store.layout == 'value' and store.dimension == 3
+		assert list(store) == [((i, 0.0, 1.0), i * 0.5) for i in range(3)]
+
+
+def test_append_mode(tmp_path):
+	filename = str(tmp_path / 'scan.oxyz')
+	expected = rows(6)
+	write(filename, expected[:3], chunk_size=2)
+	with ScanStore(filename, 'a', chunk_size=2) as store:
+		assert len(store) == 3
+		for coordinate, data in expected[3:]:
+			store.append(coordinate, data)
+	with ScanStore(filename) as store:
+		assert_rows(store, expected)
+
+
+def test_rows_with_other_axes_are_rejected(tmp_path):
+	filename = str(tmp_path / 'scan.oxyz')
+	with ScanStore(filename, 'w') as store:
+		store.append((0, 0), 1)
+		with pytest.raises(ValueError, match='has 3 axes'):
+			store.append((0, 0, 0), 2)
+		store.append((1, 0), 3)
+	# the number of axes of a stored file is kept when appending
+	with ScanStore(filename, 'a') as store:
+		assert store.dimension == 2
+		with pytest.raises(ValueError, match='has 1 axes'):
+			store.append((5,), 4)
+	with ScanStore(filename) as store:
+		assert list(store) == [((0.0, 0.0), 1), ((1.0, 0.0), 3)]
+
+
+def test_read_only(tmp_path):
+	filename = str(tmp_path / 'scan.oxyz')
+	write(filename, rows(1))
+	with ScanStore(filename) as store:
+		with pytest.raises(IOError):
+			store.append((0, 0), {})
+
+
+def test_recovery_without_footer(tmp_path):
+	filename = str(tmp_path / 'scan.oxyz')
+	expected = rows(10)
+	write(filename, expected, chunk_size=4)
+	# killed after the last chunk, before the footer was written
+	with open(filename, 'r+b') as f:
+		f.truncate(os.path.getsize(filename) - len(FOOTER_MAGIC) - 3)
+
+	with ScanStore(filename) as store:
+		assert_rows(store, expected)
+
+
+def test_recovery_drops_incomplete_chunk(tmp_path):
+	filename = str(tmp_path / 'scan.oxyz')
+	expected = rows(10)
+	write(filename, expected, chunk_size=4)
+	# killed while writing the last chunk: the footer and the end of the chunk are missing
+	with open(filename, 'r+b') as f:
+		f.seek(-len(FOOTER_MAGIC) - 8, os.SEEK_END)
+		length = struct.unpack('<Q', f.read(8))[0]
+		f.truncate(os.path.getsize(filename) - len(FOOTER_MAGIC) - 8 - length - 8)
+
+	with ScanStore(filename) as store:
+		assert_rows(store, expected[:8])
+	# appending replaces the incomplete chunk
+	with ScanStore(filename, 'a', chunk_size=4) as store:
+		for coordinate, data in expected[8:]:
+			store.append(coordinate, data)
+	with ScanStore(filename) as store:
+		assert_rows(store, expected)
+
+
+def test_position_and_truncate(tmp_path):
+	filename = str(tmp_path / 'scan.oxyz')
+	expected = rows(10)
+	with ScanStore(filename, 'w', chunk_size=4) as store:
+		for coordinate, data in expected:
+			store.append(coordinate, data)
+		# pending rows count
+		assert len(store) == 8 and store.pending == 2
+		assert store.position == 10
+		# within the pending rows
+		store.truncate(9)
+		assert store.position == 9 and len(store) == 8
+		# within a written chunk, the kept rows of the chunk are written again
+		store.truncate(6)
+		assert store.position == 6 and len(store) == 6
+		assert_rows(store, expected[:6])
+		for coordinate, data in expected[6:]:
+			store.append(coordinate, data)
+	with ScanStore(filename) as store:
+		assert_rows(store, expected)
+
+	with ScanStore(filename, 'a') as store:
+		# at a chunk boundary
+		store.truncate(4)
+		assert store.position == 4
+	with ScanStore(filename) as store:
+		assert_rows(store, expected[:4])
+
+	with ScanStore(filename, 'a') as store:
+		store.truncate(0)
+	with ScanStore(filename) as store:
+		assert len(store) == 0
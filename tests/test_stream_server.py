@@ -0,0 +1,99 @@
+import json
+import socket
+import threading
+
+import pytest
+
+from openxyz import rpi
+from openxyz.serial_worker import SerialWorker
+from openxyz.simulator import MarlinSimulator, VirtualClock
+from openxyz.stream_server import StreamServer
+from openxyz.transport import TcpTransport
+
+
+@pytest.fixture
+def simulator():
+	return MarlinSimulator(clock=VirtualClock(), keepalive_interval=1.0)
+
+
+@pytest.fixture
+def server(monkeypatch, simulator):
+	# bridge handlers on a simulated Marlin, the stream server listens on a free local port
+	worker = SerialWorker(None, mock=True, simulator=simulator)
+	monkeypatch.setattr(rpi, 'marlin_worker', worker)
+	server = StreamServer(('127.0.0.1', 0), rpi.HANDLERS, worker=worker, immediate=('/emergency', '/status'))
+	server.start()
+	yield server
+	server.stop()
+	worker.stop(5.0)
+
+
+@pytest.fixture
+def transport(server):
+	transport = TcpTransport(f'tcp://127.0.0.1:{server.port}', read_timeout=10.0)
+	yield transport
+	transport.close()
+
+
+def test_pipelined_requests_get_their_responses(transport):
+	futures = []
+	for x in range(1, 6):
+		futures.append(('/send_gcode', transport.submit('/send_gcode', {"gcode": f"G0 X{x}"})))
+		futures.append(('/send_gcode', transport.submit('/send_gcode', {"gcode": "M114"})))
+	futures.append(('/unknown', transport.submit('/unknown', {})))
+	futures.append(('/send_gcode', transport.submit('/send_gcode', {"gcode": "M114"})))
+
+	bodies = [future.result(10.0) for _, future in futures]
+	for x in range(1, 6):
+		move, position = bodies[2 * x - 2], bodies[2 * x - 1]
+		assert move == ({"response": ""}, 200)
+		assert position[1] == 200 and position[0]["response"].startswith(f"X:{x}.00 Y:0.00")
+	assert bodies[-2][1] == 404
+	assert bodies[-1][0]["response"].startswith("X:5.00 Y:0.00")
+
+
+def test_responses_carry_the_request_id(server):
+	with socket.create_connection(('127.0.0.1', server.port), timeout=10.0) as connection:
+		ids = [7, 3, 42, "a"]
+		requests = b''.join(json.dumps({"id": request_id, "endpoint": "/send_gcode",
+										"payload": {"gcode": f"G0 Y{i + 1}"}}).encode() + b'\n'
+							for i, request_id in enumerate(ids))
+		connection.sendall(requests)
+		lines = connection.makefile('rb')
+		responses = []
+		while len(responses) < len(ids):
+			message = json.loads(lines.readline())
+			# busy events may be interleaved with the responses
+			if "event" not in message:
+				responses.append(message)
+	assert [response["id"] for response in responses] == ids
+	assert all(response["status"] == 200 for response in responses)
+
+
+def test_busy_events_reach_listeners(transport):
+	events = []
+	received = threading.Event()
+
+	def listener(event):
+		events.append(event)
+		received.set()
+
+	transport.add_listener(listener)
+	# the dwell outlasts several keepalive intervals of the simulator
+	assert transport.post('/send_gcode', {"gcode": "G4 S5"}) == {"response": ""}
+	assert received.wait(5.0)
+	assert {"event": "busy"} in events
+
+
+def test_busy_events_after_reconnect(server, transport):
+	# a closed connection does not keep other connections from receiving events
+	transport.post('/send_gcode', {"gcode": "G4 S2"})
+	transport.close()
+	other = TcpTransport(f'tcp://127.0.0.1:{server.port}', read_timeout=10.0)
+	try:
+		events = []
+		other.add_listener(events.append)
+		other.post('/send_gcode', {"gcode": "G4 S3"})
+		assert {"event": "busy"} in events
+	finally:
+		other.close()